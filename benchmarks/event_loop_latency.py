@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Event-loop latency benchmark for blocking pytubefix work.
+
+Runs a ticker coroutine that measures how late each wake-up is while several
+"downloads" run, once with the blocking call made directly inside a coroutine
+(the old behaviour) and once through run_pytube() on the dedicated executor.
+
+    python benchmarks/event_loop_latency.py                  # simulated blocking work
+    python benchmarks/event_loop_latency.py --url <youtube>  # real metadata fetches
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.download_service import run_pytube, load_youtube
+
+TICK_INTERVAL = 0.01  # 10 ms
+
+
+def simulated_download(seconds: float) -> int:
+    """Stand-in for stream.download(): blocking I/O waits plus some CPU work"""
+    deadline = time.monotonic() + seconds
+    total = 0
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        total += sum(range(20000))
+    return total
+
+
+async def ticker(stop: asyncio.Event, lags: list):
+    """Record how late the loop wakes us compared to the requested interval"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK_INTERVAL)
+        lags.append((time.perf_counter() - start - TICK_INTERVAL) * 1000)
+
+
+async def run_case(name: str, job_factory, jobs: int) -> dict:
+    stop = asyncio.Event()
+    lags: list = []
+    tick_task = asyncio.create_task(ticker(stop, lags))
+    await asyncio.sleep(0.1)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(job_factory() for _ in range(jobs)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await tick_task
+
+    lags.sort()
+    return {
+        'case': name,
+        'jobs': jobs,
+        'wall_s': elapsed,
+        'p50_ms': statistics.median(lags) if lags else 0.0,
+        'p99_ms': lags[int(len(lags) * 0.99) - 1] if lags else 0.0,
+        'max_ms': lags[-1] if lags else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=4, help='concurrent jobs per case')
+    parser.add_argument('--seconds', type=float, default=1.0, help='duration of each simulated job')
+    parser.add_argument('--url', help='YouTube URL to fetch metadata for instead of simulating')
+    args = parser.parse_args()
+
+    if args.url:
+        async def inline():
+            load_youtube(args.url)
+
+        async def offloaded():
+            await run_pytube('metadata', load_youtube, args.url)
+    else:
+        async def inline():
+            simulated_download(args.seconds)
+
+        async def offloaded():
+            await run_pytube('download', simulated_download, args.seconds)
+
+    results = [
+        await run_case('inline (blocking in coroutine)', inline, args.jobs),
+        await run_case('run_pytube (dedicated executor)', offloaded, args.jobs),
+    ]
+
+    print(f"{'case':<34}{'jobs':>6}{'wall s':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>10}")
+    for r in results:
+        print(f"{r['case']:<34}{r['jobs']:>6}{r['wall_s']:>9.2f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['max_ms']:>10.2f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -20,7 +20,9 @@ USERBOT_CONFIG = {
     'session_timeout': int(os.environ.get('SESSION_TIMEOUT', 300)),  # 5 minutes
     'retry_attempts': int(os.environ.get('RETRY_ATTEMPTS', 3)),
     'retry_delay': int(os.environ.get('RETRY_DELAY', 5)),
-    'load_balance_method': os.environ.get('LOAD_BALANCE_METHOD', 'round_robin')  # round_robin, least_used
+    'load_balance_method': os.environ.get('LOAD_BALANCE_METHOD', 'round_robin'),  # round_robin, least_used
+    'storage_channel': int(os.environ.get('STORAGE_CHANNEL_ID', 0)),  # private channel with the userbots and the bot as admins; 0 disables routing
+    'route_min_size': int(os.environ.get('ROUTE_MIN_SIZE', 50 * 1024 * 1024))  # smaller files are uploaded by the bot itself
 }
 
 # Download Configuration
@@ -28,8 +30,74 @@ DOWNLOAD_CONFIG = {
     'temp_dir': Path("temp_downloads"),
     'max_file_size': int(os.environ.get('MAX_FILE_SIZE', 1536 * 1024 * 1024)),  # 1.5GB
     'cleanup_after': int(os.environ.get('CLEANUP_AFTER', 3600)),  # 1 hour
-    'concurrent_downloads': int(os.environ.get('CONCURRENT_DOWNLOADS', 3)),
-    'chunk_size': int(os.environ.get('CHUNK_SIZE', 8192))
+    'concurrent_downloads': int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', os.environ.get('CONCURRENT_DOWNLOADS', 3))),
+    'max_pending_downloads': int(os.environ.get('MAX_PENDING_DOWNLOADS', 20)),  # queued jobs beyond the workers
+    'chunk_size': int(os.environ.get('CHUNK_SIZE', 8192)),
+    'pytube_workers': int(os.environ.get('PYTUBE_WORKERS', 6)),  # threads for blocking pytubefix calls
+    'metadata_timeout': int(os.environ.get('METADATA_TIMEOUT', 60)),
+    'streams_timeout': int(os.environ.get('STREAMS_TIMEOUT', 60)),
+    'download_timeout': int(os.environ.get('DOWNLOAD_TIMEOUT', 1800)),
+    'youtube_clients': [c.strip() for c in os.environ.get('YOUTUBE_CLIENTS', 'WEB,ANDROID_VR,TV').split(',') if c.strip()],
+    'youtube_cookie_files': [f.strip() for f in os.environ.get('YOUTUBE_COOKIE_FILES', 'cookies.txt').split(',') if f.strip()],  # one per account, rotated
+    'po_token_file': os.environ.get('PO_TOKEN_FILE', 'po_tokens.json'),  # {account: {visitor_data, po_token}}, keyed by cookie file stem
+    'metadata_hedging': os.environ.get('METADATA_HEDGING', 'true').lower() == 'true',  # race a second client when slow
+    'hedge_percentile': float(os.environ.get('HEDGE_PERCENTILE', 0.9)),  # of the client's latency before hedging
+    'hedge_min_delay': float(os.environ.get('HEDGE_MIN_DELAY', 2.0)),
+    'hedge_initial_delay': float(os.environ.get('HEDGE_INITIAL_DELAY', 8.0)),  # until the client has latency samples
+    'client_cooldown': int(os.environ.get('CLIENT_COOLDOWN', 600)),  # seconds a bot-checked client is avoided
+    'metadata_cache_size': int(os.environ.get('METADATA_CACHE_SIZE', 256)),  # videos kept in memory
+    'metadata_cache_ttl': int(os.environ.get('METADATA_CACHE_TTL', 1800)),  # stream URLs expire upstream after a few hours
+    'segmented_download': os.environ.get('SEGMENTED_DOWNLOAD', 'true').lower() == 'true',
+    'download_segments': int(os.environ.get('DOWNLOAD_SEGMENTS', 4)),  # concurrent range requests per file
+    'segment_size': int(os.environ.get('SEGMENT_SIZE', 8 * 1024 * 1024)),  # googlevideo throttles long ranges
+    'segment_retries': int(os.environ.get('SEGMENT_RETRIES', 3)),
+    'resume_attempts': int(os.environ.get('RESUME_ATTEMPTS', 2)),  # resumes from the checkpoint before falling back
+    'checkpoint_interval': int(os.environ.get('CHECKPOINT_INTERVAL', 2)),  # seconds between checkpoint writes
+    'http_chunk_size': int(os.environ.get('HTTP_CHUNK_SIZE', 256 * 1024)),
+    'http_pool_size': int(os.environ.get('HTTP_POOL_SIZE', 32)),
+    'adaptive_download': os.environ.get('ADAPTIVE_DOWNLOAD', 'true').lower() == 'true',  # DASH video+audio above 720p
+    'ffmpeg_workers': int(os.environ.get('FFMPEG_WORKERS', 2)),  # concurrent ffmpeg/ffprobe processes
+    'mux_timeout': int(os.environ.get('MUX_TIMEOUT', 600)),
+    'faststart': os.environ.get('FASTSTART', 'true').lower() == 'true',  # remux mp4s whose moov atom is at the end
+    'probe_workers': int(os.environ.get('PROBE_WORKERS', 4)),  # concurrent ffprobe processes, separate from muxing
+    'probe_timeout': int(os.environ.get('PROBE_TIMEOUT', 30)),
+    'probe_cache_size': int(os.environ.get('PROBE_CACHE_SIZE', 512)),  # probed files remembered by content
+    'streaming_upload': os.environ.get('STREAMING_UPLOAD', 'true').lower() == 'true',  # upload while downloading
+    'stream_buffer_size': int(os.environ.get('STREAM_BUFFER_SIZE', 32 * 1024 * 1024)),  # RAM before spilling to disk
+    'upload_connections': int(os.environ.get('UPLOAD_CONNECTIONS', 4)),  # MTProto connections per file upload
+    'upload_part_retries': int(os.environ.get('UPLOAD_PART_RETRIES', 3)),
+    'parallel_upload_min_size': int(os.environ.get('PARALLEL_UPLOAD_MIN_SIZE', 20 * 1024 * 1024)),  # smaller files use send_file
+    'upload_workers': int(os.environ.get('UPLOAD_WORKERS', 4)),  # upload parts in flight per file
+    'storage_budget': int(os.environ.get('STORAGE_BUDGET', 8 * 1024 * 1024 * 1024)),  # bytes of temp_dir in use at once
+    'storage_wait_timeout': int(os.environ.get('STORAGE_WAIT_TIMEOUT', 600)),  # wait for space before failing a job
+    'storage_max_age': int(os.environ.get('STORAGE_MAX_AGE', 24 * 3600)),  # kept partials / leaked files expire
+    'storage_sweep_interval': int(os.environ.get('STORAGE_SWEEP_INTERVAL', 600)),
+    'max_duration': int(os.environ.get('MAX_DURATION', 4 * 3600)),  # seconds of video, 0 for no limit
+    'max_eta': int(os.environ.get('MAX_ETA', 1800)),  # reject/downgrade jobs that would finish later than this
+    'assumed_throughput': int(os.environ.get('ASSUMED_THROUGHPUT', 4 * 1024 * 1024)),  # bytes/s before jobs are measured
+    'speculative_prefetch': os.environ.get('SPECULATIVE_PREFETCH', 'false').lower() == 'true',  # download the likely pick early
+    'prefetch_max_jobs': int(os.environ.get('PREFETCH_MAX_JOBS', 1)),  # speculative downloads at once
+    'prefetch_budget': int(os.environ.get('PREFETCH_BUDGET', 1024 * 1024 * 1024)),  # bytes speculated at once
+    'prefetch_max_size': int(os.environ.get('PREFETCH_MAX_SIZE', 300 * 1024 * 1024)),
+    'prefetch_min_confidence': float(os.environ.get('PREFETCH_MIN_CONFIDENCE', 0.5)),  # share of history for the guess
+    'prefetch_ttl': int(os.environ.get('PREFETCH_TTL', 300)),  # seconds a prefetched file waits for its tap
+    'prefetch_miss_limit': int(os.environ.get('PREFETCH_MISS_LIMIT', 3)),  # wrong guesses in a row before a cooldown
+    'prefetch_cooldown': int(os.environ.get('PREFETCH_COOLDOWN', 3600)),
+    'bandwidth_limit': int(os.environ.get('BANDWIDTH_LIMIT', 0)),  # download bytes/s for the whole bot, 0 for no limit
+    'small_job_share': float(os.environ.get('SMALL_JOB_SHARE', 0.25)),  # of the limit, kept for small jobs
+    'small_job_size': int(os.environ.get('SMALL_JOB_SIZE', 50 * 1024 * 1024)),  # audio and shorts usually fit
+    'small_job_duration': int(os.environ.get('SMALL_JOB_DURATION', 60)),  # seconds; shorts are always small jobs
+    'instagram_album_concurrency': int(os.environ.get('INSTAGRAM_ALBUM_CONCURRENCY', 4)),  # carousel items fetched at once
+    'instagram_cache_size': int(os.environ.get('INSTAGRAM_CACHE_SIZE', 256)),  # posts kept in memory
+    'instagram_cache_ttl': int(os.environ.get('INSTAGRAM_CACHE_TTL', 600)),  # CDN links in a post expire upstream
+    'instagram_requests_per_minute': int(os.environ.get('INSTAGRAM_REQUESTS_PER_MINUTE', 20)),  # per account, and for the bare IP
+    'instagram_cooldown': int(os.environ.get('INSTAGRAM_COOLDOWN', 900)),  # seconds an account rests after a 429
+    'instagram_attempts': int(os.environ.get('INSTAGRAM_ATTEMPTS', 3)),  # accounts tried per post
+    'instagram_max_file_size': int(os.environ.get('INSTAGRAM_MAX_FILE_SIZE', 200 * 1024 * 1024)),  # reserved when the CDN sends no length
+    'progress_interval': float(os.environ.get('PROGRESS_INTERVAL', 1.0)),  # seconds between progress events per job
+    'outbox_rate': float(os.environ.get('OUTBOX_RATE', 25)),  # bot messages and edits per second over all chats
+    'outbox_chat_interval': float(os.environ.get('OUTBOX_CHAT_INTERVAL', 1.0)),  # seconds between calls to one private chat
+    'outbox_group_interval': float(os.environ.get('OUTBOX_GROUP_INTERVAL', 3.0))  # groups allow about 20 messages a minute
 }
 
 # Create temp directory
@@ -62,6 +130,7 @@ DATABASE_CONFIG = {
             session_used TEXT,
             download_date TEXT,
             status TEXT,
+            quality TEXT,
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )''',
         'sessions': '''CREATE TABLE IF NOT EXISTS sessions (
@@ -81,6 +150,22 @@ DATABASE_CONFIG = {
             created_at TEXT,
             processed BOOLEAN DEFAULT 0,
             FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )''',
+        'file_cache': '''CREATE TABLE IF NOT EXISTS file_cache (
+            id INTEGER PRIMARY KEY,
+            platform TEXT,
+            media_id TEXT,
+            quality TEXT,  -- format ID that was uploaded: an itag, or 'video+audio' itags
+            document_id INTEGER,
+            access_hash INTEGER,
+            file_reference BLOB,
+            media_type TEXT,
+            file_size INTEGER,
+            title TEXT,
+            hits INTEGER DEFAULT 0,
+            created_at TEXT,
+            last_used TEXT,
+            UNIQUE (platform, media_id, quality)
         )'''
     }
 }
@@ -129,6 +214,20 @@ QUALITY_OPTIONS = {
     }
 }
 
+# Target heights of the YouTube quality keys
+QUALITY_HEIGHTS = {
+    '4k': 2160,
+    '1440p': 1440,
+    '1080p': 1080,
+    'hd': 720,
+    '720p': 720,
+    'sd': 480,
+    '480p': 480,
+    '360p': 360,
+    '240p': 240,
+    '144p': 144
+}
+
 # Admin Panel Configuration
 ADMIN_PANEL_CONFIG = {
     'main_admin': 79049016,
@@ -165,6 +264,8 @@ MESSAGES = {
 • `/sessions` - مشاهده جلسات فعال
 • `/stats` - آمار ربات
 • `/cleanup` - پاکسازی فایل‌های موقت
+• `/jobs` - دانلودهای در حال اجرا و در صف
+• `/cancel <job_id>` - لغو یک دانلود
 
 ⚠️ **محدودیت‌ها:**
 • حداکثر اندازه فایل: ۵۰ مگابایت
@@ -179,6 +280,15 @@ MESSAGES = {
     'error': '❌ خطایی رخ داد. لطفاً دوباره تلاش کنید.',
     'rate_limited': '⏰ محدودیت نرخ تجاوز شد. لطفاً {seconds} ثانیه صبر کنید.',
     'file_too_large': '📏 فایل خیلی بزرگ است (حداکثر ۱.۵ گیگابایت). کیفیت پایین‌تری امتحان کنید.',
+    'queued': '⏳ **در صف دانلود...**\n\n📍 **جایگاه شما در صف:** {position}\n⏰ **زمان تقریبی شروع:** {eta}\n\n💡 *لطفاً صبر کنید...*',
+    'queue_full': '🚦 **صف دانلود پر است!**\n\n⏰ لطفاً حدود {eta} دیگر دوباره تلاش کنید.',
+    'admitted': '✅ **درخواست پذیرفته شد**\n\n📦 **حجم تقریبی:** {size}\n⏰ **زمان تقریبی تکمیل:** {eta}\n\n💡 *لطفاً صبر کنید...*',
+    'downgraded': '⚠️ **کیفیت درخواستی قابل ارسال نیست**\n\n🔻 دانلود با کیفیت **{quality}** انجام می‌شود.\n📦 **حجم تقریبی:** {size}\n⏰ **زمان تقریبی تکمیل:** {eta}',
+    'too_large': '📦 **فایل بیش از حد بزرگ است!**\n\nحجم {size} از سقف {limit} بیشتر است و کیفیت پایین‌تری هم در این محدوده وجود ندارد.',
+    'too_long': '⏱ **ویدیو بیش از حد طولانی است!**\n\nمدت {duration} از سقف مجاز {limit} بیشتر است.',
+    'too_slow': '🐢 **ربات در حال حاضر بسیار شلوغ است!**\n\nتکمیل این درخواست حدود {eta} طول می‌کشد (سقف: {limit}). لطفاً بعداً دوباره تلاش کنید.',
+    'cancelled': '🛑 **دانلود لغو شد.**',
+    'no_jobs': '💤 هیچ دانلودی در حال اجرا یا در صف نیست.',
     'no_sessions': '🚫 هیچ جلسه Userbot فعالی در دسترس نیست.',
     'session_error': '⚠️ خطای جلسه. در حال امتحان جلسه دیگر...'
 }
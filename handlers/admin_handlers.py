@@ -10,6 +10,7 @@ from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, F
 
 from config import ADMIN_IDS, USERBOT_CONFIG, DOWNLOAD_CONFIG, ADMIN_PANEL_CONFIG
 from utils.database import Database
+from services.outbox import outbox
 from services.session_manager import SessionManager
 from utils.helpers import FileUtils, TextUtils, TimeUtils, format_user_info
 from utils.logging_config import get_logger
@@ -624,7 +625,8 @@ class AdminHandlers:
             
             for user in users:
                 try:
-                    await self.bot.send_message(user['id'], f"📢 **پیام از مدیریت:**\n\n{message}")
+                    # Paced with the rest of the bot's traffic instead of tripping the global flood limit
+                    await outbox.send(self.bot, user['id'], f"📢 **پیام از مدیریت:**\n\n{message}")
                     sent_count += 1
                 except Exception as e:
                     failed_count += 1
@@ -632,14 +634,16 @@ class AdminHandlers:
                 
                 # بروزرسانی پیشرفت هر 10 پیام
                 if (sent_count + failed_count) % 10 == 0:
-                    await progress_msg.edit(
+                    outbox.edit(
+                        progress_msg,
                         f"📢 پیشرفت ارسال:\n"
                         f"✅ ارسال شده: {sent_count}\n"
                         f"❌ ناموفق: {failed_count}\n"
                         f"📊 باقی‌مانده: {len(users) - sent_count - failed_count}"
                     )
             
-            await progress_msg.edit(
+            await outbox.edit(
+                progress_msg,
                 f"✅ **ارسال پیام همگانی تکمیل شد!**\n\n"
                 f"📊 آمار نهایی:\n"
                 f"✅ ارسال موفق: {sent_count}\n"
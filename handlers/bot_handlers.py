@@ -2,29 +2,33 @@ import asyncio
 import logging
 import re
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 from telethon import TelegramClient, events, Button
-from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeAudio
+from telethon.errors import FileReferenceExpiredError, FileIdInvalidError, MediaEmptyError
+from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeAudio, DocumentAttributeFilename, InputDocument
 
 from config import (
     BOT_TOKEN, API_ID, API_HASH, MESSAGES, 
-    ADMIN_IDS, QUALITY_OPTIONS, RATE_LIMIT_CONFIG, ADMIN_PANEL_CONFIG
+    ADMIN_IDS, QUALITY_OPTIONS, RATE_LIMIT_CONFIG, ADMIN_PANEL_CONFIG, DOWNLOAD_CONFIG
 )
-from services.download_service import DownloadService
+from services.download_service import (
+    DownloadService, YOUTUBE_PATTERN, extract_video_id, video_metadata_cache, bandwidth_shaper, metadata_resolver
+)
+from services.cookie_store import cookie_store
+from services.media_processing import media_prober
+from services.outbox import outbox
+from services.prefetch_service import SpeculativePrefetcher
 from services.session_manager import SessionManager
+from services.upload_router import UploadRouter
+from services.upload_service import parallel_upload
 from utils.database import Database
 from utils.rate_limiter import RateLimiter
-from utils.helpers import FileUtils, TimeUtils
+from utils.helpers import FileUtils
 
 logger = logging.getLogger(__name__)
 
 # URL patterns
-YOUTUBE_PATTERN = re.compile(
-    r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
-    r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-)
-
 INSTAGRAM_PATTERN = re.compile(
     r'https?://(?:www\.)?instagram\.com/(?:p|reel|tv)/([A-Za-z0-9_-]+)/?'
 )
@@ -34,6 +38,8 @@ class BotHandlers:
         self.session_manager = session_manager
         self.download_service = DownloadService(session_manager)
         self.db = Database()
+        self.prefetcher = SpeculativePrefetcher(self.download_service, self.db)
+        self.upload_router = UploadRouter(session_manager)
         self.rate_limiter = RateLimiter()
         self.admin_handlers = admin_handlers
         self.bot: Optional[TelegramClient] = None
@@ -61,6 +67,8 @@ class BotHandlers:
         self.bot.add_event_handler(self.sessions_handler, events.NewMessage(pattern='/sessions'))
         self.bot.add_event_handler(self.stats_handler, events.NewMessage(pattern='/stats'))
         self.bot.add_event_handler(self.cleanup_handler, events.NewMessage(pattern='/cleanup'))
+        self.bot.add_event_handler(self.jobs_handler, events.NewMessage(pattern='/jobs'))
+        self.bot.add_event_handler(self.cancel_handler, events.NewMessage(pattern='/cancel'))
         self.bot.add_event_handler(self.url_handler, events.NewMessage())
         self.bot.add_event_handler(self.callback_handler, events.CallbackQuery())
         
@@ -96,7 +104,8 @@ class BotHandlers:
                         message_type = message_data['message_type']
                         
                         # Send notification to user that their request is being processed
-                        await self.bot.send_message(
+                        await outbox.send(
+                            self.bot,
                             user_id,
                             "🔄 **درخواست شما در حال پردازش است...**\n\n"
                             "ربات مجدداً آنلاین شده و درخواست قبلی شما را پردازش می‌کند."
@@ -245,6 +254,36 @@ class BotHandlers:
             message += f"• کل دانلودها: {stats.get('total_downloads', 0)}\n"
             message += f"• جلسات فعال: {len(self.session_manager.active_sessions)}\n"
             message += f"• دانلودهای امروز: {stats.get('today_downloads', 0)}\n"
+            queue_stats = self.download_service.scheduler.get_stats()
+            message += f"• صف دانلود: {queue_stats['running']}/{queue_stats['workers']} فعال، {queue_stats['pending']} در انتظار، {self.download_service.shared_downloads} دانلود اشتراکی\n"
+            cache_stats = video_metadata_cache.get_stats()
+            message += f"• کش اطلاعات ویدیو: {cache_stats['entries']} مورد، {cache_stats['hit_rate']}% موفق\n"
+            resolver_stats = metadata_resolver.get_stats()
+            clients = '، '.join(
+                f"{c['name']} {c['success_rate']}%" + (f" ({c['p50']:.1f}s)" if c['p50'] is not None else '') + (' ⛔' if c['blocked'] else '')
+                for c in resolver_stats['clients']
+            )
+            message += f"• کلاینت‌های یوتیوب: {clients}، {resolver_stats['hedges']} درخواست موازی\n"
+            accounts = cookie_store.get_stats()['accounts']
+            if len(accounts) > 1:
+                message += f"• حساب‌های یوتیوب: {', '.join(a['name'] + (' ⛔' if a['blocked'] else '') for a in accounts)}\n"
+            file_cache_stats = await self.db.get_file_cache_stats()
+            message += f"• کش فایل تلگرام: {file_cache_stats.get('entries', 0)} فایل، {file_cache_stats.get('hit_rate', 0)}% موفق، {file_cache_stats.get('invalidations', 0)} منقضی\n"
+            admission_stats = self.download_service.admission.get_stats()
+            message += f"• پذیرش درخواست‌ها: {admission_stats['accepted']} پذیرفته، {admission_stats['downgraded']} کاهش کیفیت، {admission_stats['rejected']} رد شده ({FileUtils.format_file_size(admission_stats['throughput'])}/ثانیه)\n"
+            prefetch_stats = self.prefetcher.get_stats()
+            if prefetch_stats['enabled']:
+                message += f"• پیش‌دانلود: {prefetch_stats['started']} شروع، {prefetch_stats['hit_rate']}% حدس درست\n"
+            shaper_stats = bandwidth_shaper.get_stats()
+            if shaper_stats['limit']:
+                message += f"• پهنای باند: سقف {FileUtils.format_file_size(shaper_stats['limit'])}/ثانیه، {shaper_stats['flows']} دانلود فعال ({shaper_stats['small_flows']} کوچک) برای {shaper_stats['users']} کاربر\n"
+            router_stats = self.upload_router.get_stats()
+            if router_stats['enabled']:
+                message += f"• آپلود از طریق userbot: {router_stats['routed']} فایل، {router_stats['fallbacks']} بازگشت به ربات\n"
+            outbox_stats = outbox.get_stats()
+            message += f"• پیام‌های خروجی: {outbox_stats['calls']} ارسال، {outbox_stats['coalesced']} ادغام، {outbox_stats['flood_waits']} FloodWait\n"
+            storage_stats = self.download_service.storage.get_stats()
+            message += f"• فضای موقت: {storage_stats['used'] // (1024 * 1024)}/{storage_stats['budget'] // (1024 * 1024)} مگابایت، {storage_stats['partials']} دانلود نیمه‌کاره\n"
         
         await event.respond(message, parse_mode='md')
     
@@ -258,6 +297,45 @@ class BotHandlers:
         cleaned_files = await self.download_service.cleanup_temp_files()
         await event.respond(f"🧹 {cleaned_files} فایل موقت پاکسازی شد.")
     
+    async def jobs_handler(self, event):
+        """Handle /jobs command (Admin only)"""
+        user = await event.get_sender()
+        if user.id not in ADMIN_IDS:
+            await event.respond('❌ دسترسی مجاز نیست. فقط برای مدیر.')
+            return
+        
+        jobs = self.download_service.list_jobs()
+        if not jobs:
+            await event.respond(MESSAGES['no_jobs'])
+            return
+        
+        message = "📋 **دانلودهای جاری:**\n\n"
+        for job in jobs:
+            status = "🟢 در حال اجرا" if job['state'] == 'running' else "⏳ در صف"
+            users = ', '.join(str(user_id) for user_id in job['users']) or 'پیش‌دانلود'
+            message += f"• `{job['job_id']}` {status}\n"
+            message += f"  └ {self._format_seconds(job['seconds'])} | کاربران: {users}\n\n"
+        message += "برای لغو: `/cancel <job_id>`"
+        
+        await event.respond(message, parse_mode='md')
+    
+    async def cancel_handler(self, event):
+        """Handle /cancel <job_id> command (Admin only)"""
+        user = await event.get_sender()
+        if user.id not in ADMIN_IDS:
+            await event.respond('❌ دسترسی مجاز نیست. فقط برای مدیر.')
+            return
+        
+        parts = event.text.split()
+        if len(parts) != 2:
+            await event.respond('❓ استفاده: `/cancel <job_id>`', parse_mode='md')
+            return
+        
+        if self.download_service.cancel_job(parts[1]):
+            await event.respond(f"🛑 دانلود `{parts[1]}` لغو شد.", parse_mode='md')
+        else:
+            await event.respond(f"❌ دانلودی با شناسه `{parts[1]}` پیدا نشد.", parse_mode='md')
+    
     async def url_handler(self, event):
         """Handle URL messages"""
         # Skip if it's a command
@@ -317,10 +395,11 @@ class BotHandlers:
         if 'http' in event.text.lower():
             await event.respond(MESSAGES['invalid_link'])
     
-    async def get_available_qualities(self, url: str) -> Dict[str, bool]:
+    async def get_available_qualities(self, url: str, info: Optional[Dict[str, Any]] = None) -> Dict[str, bool]:
         """Get available qualities for a YouTube video"""
         try:
-            info = await self.download_service.get_download_info(url)
+            if info is None:
+                info = await self.download_service.get_download_info(url)
             if not info['success']:
                 return {'audio': True}  # At least audio should be available
             
@@ -388,15 +467,12 @@ class BotHandlers:
         loading_msg = await event.respond("🔍 **در حال بررسی کیفیت‌های موجود...**")
         
         try:
-            # Get available qualities with timeout
-            available_qualities = await asyncio.wait_for(
-                self.get_available_qualities(url),
+            # Get video info (qualities and file sizes) with timeout
+            video_info = await asyncio.wait_for(
+                self.download_service.get_download_info(url),
                 timeout=120  # 120 seconds timeout
             )
             
-            # Get video info for file sizes
-            video_info = await self.download_service.get_download_info(url)
-            
             # Check if video info extraction failed
             if not video_info.get('success'):
                 await loading_msg.edit(
@@ -404,6 +480,8 @@ class BotHandlers:
                 )
                 return
             
+            available_qualities = await self.get_available_qualities(url, video_info)
+            
             # Build dynamic buttons - each quality in separate row with file size
             quality_buttons = []
         
@@ -470,6 +548,9 @@ class BotHandlers:
                 parse_mode='md'
             )
             
+            # Start on the likely pick while the user is still reading the keyboard
+            await self.prefetcher.start(user.id, url, available_qualities)
+            
         except asyncio.TimeoutError:
             await loading_msg.edit(
                 "⏰ **زمان انتظار تمام شد!**\n\n"
@@ -563,6 +644,18 @@ class BotHandlers:
             )
             return
         
+        if data.startswith('dlcancel_'):
+            # download_id is "<user_id>_<progress message id>"
+            download_id = data[len('dlcancel_'):]
+            if download_id.split('_')[0] != str(user.id):
+                await event.answer('❌ این دکمه برای شما نیست!', alert=True)
+                return
+            if self.download_service.cancel_download(download_id):
+                await event.answer('🛑 در حال لغو دانلود...')
+            else:
+                await event.answer('این دانلود دیگر در حال اجرا نیست.')
+            return
+        
         # Handle download callbacks
         if data.startswith(('yt_', 'ig_')):
             await self.handle_download_callback(event, data)
@@ -590,6 +683,21 @@ class BotHandlers:
         url = url_data['url']
         platform_full = 'youtube' if platform == 'yt' else 'instagram'
         
+        if platform_full == 'youtube':
+            await self.prefetcher.on_choice(user.id, url, quality)
+        
+        # Resend by Telegram file reference when this exact file was delivered before
+        media_id = extract_video_id(url) if platform_full == 'youtube' else None
+        if media_id:
+            try:
+                # 'hd' and '720p' resolve to the same format and share one cached upload
+                formats = await self.download_service.cache_formats(url, quality)
+            except Exception as e:
+                logger.debug(f"Could not resolve cached formats of {url}: {e}")
+                formats = []
+            if await self.send_cached_file(event, user.id, url, platform_full, media_id, quality, formats):
+                return
+        
         # Check if we have active sessions
         if not self.session_manager.active_sessions:
             await event.respond(MESSAGES['no_sessions'])
@@ -597,68 +705,50 @@ class BotHandlers:
         
         # Start download process
         progress_message = await event.respond(MESSAGES['processing'])
+        download_id = f"{user.id}_{progress_message.id}"
+        cancel_buttons = [[Button.inline('❌ لغو دانلود', f'dlcancel_{download_id}')]]
+        await outbox.edit(progress_message, MESSAGES['processing'], buttons=cancel_buttons)
         
         try:
-            # Get quality format
-            quality_format = QUALITY_OPTIONS[platform_full].get(quality, 'best')
+            # Admission may downgrade the requested quality before the download starts
+            admitted = {'quality': quality}
             
             # Download with progress tracking
             async def progress_callback(progress_data):
-                await self.update_progress(progress_message, progress_data)
+                if progress_data['status'] == 'admitted':
+                    admitted['quality'] = progress_data['quality']
+                await self.update_progress(progress_message, progress_data, buttons=cancel_buttons)
+            
+            # Used by streaming mode, which uploads while downloading and sends the file itself
+            async def deliver(input_file, info):
+                return await self.bot.send_file(
+                    event.chat_id,
+                    input_file,
+                    caption=self._file_caption(
+                        info['title'], info['file_size'], self._quality_label(admitted['quality']), platform_full
+                    ),
+                    attributes=await self._build_attributes(info) + [DocumentAttributeFilename(info['file_name'])],
+                    mime_type=info['mime_type'],
+                    parse_mode='md'
+                )
             
             result = await self.download_service.download_and_upload(
                 url=url,
                 platform=platform_full,
-                quality=quality_format,
-                progress_callback=progress_callback
+                quality=quality,
+                progress_callback=progress_callback,
+                client=self.bot,
+                deliver=deliver,
+                user_id=user.id,
+                download_id=download_id
             )
             
             if result['success']:
                 # Send the file
-                file_path = result['file_path']
+                file_path = result.get('file_path')
                 file_size = result['file_size']
-                
-                # Prepare file attributes
-                attributes = []
-                if result['media_type'] == 'video':
-                    # Get video duration safely
-                    duration = result.get('duration', 0)
-                    if duration is None or duration <= 0:
-                        try:
-                            duration = TimeUtils.get_video_duration(file_path)
-                        except:
-                            duration = 0
-                    
-                    # Get video dimensions safely
-                    width = result.get('width', 0)
-                    height = result.get('height', 0)
-                    if width is None or width <= 0:
-                        width = 640
-                    if height is None or height <= 0:
-                        height = 480
-                    
-                    # Ensure all values are integers
-                    duration = int(duration) if duration and duration > 0 else 0
-                    width = int(width) if width and width > 0 else 640
-                    height = int(height) if height and height > 0 else 480
-                    
-                    attributes.append(DocumentAttributeVideo(
-                        duration=duration,
-                        w=width,
-                        h=height,
-                        supports_streaming=True
-                    ))
-                elif result['media_type'] == 'audio':
-                    duration = result.get('duration', 0)
-                    if duration is None or duration <= 0:
-                        duration = 0
-                    duration = int(duration)
-                    
-                    attributes.append(DocumentAttributeAudio(
-                        duration=duration,
-                        title=result.get('title', ''),
-                        performer=result.get('uploader', '')
-                    ))
+                delivered_quality = result.get('quality', quality)
+                quality_info = self._quality_label(delivered_quality)
                 
                 # Upload using bot client (not userbot session)
                 # Update progress to uploading with progress bar
@@ -674,68 +764,72 @@ class BotHandlers:
                     progress_text += f"📁 **اندازه:** {FileUtils.format_file_size(current)} / {FileUtils.format_file_size(total)}\n\n"
                     progress_text += f"⏳ *در حال ارسال...*"
                     
-                    try:
-                        await progress_message.edit(progress_text, parse_mode='md')
-                    except:
-                        pass
+                    # Coalesced with the previous update if that one has not gone out yet
+                    outbox.edit(progress_message, progress_text, parse_mode='md')
                 
                 try:
-                    # Prepare quality info for caption
-                    quality_info = ""
-                    if quality != 'best':
-                        if quality == 'audio':
-                            quality_info = "🎵 صوتی"
-                        elif quality in ['4k', '1440p', '1080p', 'hd', 'sd', '720p', '480p', '360p', '240p', '144p']:
-                            quality_map = {
-                                '4k': '4K (2160p)',
-                                '1440p': '1440p QHD',
-                                '1080p': '1080p Full HD',
-                                'hd': '720p HD',
-                                'sd': '480p SD',
-                                '720p': '720p HD',
-                                '480p': '480p',
-                                '360p': '360p',
-                                '240p': '240p',
-                                '144p': '144p'
-                            }
-                            quality_info = f"🎥 {quality_map.get(quality, quality)}"
-                        else:
-                            quality_info = f"📹 {quality}"
+                    if result.get('delivered'):
+                        # Already streamed to this chat while downloading
+                        sent_message = result['message']
+                    elif result.get('document'):
+                        # Another user's identical request was streamed; resend its document
+                        sent_message = await self.bot.send_file(
+                            event.chat_id,
+                            result['document'],
+                            caption=self._file_caption(result['title'], file_size, quality_info, platform_full),
+                            parse_mode='md'
+                        )
                     else:
-                        quality_info = "📹 بهترین کیفیت"
-                    
-                    # Send file using the main bot client with progress callback
-                    await self.bot.send_file(
-                        event.chat_id,
-                        file_path,
-                        caption=f"✅ **{result['title']}**\n\n📊 اندازه: {FileUtils.format_file_size(file_size)}\n{quality_info}\n🎬 پلتفرم: {platform_full.title()}\n🚀 دانلود شده توسط ربات",
-                        attributes=attributes,
-                        parse_mode='md',
-                        progress_callback=upload_progress_callback
-                    )
+                        caption = self._file_caption(result['title'], file_size, quality_info, platform_full)
+                        attributes = await self._build_attributes(result)
+                        
+                        # Large files go through a userbot and the storage channel when one is configured
+                        sent_message = await self.upload_router.deliver(
+                            self.bot, event.chat_id, file_path, file_size, caption,
+                            attributes=attributes, progress_callback=upload_progress_callback
+                        )
+                        
+                        if sent_message is None:
+                            # Large files go up over several bot connections before the message is sent
+                            upload = file_path
+                            if file_size >= DOWNLOAD_CONFIG['parallel_upload_min_size']:
+                                upload = await parallel_upload(
+                                    self.bot, file_path, progress_callback=upload_progress_callback
+                                )
+                            
+                            # Send file using the main bot client with progress callback
+                            sent_message = await self.bot.send_file(
+                                event.chat_id,
+                                upload,
+                                caption=caption,
+                                attributes=attributes,
+                                parse_mode='md',
+                                progress_callback=upload_progress_callback
+                            )
                     
                     # Log successful download only after successful send
                     await self.db.log_download(
                         user.id, url, platform_full, result['media_type'],
-                        file_size, 'bot_client', 'success'
+                        file_size, 'bot_client', 'success', quality
                     )
                     
+                    # Remember the uploaded document so the next request is a plain resend
+                    document = getattr(sent_message, 'document', None)
+                    if media_id and document and result.get('format_id'):
+                        await self.db.cache_file(
+                            platform_full, media_id, result['format_id'], document.id, document.access_hash,
+                            document.file_reference, result['media_type'], file_size, result['title']
+                        )
+                    
                     # Show success message
-                    await progress_message.edit(
-                        f"🎉 **ارسال موفقیت‌آمیز!**\n\n"
-                        f"✅ فایل **{result['title'][:50]}{'...' if len(result['title']) > 50 else ''}** با موفقیت ارسال شد.\n\n"
-                        f"📊 **اطلاعات فایل:**\n"
-                        f"• اندازه: {FileUtils.format_file_size(file_size)}\n"
-                        f"• کیفیت: {quality_info.replace('🎥 ', '').replace('🎵 ', '').replace('📹 ', '')}\n"
-                        f"• نوع: {result['media_type'].title()}\n"
-                        f"• پلتفرم: {platform_full.title()}\n\n"
-                        f"💫 *از استفاده از ربات متشکریم!*",
+                    await outbox.edit(progress_message, 
+                        self._success_text(result['title'], file_size, quality_info, result['media_type'], platform_full),
                         parse_mode='md'
                     )
                     
                 except Exception as send_error:
                     logger.error(f"File send error: {send_error}")
-                    await progress_message.edit(f"❌ خطا در ارسال فایل: {str(send_error)}")
+                    await outbox.edit(progress_message, f"❌ خطا در ارسال فایل: {str(send_error)}")
                     
                     # Log failed send
                     await self.db.log_download(
@@ -744,62 +838,173 @@ class BotHandlers:
                     )
                 
                 finally:
-                    # Clean up temporary file after send attempt
-                    try:
-                        import os
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.debug(f"Cleaned up file: {file_path}")
-                            # Also remove parent directory if empty
-                            parent_dir = os.path.dirname(file_path)
-                            if os.path.exists(parent_dir) and not os.listdir(parent_dir):
-                                os.rmdir(parent_dir)
-                                logger.debug(f"Cleaned up directory: {parent_dir}")
-                    except Exception as cleanup_error:
-                        logger.debug(f"Cleanup error: {cleanup_error}")
+                    # The file may be shared with other users' identical requests
+                    if file_path:
+                        self.download_service.release_file(file_path)
+            elif result.get('queue_full'):
+                await outbox.edit(progress_message, 
+                    MESSAGES['queue_full'].format(eta=self._format_seconds(result.get('retry_after', 0))),
+                    parse_mode='md'
+                )
+            elif result.get('rejected'):
+                await outbox.edit(progress_message, self._rejection_text(result), parse_mode='md')
+            elif result.get('cancelled'):
+                await outbox.edit(progress_message, MESSAGES['cancelled'], parse_mode='md')
+                await self.db.log_download(
+                    user.id, url, platform_full, 'unknown', 0, 'none', 'cancelled', quality
+                )
             else:
-                await progress_message.edit(f"❌ Download failed: {result['error']}")
+                await outbox.edit(progress_message, f"❌ Download failed: {result['error']}")
                 
         except Exception as e:
             logger.error(f"Download error for user {user.id}: {e}")
-            await progress_message.edit(MESSAGES['error'])
+            await outbox.edit(progress_message, MESSAGES['error'])
             
             # Log failed download
             await self.db.log_download(
                 user.id, url, platform_full, 'unknown', 0, 'none', 'failed'
             )
     
-    async def update_progress(self, message, progress_data):
-        """Update progress message with detailed information"""
+    async def send_cached_file(
+        self,
+        event,
+        user_id: int,
+        url: str,
+        platform: str,
+        media_id: str,
+        quality: str,
+        formats: List[str]
+    ) -> bool:
+        """Resend a previously uploaded file of one of formats by reference; False means download it normally"""
+        cached = None
+        for format_id in formats:
+            cached = await self.db.get_cached_file(platform, media_id, format_id)
+            if cached:
+                break
+        if not cached:
+            return False
+        
+        quality_info = self._quality_label(quality)
+        document = InputDocument(
+            id=cached['document_id'],
+            access_hash=cached['access_hash'],
+            file_reference=cached['file_reference']
+        )
+        
+        try:
+            await self.bot.send_file(
+                event.chat_id,
+                document,
+                caption=self._file_caption(cached['title'], cached['file_size'], quality_info, platform),
+                parse_mode='md'
+            )
+        except (FileReferenceExpiredError, FileIdInvalidError, MediaEmptyError) as e:
+            logger.warning(f"Cached file for {platform}/{media_id} ({format_id}) is no longer valid: {e}")
+            await self.db.invalidate_cached_file(platform, media_id, format_id)
+            return False
+        except Exception as e:
+            logger.error(f"Error resending cached file for {platform}/{media_id}: {e}")
+            return False
+        
+        await self.db.log_download(
+            user_id, url, platform, cached['media_type'],
+            cached['file_size'], 'file_cache', 'success', quality
+        )
+        await event.respond(
+            self._success_text(cached['title'], cached['file_size'], quality_info, cached['media_type'], platform),
+            parse_mode='md'
+        )
+        return True
+    
+    @staticmethod
+    async def _build_attributes(result: Dict[str, Any]) -> list:
+        """Telegram document attributes for a downloaded video or audio, probed from the file when there is one"""
+        probed = {}
+        if result.get('file_path') and result['media_type'] in ('video', 'audio'):
+            try:
+                probed = await media_prober.probe(result['file_path'])
+            except Exception as e:
+                logger.debug(f"Could not probe {result['file_path']}: {e}")
+        
+        # The file itself is exact; stream metadata is only the fallback
+        duration = int(probed.get('duration') or result.get('duration') or 0)
+        attributes = []
+        if result['media_type'] == 'video':
+            width = int(probed.get('width') or result.get('width') or 0)
+            height = int(probed.get('height') or result.get('height') or 0)
+            attributes.append(DocumentAttributeVideo(
+                duration=duration,
+                w=width or 640,
+                h=height or 480,
+                supports_streaming=True
+            ))
+        elif result['media_type'] == 'audio':
+            attributes.append(DocumentAttributeAudio(
+                duration=duration,
+                title=result.get('title', ''),
+                performer=result.get('uploader', '')
+            ))
+        return attributes
+    
+    @staticmethod
+    def _quality_label(quality: str) -> str:
+        """Human readable quality for captions"""
+        if quality == 'best':
+            return "📹 بهترین کیفیت"
+        if quality == 'audio':
+            return "🎵 صوتی"
+        
+        quality_map = {
+            '4k': '4K (2160p)',
+            '1440p': '1440p QHD',
+            '1080p': '1080p Full HD',
+            'hd': '720p HD',
+            'sd': '480p SD',
+            '720p': '720p HD',
+            '480p': '480p',
+            '360p': '360p',
+            '240p': '240p',
+            '144p': '144p'
+        }
+        if quality in quality_map:
+            return f"🎥 {quality_map[quality]}"
+        return f"📹 {quality}"
+    
+    @staticmethod
+    def _file_caption(title: str, file_size: int, quality_info: str, platform: str) -> str:
+        """Caption attached to a delivered file"""
+        return f"✅ **{title}**\n\n📊 اندازه: {FileUtils.format_file_size(file_size)}\n{quality_info}\n🎬 پلتفرم: {platform.title()}\n🚀 دانلود شده توسط ربات"
+    
+    @staticmethod
+    def _success_text(title: str, file_size: int, quality_info: str, media_type: str, platform: str) -> str:
+        """Final status message after a file was delivered"""
+        return (
+            f"🎉 **ارسال موفقیت‌آمیز!**\n\n"
+            f"✅ فایل **{title[:50]}{'...' if len(title) > 50 else ''}** با موفقیت ارسال شد.\n\n"
+            f"📊 **اطلاعات فایل:**\n"
+            f"• اندازه: {FileUtils.format_file_size(file_size)}\n"
+            f"• کیفیت: {quality_info.replace('🎥 ', '').replace('🎵 ', '').replace('📹 ', '')}\n"
+            f"• نوع: {media_type.title()}\n"
+            f"• پلتفرم: {platform.title()}\n\n"
+            f"💫 *از استفاده از ربات متشکریم!*"
+        )
+    
+    async def update_progress(self, message, progress_data, buttons=None):
+        """Update progress message with detailed information; buttons stay until the upload starts"""
         try:
             if progress_data['status'] == 'downloading':
                 percent = progress_data.get('percent', 0)
-                speed = progress_data.get('speed', 'نامشخص')
-                eta = progress_data.get('eta', 'نامشخص')
+                speed = progress_data.get('speed')
+                eta = progress_data.get('eta')
                 
                 # Create animated progress bar
                 bar_length = 15
                 filled_length = int(bar_length * percent // 100)
                 bar = '🟩' * filled_length + '⬜' * (bar_length - filled_length)
                 
-                # Format speed nicely
-                if speed != 'نامشخص' and speed != 'Unknown':
-                    try:
-                        # Clean up speed string
-                        speed_clean = speed.replace('/s', '/ثانیه').replace('MiB', 'مگابایت').replace('KiB', 'کیلوبایت')
-                    except:
-                        speed_clean = speed
-                else:
-                    speed_clean = 'در حال محاسبه...'
-                
-                # Format ETA nicely
-                if eta != 'نامشخص' and eta != 'Unknown':
-                    try:
-                        eta_clean = eta.replace('s', ' ثانیه').replace('m', ' دقیقه').replace('h', ' ساعت')
-                    except:
-                        eta_clean = eta
-                else:
-                    eta_clean = 'در حال محاسبه...'
+                # Speed and ETA come from the progress bus as bytes/s and seconds
+                speed_clean = f"{FileUtils.format_file_size(int(speed))}/ثانیه" if speed else 'در حال محاسبه...'
+                eta_clean = self._format_seconds(eta) if eta is not None else 'در حال محاسبه...'
                 
                 progress_text = f"📥 **در حال دانلود محتوا...**\n\n"
                 progress_text += f"📊 **پیشرفت:** {percent}%\n"
@@ -808,6 +1013,18 @@ class BotHandlers:
                 progress_text += f"⏰ **زمان باقی‌مانده:** {eta_clean}\n\n"
                 progress_text += f"💡 *لطفاً صبر کنید...*"
                 
+            elif progress_data['status'] == 'queued':
+                progress_text = MESSAGES['queued'].format(
+                    position=progress_data.get('position', 1),
+                    eta=self._format_seconds(progress_data.get('eta', 0))
+                )
+            elif progress_data['status'] == 'admitted':
+                template = MESSAGES['downgraded'] if progress_data.get('downgraded') else MESSAGES['admitted']
+                progress_text = template.format(
+                    quality=self._quality_label(progress_data['quality']),
+                    size=FileUtils.format_file_size(progress_data.get('size', 0)) if progress_data.get('size') else 'نامشخص',
+                    eta=self._format_seconds(progress_data.get('eta', 0))
+                )
             elif progress_data['status'] == 'uploading':
                 progress_text = "📤 **در حال آپلود به تلگرام...**\n\n"
                 progress_text += "🔄 فایل در حال ارسال است...\n"
@@ -822,10 +1039,41 @@ class BotHandlers:
                 progress_text += "🔍 تجزیه و تحلیل لینک...\n\n"
                 progress_text += "⏳ *لطفاً کمی صبر کنید...*"
             
-            await message.edit(progress_text, parse_mode='md')
+            if progress_data['status'] in ('uploading', 'finished'):
+                # Nothing left to cancel once the file is downloaded
+                buttons = None
+            # Not awaited: a download must never wait for its progress message
+            outbox.edit(message, progress_text, parse_mode='md', buttons=buttons)
         except Exception as e:
             logger.debug(f"Progress update error: {e}")
 
+    def _rejection_text(self, result: Dict[str, Any]) -> str:
+        """Explain why admission control turned a request down"""
+        reason = result['reason']
+        if reason == 'too_large':
+            return MESSAGES['too_large'].format(
+                size=FileUtils.format_file_size(result['size']), limit=FileUtils.format_file_size(result['limit'])
+            )
+        if reason == 'too_long':
+            return MESSAGES['too_long'].format(
+                duration=self._format_seconds(result['duration']), limit=self._format_seconds(result['limit'])
+            )
+        return MESSAGES['too_slow'].format(
+            eta=self._format_seconds(result['eta']), limit=self._format_seconds(result['limit'])
+        )
+    
+    @staticmethod
+    def _format_seconds(seconds: int) -> str:
+        """Format a duration in seconds as Persian text"""
+        seconds = int(seconds or 0)
+        if seconds < 60:
+            return f"{max(seconds, 1)} ثانیه"
+        minutes, seconds = divmod(seconds, 60)
+        if minutes < 60:
+            return f"{minutes} دقیقه" + (f" و {seconds} ثانیه" if seconds else "")
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours} ساعت" + (f" و {minutes} دقیقه" if minutes else "")
+
 async def setup_bot_handlers(session_manager: SessionManager) -> TelegramClient:
     """Setup and return configured bot"""
     handlers = BotHandlers(session_manager)
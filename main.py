@@ -11,6 +11,7 @@ from pathlib import Path
 from config import BOT_TOKEN, API_ID, API_HASH
 from handlers.bot_handlers import setup_bot_handlers
 from handlers.admin_handlers import setup_admin_handlers
+from services.download_service import close_http_session
 from services.session_manager import SessionManager
 from utils.database import Database
 from utils.logging_config import BotLogger
@@ -52,6 +53,7 @@ async def main():
         raise
     finally:
         logger.info("🛑 Bot shutting down...")
+        await close_http_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
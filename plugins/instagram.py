@@ -1,23 +1,193 @@
-import os
 import asyncio
+import functools
+import logging
 import re
-import requests
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import aiofiles
+import aiohttp
 from telethon import events, Button
 from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeAudio
 from utils.progress_manager import ProgressManager
 from plugins.constant import TEXT, DATA
-from config import BOT_TOKEN
+from config import BOT_TOKEN, DOWNLOAD_CONFIG
+from services.download_service import VideoMetadataCache
+from services.progress_bus import progress_bus
+from services.storage_manager import storage_manager
+
+# هدرهای مرورگر برای صفحه پست؛ keep-alive و فشرده‌سازی را خود aiohttp مدیریت می‌کند
+PAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+}
+
+# هدرهای دانلود فایل از CDN اینستاگرام
+MEDIA_HEADERS = {
+    'User-Agent': PAGE_HEADERS['User-Agent'],
+    'Referer': 'https://www.instagram.com/',
+}
+
+# حداکثر تعداد رسانه در یک آلبوم تلگرام
+ALBUM_SIZE = 10
+
+logger = logging.getLogger(__name__)
+
+_instagram_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_instagram_session() -> aiohttp.ClientSession:
+    """نشست aiohttp مخصوص اینستاگرام
+
+    کوکی‌ها فقط همراه هر درخواست و از حساب همان درخواست فرستاده می‌شوند؛ DummyCookieJar
+    کوکی‌های Set-Cookie را نگه نمی‌دارد تا sessionid یک حساب به درخواست ناشناس یا حساب دیگر نرسد.
+    """
+    global _instagram_session
+    if _instagram_session is None or _instagram_session.closed:
+        _instagram_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=DOWNLOAD_CONFIG['http_pool_size'], ttl_dns_cache=300),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=aiohttp.ClientTimeout(total=None, connect=15, sock_read=30)
+        )
+    return _instagram_session
+
+
+class InstagramAccount:
+    """یک نشست اینستاگرام (یا IP خود ربات بدون ورود) با بودجه درخواست جداگانه"""
+    
+    def __init__(self, username: Optional[str] = None, password: Optional[str] = None):
+        self.username = username
+        self.password = password
+        self.cookies: Optional[Dict[str, str]] = None if username else {}
+        # زمان درخواست‌های یک دقیقه اخیر
+        self.requests: Deque[float] = deque()
+        self.cooldown_until = 0.0
+        self.rate_limited = 0
+    
+    @property
+    def name(self) -> str:
+        return self.username or 'anonymous'
+    
+    def budget_left(self, now: float) -> int:
+        """تعداد درخواست مجاز باقی‌مانده در پنجره یک دقیقه‌ای"""
+        while self.requests and now - self.requests[0] >= 60:
+            self.requests.popleft()
+        return DOWNLOAD_CONFIG['instagram_requests_per_minute'] - len(self.requests)
+
+
+class InstagramAccountPool:
+    """چرخش درخواست‌های اینستاگرام بین حساب‌های جدول insta_acc
+
+    هر حساب سقف درخواست در دقیقه دارد و پس از پاسخ 429 مدتی کنار گذاشته می‌شود.
+    درخواست‌ها همه از نشست مشترک aiohttp می‌روند و فقط کوکی‌های حساب فرق می‌کند.
+    """
+    
+    def __init__(self):
+        self.accounts: List[InstagramAccount] = []
+        self._loaded = False
+        self._login_lock = asyncio.Lock()
+    
+    def _load(self):
+        """خواندن حساب‌ها از دیتابیس افزونه؛ بدون دیتابیس فقط درخواست بدون ورود انجام می‌شود"""
+        self._loaded = True
+        records = []
+        try:
+            from plugins.db_wrapper import DB
+            records = DB().get_insta_acc() or []
+        except Exception as e:
+            logger.warning(f"Instagram accounts not available, using anonymous requests only: {e}")
+        self.accounts = [InstagramAccount(username, password) for username, password in records]
+        # IP خود ربات هم یک عضو استخر با بودجه جداگانه است
+        self.accounts.append(InstagramAccount())
+        logger.info(f"Instagram pool: {len(self.accounts) - 1} accounts")
+    
+    async def acquire(self) -> InstagramAccount:
+        """حسابی که بودجه دارد و در استراحت نیست؛ در غیر این صورت تا آزاد شدن اولین حساب صبر می‌کند"""
+        if not self._loaded:
+            self._load()
+        
+        while True:
+            now = time.monotonic()
+            ready = [a for a in self.accounts if a.cooldown_until <= now and a.budget_left(now) > 0]
+            if ready:
+                # بیشترین بودجه باقی‌مانده، تا بار بین حساب‌ها پخش شود
+                account = max(ready, key=lambda a: a.budget_left(now))
+                if account.cookies is None and not await self._login(account):
+                    continue
+                account.requests.append(time.monotonic())
+                return account
+            
+            # زودترین زمانی که یکی از حساب‌ها دوباره قابل استفاده می‌شود
+            wake_at = min(
+                max(a.cooldown_until, a.requests[0] + 60 if a.budget_left(now) <= 0 else now)
+                for a in self.accounts
+            )
+            await asyncio.sleep(max(0.1, wake_at - now))
+    
+    async def _login(self, account: InstagramAccount) -> bool:
+        """ورود با instaloader در نخ جدا و نگه‌داشتن کوکی‌های نشست در حافظه"""
+        async with self._login_lock:
+            if account.cookies is not None:
+                return True
+            try:
+                account.cookies = await asyncio.get_running_loop().run_in_executor(
+                    None, self._login_blocking, account.username, account.password
+                )
+                logger.info(f"Logged in to Instagram as {account.username}")
+                return True
+            except Exception as e:
+                logger.warning(f"Instagram login failed for {account.username}: {e}")
+                account.cooldown_until = time.monotonic() + DOWNLOAD_CONFIG['instagram_cooldown']
+                return False
+    
+    @staticmethod
+    def _login_blocking(username: str, password: str) -> Dict[str, str]:
+        import instaloader
+        loader = instaloader.Instaloader(quiet=True)
+        loader.login(username, password)
+        return loader.save_session()
+    
+    def report(self, account: InstagramAccount, status: int):
+        """ثبت نتیجه درخواست: 429 یعنی استراحت، 401/403 یعنی نشست باید دوباره ساخته شود"""
+        if status == 429:
+            account.rate_limited += 1
+            account.cooldown_until = time.monotonic() + DOWNLOAD_CONFIG['instagram_cooldown']
+            logger.warning(f"Instagram rate-limited {account.name}, resting it")
+        elif status in (401, 403) and account.username:
+            account.cookies = None
+            account.cooldown_until = time.monotonic() + DOWNLOAD_CONFIG['instagram_cooldown']
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """آمار استفاده از حساب‌ها"""
+        now = time.monotonic()
+        return {
+            'accounts': [
+                {
+                    'name': account.name,
+                    'budget_left': account.budget_left(now),
+                    'rate_limited': account.rate_limited,
+                    'cooling_down': account.cooldown_until > now
+                }
+                for account in self.accounts
+            ]
+        }
+
+
+# اطلاعات پست بر اساس shortcode؛ لینک‌های CDN امضا‌شده هستند و چند ساعت بعد منقضی می‌شوند
+instagram_post_cache = VideoMetadataCache(
+    DOWNLOAD_CONFIG['instagram_cache_size'],
+    DOWNLOAD_CONFIG['instagram_cache_ttl']
+)
+
+instagram_pool = InstagramAccountPool()
 
 class InstagramDownloader:
     """کلاس دانلود از اینستاگرام با Telethon"""
     
     def __init__(self, client):
         self.client = client
-        self.downloads_path = "downloads"
-        
-        # ایجاد پوشه دانلود
-        if not os.path.exists(self.downloads_path):
-            os.makedirs(self.downloads_path)
     
     def extract_shortcode(self, url: str) -> str:
         """استخراج shortcode از URL اینستاگرام"""
@@ -35,32 +205,54 @@ class InstagramDownloader:
         raise Exception("لینک اینستاگرام معتبر نیست")
     
     async def get_post_info(self, url: str) -> dict:
-        """دریافت اطلاعات پست اینستاگرام"""
+        """دریافت اطلاعات پست اینستاگرام (از کش، و فقط یک درخواست برای درخواست‌های همزمان یک پست)"""
         try:
             shortcode = self.extract_shortcode(url)
+            return await instagram_post_cache.get_or_fetch(
+                shortcode, functools.partial(self._fetch_post_info, shortcode)
+            )
+        except Exception as e:
+            raise Exception(f"خطا در پردازش لینک: {str(e)}")
+    
+    async def _fetch_post_info(self, shortcode: str) -> dict:
+        """دریافت اطلاعات پست با حسابی از استخر؛ در صورت 429 حساب بعدی امتحان می‌شود"""
+        # استفاده از API عمومی اینستاگرام
+        api_url = f"https://www.instagram.com/p/{shortcode}/?__a=1&__d=dis"
+        
+        for attempt in range(DOWNLOAD_CONFIG['instagram_attempts']):
+            account = await instagram_pool.acquire()
             
-            # استفاده از API عمومی اینستاگرام
-            api_url = f"https://www.instagram.com/p/{shortcode}/?__a=1&__d=dis"
-            
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-            }
+            # اتصال‌ها و DNS بین درخواست‌ها استفاده مجدد می‌شوند، ولی کوکی‌ها فقط از همین حساب هستند
+            async with get_instagram_session().get(
+                api_url, headers=PAGE_HEADERS, cookies=account.cookies, timeout=aiohttp.ClientTimeout(total=10)
+            ) as response:
+                status = response.status
+                data = await response.json(content_type=None) if status == 200 else None
             
-            response = requests.get(api_url, headers=headers, timeout=10)
+            if status in (401, 403, 429):
+                instagram_pool.report(account, status)
+                continue
             
-            if response.status_code == 200:
-                data = response.json()
-                
+            if status == 200:
                 # استخراج اطلاعات پست
                 media = data.get('graphql', {}).get('shortcode_media', {})
                 
                 if not media:
                     raise Exception("اطلاعات پست یافت نشد")
                 
+                # پست چندتایی (sidecar): هر اسلاید یک node جدا با لینک‌های خودش دارد
+                children = media.get('edge_sidecar_to_children', {}).get('edges', [])
+                nodes = [edge.get('node', {}) for edge in children] or [media]
+                items = [
+                    {
+                        'is_video': node.get('is_video', False),
+                        'display_url': node.get('display_url', ''),
+                        'video_url': node.get('video_url', ''),
+                        'dimensions': node.get('dimensions', {}),
+                    }
+                    for node in nodes
+                ]
+                
                 return {
                     'shortcode': shortcode,
                     'caption': media.get('edge_media_to_caption', {}).get('edges', [{}])[0].get('node', {}).get('text', ''),
@@ -71,23 +263,32 @@ class InstagramDownloader:
                     'dimensions': media.get('dimensions', {}),
                     'like_count': media.get('edge_media_preview_like', {}).get('count', 0),
                     'comment_count': media.get('edge_media_to_comment', {}).get('count', 0),
+                    'items': items,
+                    'is_album': len(items) > 1,
+                    # برای انقضای کش
+                    'fetched_at': time.monotonic(),
                 }
             else:
-                raise Exception(f"خطا در دریافت اطلاعات: {response.status_code}")
-                
-        except Exception as e:
-            raise Exception(f"خطا در پردازش لینک: {str(e)}")
+                raise Exception(f"خطا در دریافت اطلاعات: {status}")
+        
+        raise Exception("همه حساب‌های اینستاگرام محدود شده‌اند، لطفاً بعداً تلاش کنید")
     
     def create_download_keyboard(self, post_info: dict, url: str) -> list:
         """ایجاد کیبورد دانلود"""
         buttons = []
+        # shortcode خود پست در داده دکمه است؛ جدولی لازم نیست که پر شود یا دو پست در آن تداخل کنند
+        key = post_info['shortcode']
+        
+        if post_info['is_album']:
+            # دکمه دانلود همه اسلایدها به صورت یک آلبوم
+            buttons.append([Button.inline(f"🗂 دانلود آلبوم ({len(post_info['items'])} مورد)", f"ig_album_{key}")])
         
         if post_info['is_video']:
             # دکمه دانلود ویدیو
-            buttons.append([Button.inline("🎥 دانلود ویدیو", f"ig_video_{hash(url) % 10000}")])
+            buttons.append([Button.inline("🎥 دانلود ویدیو", f"ig_video_{key}")])
         
         # دکمه دانلود تصویر (همیشه موجود)
-        buttons.append([Button.inline("🖼 دانلود تصویر", f"ig_image_{hash(url) % 10000}")])
+        buttons.append([Button.inline("🖼 دانلود تصویر", f"ig_image_{key}")])
         
         # دکمه لغو
         buttons.append([Button.inline("❌ لغو", "cancel")])
@@ -95,7 +296,10 @@ class InstagramDownloader:
         return buttons
     
     async def download_media(self, url: str, media_type: str, progress_manager: ProgressManager) -> str:
-        """دانلود رسانه از اینستاگرام"""
+        """دانلود رسانه از اینستاگرام
+
+        فایل در فضای موقت مشترک ذخیره می‌شود؛ پس از ارسال باید با storage_manager.release آزاد شود.
+        """
         try:
             post_info = await self.get_post_info(url)
             
@@ -115,41 +319,130 @@ class InstagramDownloader:
             
             # نام فایل
             filename = f"instagram_{post_info['shortcode']}.{file_ext}"
-            file_path = os.path.join(self.downloads_path, filename)
             
-            # دانلود فایل
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Referer': 'https://www.instagram.com/',
-            }
+            # پیشرفت مثل یوتیوب از progress bus و با فاصله زمانی به progress manager می‌رسد
+            job_id = f"instagram_{post_info['shortcode']}_{id(progress_manager)}"
             
-            response = requests.get(download_url, headers=headers, stream=True, timeout=30)
-            response.raise_for_status()
+            async def on_progress(event):
+                await progress_manager.update_progress(event['downloaded'], event['total'], "دانلود در حال انجام")
             
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded_size = 0
+            def on_chunk(downloaded: int, total: int):
+                if total > 0:
+                    progress_bus.report(job_id, downloaded, total)
             
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
-                        
-                        # به‌روزرسانی پیشرفت
-                        if total_size > 0:
-                            await progress_manager.update_progress(
-                                downloaded_size, 
-                                total_size, 
-                                "دانلود در حال انجام"
-                            )
+            progress_bus.subscribe(job_id, on_progress)
+            try:
+                file_path = await self._fetch_file(download_url, filename, on_chunk)
+            finally:
+                await progress_bus.close(job_id)
             
             # تکمیل دانلود
-            await progress_manager.complete_progress(filename, downloaded_size)
+            await progress_manager.complete_progress(filename, file_path.stat().st_size)
             
-            return file_path
+            return str(file_path)
             
         except Exception as e:
             raise Exception(f"خطا در دانلود: {str(e)}")
+    
+    async def download_album(self, url: str, progress_manager: ProgressManager) -> List[str]:
+        """دانلود همزمان همه اسلایدهای یک پست با سقف همزمانی برای هر پست
+
+        فایل‌ها در فضای موقت مشترک هستند و پس از ارسال باید با storage_manager.release آزاد شوند.
+        """
+        try:
+            post_info = await self.get_post_info(url)
+            shortcode = post_info['shortcode']
+            job_id = f"instagram_{shortcode}_{id(progress_manager)}"
+            
+            async def on_progress(event):
+                await progress_manager.update_progress(event['downloaded'], event['total'], "دانلود آلبوم در حال انجام")
+            
+            # پیشرفت کل آلبوم: مجموع بایت‌های همه اسلایدها (حجم کل با شروع هر اسلاید کامل‌تر می‌شود)
+            progress: Dict[int, Tuple[int, int]] = {}
+            
+            def on_chunk(index: int, downloaded: int, total: int):
+                progress[index] = (downloaded, total)
+                progress_bus.report(
+                    job_id, sum(done for done, _ in progress.values()), sum(size for _, size in progress.values())
+                )
+            
+            semaphore = asyncio.Semaphore(DOWNLOAD_CONFIG['instagram_album_concurrency'])
+            
+            async def fetch(index: int, item: dict) -> Path:
+                download_url = item['video_url'] if item['is_video'] else item['display_url']
+                if not download_url:
+                    raise Exception(f"لینک دانلود اسلاید {index + 1} یافت نشد")
+                filename = f"instagram_{shortcode}_{index + 1}.{'mp4' if item['is_video'] else 'jpg'}"
+                async with semaphore:
+                    return await self._fetch_file(download_url, filename, functools.partial(on_chunk, index))
+            
+            tasks = [asyncio.create_task(fetch(index, item)) for index, item in enumerate(post_info['items'])]
+            progress_bus.subscribe(job_id, on_progress)
+            try:
+                file_paths = await asyncio.gather(*tasks)
+            except BaseException:
+                # یک اسلاید خراب یعنی آلبوم ناقص؛ بقیه متوقف و فایل‌های آماده آزاد می‌شوند
+                for task in tasks:
+                    task.cancel()
+                for result in await asyncio.gather(*tasks, return_exceptions=True):
+                    if isinstance(result, Path):
+                        storage_manager.release(str(result))
+                raise
+            finally:
+                await progress_bus.close(job_id)
+            
+            total_size = sum(path.stat().st_size for path in file_paths)
+            await progress_manager.complete_progress(f"{len(file_paths)} فایل از @{post_info['owner']}", total_size)
+            
+            return [str(path) for path in file_paths]
+            
+        except Exception as e:
+            raise Exception(f"خطا در دانلود آلبوم: {str(e)}")
+    
+    async def _fetch_file(self, download_url: str, filename: str, on_chunk: Callable[[int, int], None]) -> Path:
+        """دانلود یک فایل در فضای موقت؛ on_chunk(دریافت‌شده، حجم کل) پس از هر قطعه صدا زده می‌شود"""
+        reservation = None
+        try:
+            async with get_instagram_session().get(download_url, headers=MEDIA_HEADERS) as response:
+                response.raise_for_status()
+                total_size = response.content_length or 0
+                ceiling = DOWNLOAD_CONFIG['instagram_max_file_size']
+                if total_size > ceiling:
+                    raise Exception("حجم فایل از سقف مجاز بیشتر است")
+                
+                # رزرو فضا در بودجه دیسک موقت پیش از نوشتن فایل؛ برای پاسخ chunked حجم نامعلوم است و سقف رزرو می‌شود
+                reservation = await storage_manager.reserve(total_size or ceiling)
+                file_path = reservation.path / filename
+                
+                downloaded_size = 0
+                async with aiofiles.open(file_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CONFIG['http_chunk_size']):
+                        downloaded_size += len(chunk)
+                        if downloaded_size > ceiling:
+                            raise Exception("حجم فایل از سقف مجاز بیشتر است")
+                        if downloaded_size > reservation.size:
+                            # Content-Length اندازه بدنه فشرده است و فایل باز‌شده بزرگ‌تر شده؛ رزرو دو برابر می‌شود
+                            await storage_manager.grow(reservation, min(ceiling, max(downloaded_size, reservation.size * 2)) - reservation.size)
+                        await f.write(chunk)
+                        on_chunk(downloaded_size, total_size)
+            
+            storage_manager.commit(reservation, file_path)
+            return file_path
+        except BaseException:
+            if reservation:
+                storage_manager.discard(reservation)
+            raise
+    
+    async def send_album(self, chat_id, file_paths: List[str], caption: str = ''):
+        """ارسال فایل‌ها به صورت آلبوم؛ تلگرام هر آلبوم را به ۱۰ رسانه محدود می‌کند"""
+        for start in range(0, len(file_paths), ALBUM_SIZE):
+            files = file_paths[start:start + ALBUM_SIZE]
+            await self.client.send_file(
+                chat_id,
+                files if len(files) > 1 else files[0],
+                caption=caption if start == 0 else '',
+                parse_mode='md'
+            )
 
 # نمونه سراسری
 instagram_downloader = None
@@ -239,40 +532,47 @@ async def handle_instagram_callback(event):
         return
     
     try:
-        # پارس کردن داده‌ها
-        parts = data.split('_')
+        # پارس کردن داده‌ها؛ shortcode خودش ممکن است '_' داشته باشد
+        parts = data.split('_', 2)
         if len(parts) < 3:
             await event.answer("❌ داده نامعتبر", alert=True)
             return
         
-        media_type = parts[1]  # video یا image
+        media_type = parts[1]  # video، image یا album
         
-        if media_type not in ['video', 'image']:
+        if media_type not in ['video', 'image', 'album']:
             await event.answer("❌ نوع رسانه نامعتبر", alert=True)
             return
         
+        # لینک پست از shortcode داخل دکمه ساخته می‌شود؛ پست‌های /reel/ هم با همین آدرس باز می‌شوند
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', parts[2]):
+            await event.answer("❌ داده نامعتبر", alert=True)
+            return
+        url = f"https://www.instagram.com/p/{parts[2]}/"
+        
         # شروع دانلود
         progress_manager = ProgressManager(event, event.client)
         
         if media_type == 'video':
             await progress_manager.start_progress("دانلود ویدیو اینستاگرام")
+        elif media_type == 'album':
+            await progress_manager.start_progress("دانلود آلبوم اینستاگرام")
         else:
             await progress_manager.start_progress("دانلود تصویر اینستاگرام")
         
-        # استخراج URL از پیام اصلی
-        # نکته: برای دریافت URL اصلی، باید از روش‌های دیگری استفاده کرد
-        # اینجا فقط نمونه‌ای از کد است
-        
         await event.answer("✅ دانلود شروع شد", alert=False)
         
-        # شبیه‌سازی دانلود
-        await asyncio.sleep(2)
+        if media_type == 'album':
+            # همه اسلایدها موازی دانلود و در یک آلبوم ارسال می‌شوند
+            file_paths = await instagram_downloader.download_album(url, progress_manager)
+        else:
+            file_paths = [await instagram_downloader.download_media(url, media_type, progress_manager)]
         
-        # نمایش تکمیل
-        await progress_manager.complete_progress(
-            f"instagram_file.{'mp4' if media_type == 'video' else 'jpg'}",
-            1024 * 1024  # 1MB
-        )
+        try:
+            await instagram_downloader.send_album(event.chat_id, file_paths, "📥 دانلود شده از اینستاگرام")
+        finally:
+            for file_path in file_paths:
+                storage_manager.release(file_path)
         
     except Exception as e:
         await event.answer(f"❌ خطا: {str(e)}", alert=True)
@@ -7,6 +7,8 @@ from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeAudio
 from utils.progress_manager import ProgressManager, TelethonProgressHook
 from plugins.constant import TEXT, DATA
 from config import BOT_TOKEN
+from services.download_service import run_pytube, fetch_video_metadata
+from services.progress_bus import progress_bus
 
 class YouTubeDownloader:
     """کلاس دانلود از یوتیوب با Telethon"""
@@ -22,60 +24,68 @@ class YouTubeDownloader:
     async def get_video_info(self, url: str) -> dict:
         """دریافت اطلاعات ویدیو با pytube"""
         try:
-            # ایجاد شیء YouTube با کلاینت WEB
-            yt = YouTube(url, use_po_token=True, cookies='cookies.txt')
-            
-            # استخراج فرمت‌های موجود
-            formats = []
-            for stream in yt.streams.filter(progressive=True, file_extension='mp4'):
+            # اطلاعات از کش مشترک خوانده می‌شود و فقط در صورت نبود، از یوتیوب دریافت می‌شود
+            metadata = await fetch_video_metadata(url)
+            return self._collect_video_info(metadata)
+                
+        except Exception as e:
+            raise Exception(f"خطا در pytube: {str(e)}")
+        except Exception as e:
+            raise Exception(f"خطا در دریافت اطلاعات: {str(e)}")
+    
+    @staticmethod
+    def _collect_video_info(metadata: dict) -> dict:
+        """استخراج اطلاعات و فرمت‌ها از اطلاعات کش‌شده ویدیو"""
+        streams = metadata['streams']
+        
+        # استخراج فرمت‌های موجود
+        formats = []
+        for stream in streams:
+            if stream['is_progressive'] and stream['mime_type'] == 'video/mp4':
                 formats.append({
-                    'format_id': str(stream.itag),
-                    'ext': stream.mime_type.split('/')[-1],
-                    'height': int(stream.resolution.replace('p', '')) if stream.resolution else None,
-                    'filesize': stream.filesize,
-                    'fps': stream.fps,
+                    'format_id': str(stream['itag']),
+                    'ext': stream['mime_type'].split('/')[-1],
+                    'height': stream['height'] or None,
+                    'filesize': stream['filesize'],
+                    'fps': stream['fps'],
                     'vcodec': 'h264',
                     'acodec': 'aac'
                 })
-            
-            # اضافه کردن فرمت‌های adaptive (کیفیت بالا)
-            for stream in yt.streams.filter(adaptive=True, file_extension='mp4'):
-                if stream.video_codec:  # فقط ویدیو
-                    formats.append({
-                        'format_id': str(stream.itag),
-                        'ext': stream.mime_type.split('/')[-1],
-                        'height': int(stream.resolution.replace('p', '')) if stream.resolution else None,
-                        'filesize': stream.filesize,
-                        'fps': stream.fps,
-                        'vcodec': stream.video_codec,
-                        'acodec': 'none'
-                    })
-            
-            # اضافه کردن فرمت‌های صوتی
-            for stream in yt.streams.filter(only_audio=True):
+        
+        # اضافه کردن فرمت‌های adaptive (کیفیت بالا)
+        for stream in streams:
+            if not stream['is_progressive'] and stream['mime_type'] == 'video/mp4' and stream['video_codec']:  # فقط ویدیو
+                formats.append({
+                    'format_id': str(stream['itag']),
+                    'ext': stream['mime_type'].split('/')[-1],
+                    'height': stream['height'] or None,
+                    'filesize': stream['filesize'],
+                    'fps': stream['fps'],
+                    'vcodec': stream['video_codec'],
+                    'acodec': 'none'
+                })
+        
+        # اضافه کردن فرمت‌های صوتی
+        for stream in streams:
+            if stream['type'] == 'audio':
                 formats.append({
-                    'format_id': str(stream.itag),
-                    'ext': stream.mime_type.split('/')[-1],
+                    'format_id': str(stream['itag']),
+                    'ext': stream['mime_type'].split('/')[-1],
                     'height': None,
-                    'filesize': stream.filesize,
-                    'abr': stream.abr,
+                    'filesize': stream['filesize'],
+                    'abr': stream['abr'],
                     'vcodec': 'none',
-                    'acodec': stream.audio_codec
+                    'acodec': stream['audio_codec']
                 })
-            
-            return {
-                'title': yt.title,
-                'duration': yt.length,
-                'view_count': yt.views,
-                'uploader': yt.author,
-                'thumbnail': yt.thumbnail_url,
-                'formats': formats
-            }
-                
-        except Exception as e:
-            raise Exception(f"خطا در pytube: {str(e)}")
-        except Exception as e:
-            raise Exception(f"خطا در دریافت اطلاعات: {str(e)}")
+        
+        return {
+            'title': metadata['title'],
+            'duration': metadata['length'],
+            'view_count': metadata['views'],
+            'uploader': metadata['author'],
+            'thumbnail': metadata['thumbnail'],
+            'formats': formats
+        }
     
     def create_quality_keyboard(self, video_info: dict, url: str) -> list:
         """ایجاد کیبورد انتخاب کیفیت"""
@@ -143,45 +153,30 @@ class YouTubeDownloader:
         """دانلود ویدیو یا صوت با pytube"""
         
         try:
-            # ایجاد شیء YouTube با کلاینت WEB
-            yt = YouTube(url, use_po_token=True, cookies='cookies.txt')
+            # استفاده از شیء YouTube کش‌شده به جای دریافت دوباره صفحه ویدیو
+            metadata = await fetch_video_metadata(url)
+            yt = metadata['yt']
             
             # انتخاب stream بر اساس نوع دانلود
-            if audio_only:
-                stream = yt.streams.filter(only_audio=True).first()
-                if not stream:
-                    raise Exception("هیچ stream صوتی پیدا نشد")
-            else:
-                # پیدا کردن stream بر اساس format_id (itag)
-                try:
-                    itag = int(format_id)
-                    stream = yt.streams.get_by_itag(itag)
-                except (ValueError, TypeError):
-                    # اگر format_id معتبر نیست، بهترین کیفیت را انتخاب کن
-                    stream = yt.streams.get_highest_resolution()
-                
-                if not stream:
-                    stream = yt.streams.get_highest_resolution()
-                    if not stream:
-                        raise Exception("هیچ stream ویدیویی پیدا نشد")
+            stream = await run_pytube('streams', self._select_stream, yt, format_id, audio_only)
             
-            # تنظیم progress callback
-            def progress_callback(stream, chunk, bytes_remaining):
-                total_size = stream.filesize
-                bytes_downloaded = total_size - bytes_remaining
-                percent = (bytes_downloaded / total_size) * 100
-                
-                # ارسال پیشرفت به progress manager
-                if hasattr(progress_manager, 'update_progress'):
-                    asyncio.create_task(progress_manager.update_progress(percent))
+            # پیشرفت از نخ دانلود به صورت thread-safe به progress bus می‌رود و با فاصله به progress manager می‌رسد
+            job_id = f"plugin_{id(progress_manager)}"
             
-            # تنظیم callback
-            yt.register_on_progress_callback(progress_callback)
+            async def on_progress(event):
+                if hasattr(progress_manager, 'update_progress'):
+                    await progress_manager.update_progress(event['downloaded'], event['total'])
             
-            # دانلود فایل
-            file_path = await asyncio.get_event_loop().run_in_executor(
-                None, stream.download, self.downloads_path
-            )
+            progress_bus.subscribe(job_id, on_progress)
+            try:
+                # دانلود فایل (پیشرفت فقط به callback همین دانلود ارسال می‌شود)
+                file_path = await run_pytube(
+                    'download', metadata['progress_router'].download, stream,
+                    progress_bus.pytube_listener(job_id, stream.filesize),
+                    output_path=self.downloads_path
+                )
+            finally:
+                await progress_bus.close(job_id)
             
             if not os.path.exists(file_path):
                 raise Exception("فایل دانلود شده پیدا نشد")
@@ -192,6 +187,29 @@ class YouTubeDownloader:
             raise Exception(f"خطا در pytube: {str(e)}")
         except Exception as e:
             raise Exception(f"خطا در دانلود: {str(e)}")
+    
+    @staticmethod
+    def _select_stream(yt: YouTube, format_id: str, audio_only: bool):
+        """انتخاب stream بر اساس نوع دانلود (بلاک‌کننده)"""
+        if audio_only:
+            stream = yt.streams.filter(only_audio=True).first()
+            if not stream:
+                raise Exception("هیچ stream صوتی پیدا نشد")
+            return stream
+        
+        # پیدا کردن stream بر اساس format_id (itag)
+        try:
+            itag = int(format_id)
+            stream = yt.streams.get_by_itag(itag)
+        except (ValueError, TypeError):
+            # اگر format_id معتبر نیست، بهترین کیفیت را انتخاب کن
+            stream = yt.streams.get_highest_resolution()
+        
+        if not stream:
+            stream = yt.streams.get_highest_resolution()
+            if not stream:
+                raise Exception("هیچ stream ویدیویی پیدا نشد")
+        return stream
 
 # نمونه سراسری
 youtube_downloader = None
@@ -0,0 +1,206 @@
+import contextlib
+import http.cookiejar
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from config import DOWNLOAD_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class YouTubeAccount:
+    """One YouTube identity: a Netscape cookie file plus its optional visitorData/po_token pair"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.name = path.stem
+        self.jar: Optional[http.cookiejar.MozillaCookieJar] = None
+        self.mtime: Optional[float] = None
+        self.visitor_data: Optional[str] = None
+        self.po_token: Optional[str] = None
+        self.uses = 0
+        self.failures = 0
+        self.last_used = 0.0
+        self.blocked_until = 0.0
+
+    def refresh(self):
+        """Re-parse the cookie file if it changed on disk since the last load"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            if self.jar is not None:
+                logger.info(f"Cookie file {self.path} removed, account {self.name} is now anonymous")
+            self.jar, self.mtime = None, None
+            return
+
+        if mtime == self.mtime:
+            return
+        jar = http.cookiejar.MozillaCookieJar(str(self.path))
+        try:
+            jar.load(ignore_discard=True, ignore_expires=True)
+        except (OSError, http.cookiejar.LoadError) as e:
+            # Keep the previous jar; the file may be half-written by an extraction flow
+            logger.warning(f"Could not load cookie file {self.path}: {e}")
+            return
+        for cookie in jar:
+            if cookie.expires == 0:
+                # Browser exports write session cookies with expiry 0, which the jar would purge
+                cookie.expires = None
+        self.jar, self.mtime = jar, mtime
+        logger.info(f"Loaded {len(jar)} cookies for YouTube account {self.name}")
+
+    def po_token_verifier(self) -> Tuple[str, str]:
+        """pytubefix po_token_verifier answering from memory instead of stdin"""
+        return self.visitor_data, self.po_token
+
+
+class _AccountCookieProcessor(urllib.request.HTTPCookieProcessor):
+    """Sends the cookies of the account checked out by the current thread with every urllib request"""
+
+    def __init__(self, store: 'CookieStore'):
+        super().__init__(http.cookiejar.CookieJar())
+        self.store = store
+
+    def http_request(self, request):
+        account = self.store.current()
+        if account is not None and account.jar is not None:
+            account.jar.add_cookie_header(request)
+        return request
+
+    def http_response(self, request, response):
+        account = self.store.current()
+        if account is not None and account.jar is not None:
+            # Rotated session cookies stay in memory only; the file belongs to the admin flows
+            account.jar.extract_cookies(response, request)
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+class CookieStore:
+    """Parsed YouTube cookies and po_tokens shared by every pytubefix call
+
+    pytubefix talks to YouTube through urllib, so an opener installed once attaches the cookies
+    of whichever account the calling thread checked out. Files are parsed again only when
+    their mtime changes; requests rotate over the accounts, skipping ones that were bot-checked.
+    """
+
+    def __init__(self, cookie_files: List[str], po_token_file: str):
+        self.accounts = [YouTubeAccount(Path(path)) for path in cookie_files]
+        self.po_token_file = Path(po_token_file)
+        self._po_token_mtime: Optional[float] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._installed = False
+
+    def start(self):
+        """Load every account and route urllib through the cookie processor"""
+        if self._installed:
+            return
+        self._installed = True
+        self.refresh()
+        urllib.request.install_opener(urllib.request.build_opener(_AccountCookieProcessor(self)))
+
+    def refresh(self):
+        """Reload cookie and token files that changed on disk"""
+        for account in self.accounts:
+            account.refresh()
+        self._refresh_po_tokens()
+
+    def _refresh_po_tokens(self):
+        """Reload {account name: {'visitor_data', 'po_token'}} if the token file changed"""
+        try:
+            mtime = os.stat(self.po_token_file).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._po_token_mtime:
+            return
+
+        tokens: Dict[str, Dict[str, str]] = {}
+        if mtime is not None:
+            try:
+                with open(self.po_token_file) as f:
+                    tokens = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not load po_token file {self.po_token_file}: {e}")
+                return
+        self._po_token_mtime = mtime
+        for account in self.accounts:
+            entry = tokens.get(account.name) or {}
+            account.visitor_data = entry.get('visitor_data')
+            account.po_token = entry.get('po_token')
+
+    def checkout(self) -> Optional[YouTubeAccount]:
+        """Pick the least recently used account that is not cooling down after a bot check"""
+        if not self.accounts:
+            return None
+        self.refresh()
+        now = time.monotonic()
+        with self._lock:
+            account = min(self.accounts, key=lambda a: (a.blocked_until > now, a.last_used))
+            account.last_used = now
+            account.uses += 1
+        return account
+
+    def current(self) -> Optional[YouTubeAccount]:
+        """The account checked out by the calling thread"""
+        return getattr(self._local, 'account', None)
+
+    @contextlib.contextmanager
+    def using(self, account: Optional[YouTubeAccount]) -> Iterator[None]:
+        """Send account's cookies with the urllib requests made by this thread (blocking code only)"""
+        previous = self.current()
+        self._local.account = account
+        try:
+            yield
+        finally:
+            self._local.account = previous
+
+    @staticmethod
+    def youtube_kwargs(account: Optional[YouTubeAccount]) -> Dict[str, Any]:
+        """YouTube() arguments that hand account's po_token to pytubefix"""
+        if account is None or not (account.visitor_data and account.po_token):
+            # pytubefix generates a po_token itself when the client needs one
+            return {}
+        return {
+            'use_po_token': True,
+            'po_token_verifier': account.po_token_verifier,
+            # Keep pytubefix from reading and writing its own token cache file on every call
+            'allow_oauth_cache': False
+        }
+
+    def report_blocked(self, account: Optional[YouTubeAccount]):
+        """Rest an account that YouTube bot-checked"""
+        if account is None:
+            return
+        account.failures += 1
+        account.blocked_until = time.monotonic() + DOWNLOAD_CONFIG['client_cooldown']
+        if len(self.accounts) > 1:
+            logger.warning(f"YouTube account {account.name} was bot-checked, rotating to the next one")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get per-account usage statistics"""
+        now = time.monotonic()
+        return {
+            'accounts': [
+                {
+                    'name': account.name,
+                    'cookies': len(account.jar) if account.jar is not None else 0,
+                    'po_token': bool(account.po_token),
+                    'uses': account.uses,
+                    'failures': account.failures,
+                    'blocked': account.blocked_until > now
+                }
+                for account in self.accounts
+            ]
+        }
+
+
+cookie_store = CookieStore(DOWNLOAD_CONFIG['youtube_cookie_files'], DOWNLOAD_CONFIG['po_token_file'])
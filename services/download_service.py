@@ -1,114 +1,1116 @@
 import asyncio
+import contextlib
+import contextvars
+import functools
+import json
 import logging
 import os
-import shutil
-from datetime import datetime, timedelta
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, Optional, Callable
-import tempfile
+from typing import Dict, Any, Optional, Callable, Awaitable, Deque, Iterator, List, Tuple
+
+import aiohttp
 
 # استفاده از pytubefix برای دانلود یوتیوب
 from pytubefix import YouTube, Stream
-from pytubefix.exceptions import VideoUnavailable, ExtractError, RegexMatchError
+from telethon import TelegramClient
+from telethon.utils import get_input_document
+from pytubefix.exceptions import (
+    VideoUnavailable, ExtractError, RegexMatchError, BotDetection, LoginRequired, PoTokenRequired,
+    VideoPrivate, MembersOnly, VideoRegionBlocked, LiveStreamError
+)
 
-from config import DOWNLOAD_CONFIG, QUALITY_OPTIONS
+from config import DOWNLOAD_CONFIG, QUALITY_OPTIONS, QUALITY_HEIGHTS
+from services.cookie_store import YouTubeAccount, cookie_store
+from services.media_processing import faststart_remux, ffmpeg_available, moov_at_end, mux_streams
+from services.progress_bus import progress_bus
 from services.session_manager import SessionManager
+from services.storage_manager import Reservation, StorageFullError, storage_manager
+from services.upload_service import BIG_FILE_THRESHOLD, stream_upload
 from utils.helpers import FileUtils, TextUtils
 
 logger = logging.getLogger(__name__)
 
-class ProgressHook:
-    """Progress hook for pytube downloads"""
-    
-    def __init__(self, callback: Optional[Callable] = None):
-        self.callback = callback
-        self.last_update = 0
-    
-    def __call__(self, d):
-        if self.callback:
-            current_time = datetime.now().timestamp()
-            
-            # Throttle updates to avoid spam
-            if current_time - self.last_update < 1:  # Update every 1 second
-                return
-            
-            self.last_update = current_time
-            
-            if d['status'] == 'downloading':
-                percent = d.get('_percent_str', '0%').replace('%', '')
-                try:
-                    percent_float = float(percent)
-                except (ValueError, TypeError):
-                    percent_float = 0
-                
-                progress_data = {
-                    'status': 'downloading',
-                    'percent': int(percent_float),
-                    'speed': d.get('_speed_str', 'Unknown'),
-                    'eta': d.get('_eta_str', 'Unknown')
+# URL pattern; group 6 is the canonical 11-character video ID
+YOUTUBE_PATTERN = re.compile(
+    r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
+    r'(watch\?v=|embed/|v/|shorts/|.+\?v=)?([^&=%\?]{11})'
+)
+
+# Dedicated, bounded pool for blocking pytubefix work (HTTP fetches, deciphering, file writes)
+PYTUBE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=DOWNLOAD_CONFIG['pytube_workers'],
+    thread_name_prefix='pytubefix'
+)
+
+# Per-stage timeouts in seconds
+PYTUBE_STAGE_TIMEOUTS = {
+    'metadata': DOWNLOAD_CONFIG['metadata_timeout'],
+    'streams': DOWNLOAD_CONFIG['streams_timeout'],
+    'download': DOWNLOAD_CONFIG['download_timeout']
+}
+
+
+async def run_pytube(stage: str, func: Callable, *args, **kwargs):
+    """Run a blocking pytubefix call on the dedicated pool with the stage's timeout"""
+    loop = asyncio.get_running_loop()
+    timeout = PYTUBE_STAGE_TIMEOUTS[stage]
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(PYTUBE_EXECUTOR, functools.partial(func, *args, **kwargs)),
+            timeout=timeout
+        )
+    except asyncio.TimeoutError:
+        # The worker thread keeps running until pytubefix returns, but callers stop waiting
+        logger.warning(f"pytubefix {stage} stage timed out after {timeout}s")
+        raise
+
+
+def load_youtube(url: str, account: Optional[YouTubeAccount] = None, **kwargs) -> YouTube:
+    """Build a YouTube object and fetch its metadata and stream table with account's cookies (blocking)"""
+    with cookie_store.using(account):
+        yt = YouTube(url, **kwargs)
+        # Touch the lazy properties so every network round-trip happens on this thread
+        _ = yt.title, yt.author, yt.length, yt.thumbnail_url
+        _ = yt.streams
+    return yt
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    """Get the canonical YouTube video ID from a URL"""
+    match = YOUTUBE_PATTERN.search(url)
+    return match.group(6) if match else None
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a pytubefix download thread to stop it at the next chunk"""
+
+
+class StreamProgressRouter:
+    """Routes progress events of a shared YouTube object to the downloading thread's listener"""
+
+    def __init__(self):
+        # Thread ident -> (listener, cancel flag)
+        self._listeners: Dict[int, Tuple[Optional[Callable], Optional[threading.Event]]] = {}
+
+    def __call__(self, stream, chunk, bytes_remaining):
+        listener, cancelled = self._listeners.get(threading.get_ident(), (None, None))
+        if cancelled is not None and cancelled.is_set():
+            # Threads cannot be killed; pytubefix lets this propagate out of stream.download()
+            raise DownloadCancelled()
+        if listener:
+            listener(stream, chunk, bytes_remaining)
+
+    def download(
+        self,
+        stream: Stream,
+        listener: Optional[Callable] = None,
+        cancelled: Optional[threading.Event] = None,
+        **kwargs
+    ) -> str:
+        """Download a stream, sending its progress to listener and stopping once cancelled is set (blocking)"""
+        ident = threading.get_ident()
+        self._listeners[ident] = (listener, cancelled)
+        try:
+            return stream.download(**kwargs)
+        finally:
+            self._listeners.pop(ident, None)
+
+
+def _describe_video(yt: YouTube, video_id: str) -> Dict[str, Any]:
+    """Snapshot title, author, length, thumbnail and the itag table (blocking)"""
+    streams = []
+    for stream in yt.streams:
+        height = getattr(stream, 'height', None) or 0
+        if not height and stream.resolution:
+            try:
+                height = int(stream.resolution.rstrip('p'))
+            except ValueError:
+                height = 0
+        streams.append({
+            'itag': stream.itag,
+            'type': stream.type,
+            'mime_type': stream.mime_type,
+            'resolution': stream.resolution,
+            'height': height,
+            'width': getattr(stream, 'width', None) or 0,
+            'fps': getattr(stream, 'fps', None),
+            'abr': stream.abr,
+            'video_codec': stream.video_codec,
+            'audio_codec': stream.audio_codec,
+            'filesize': stream.filesize,
+            'is_progressive': stream.is_progressive,
+            'includes_video_track': stream.includes_video_track,
+            'includes_audio_track': stream.includes_audio_track
+        })
+
+    return {
+        'video_id': video_id,
+        'title': yt.title,
+        'author': yt.author,
+        'length': yt.length,
+        'views': yt.views,
+        'thumbnail': yt.thumbnail_url,
+        'streams': streams,
+        'yt': yt,
+        'fetched_at': time.monotonic()
+    }
+
+
+def build_download_result(metadata: Dict[str, Any], itag: int, file_path: Optional[Path], file_size: int) -> Dict[str, Any]:
+    """Describe a finished download using the cached metadata"""
+    stream_info = next((s for s in metadata['streams'] if s['itag'] == itag), {})
+
+    return {
+        'success': True,
+        'file_path': str(file_path) if file_path else None,
+        'file_size': file_size,
+        'media_type': 'video' if stream_info.get('includes_video_track') else 'audio',
+        'title': metadata['title'],
+        'uploader': metadata['author'],
+        'duration': metadata['length'],
+        'width': stream_info.get('width', 0),
+        'height': stream_info.get('height', 0)
+    }
+
+
+def _abr_value(stream: Dict[str, Any]) -> int:
+    """Numeric audio bitrate of a cached stream ('128kbps' -> 128)"""
+    return int((stream['abr'] or '0').rstrip('kbps') or 0)
+
+
+def select_stream_itag(metadata: Dict[str, Any], quality: str) -> Optional[int]:
+    """Resolve a quality key ('hd', '1080p', 'audio', ...) to an itag of the cached streams"""
+    streams = metadata['streams']
+
+    if quality == 'audio':
+        audio = [s for s in streams if s['type'] == 'audio']
+        if audio:
+            return max(audio, key=_abr_value)['itag']
+
+    progressive = sorted(
+        (s for s in streams if s['is_progressive'] and s['height']),
+        key=lambda s: (s['height'], s['mime_type'] == 'video/mp4'),
+        reverse=True
+    )
+    if not progressive:
+        return streams[0]['itag'] if streams else None
+
+    if quality in ('worst', 'lowest'):
+        return progressive[-1]['itag']
+
+    # Best progressive stream not above the requested height, else the smallest one
+    target = QUALITY_HEIGHTS.get(quality)
+    if target:
+        for stream in progressive:
+            if stream['height'] <= target:
+                return stream['itag']
+        return progressive[-1]['itag']
+
+    return progressive[0]['itag']
+
+
+def select_stream_format(metadata: Dict[str, Any], quality: str) -> Optional[str]:
+    """Resolve a quality key to a format ID: one itag, or 'video+audio' itags for adaptive streams"""
+    itag = select_stream_itag(metadata, quality)
+    if itag is None:
+        return None
+
+    target = QUALITY_HEIGHTS.get(quality)
+    if not target or not DOWNLOAD_CONFIG['adaptive_download'] or not ffmpeg_available():
+        return str(itag)
+
+    # Progressive streams stop at 720p; use DASH only when it gets closer to the requested height
+    streams = metadata['streams']
+    progressive_height = next((s['height'] for s in streams if s['itag'] == itag), 0)
+    video = [
+        s for s in streams
+        if s['type'] == 'video' and not s['is_progressive'] and progressive_height < s['height'] <= target
+    ]
+    audio = [s for s in streams if s['type'] == 'audio']
+    if not video or not audio:
+        return str(itag)
+
+    # Prefer mp4 (H.264/AV1) video and AAC audio so the muxed mp4 plays inline in Telegram
+    best_video = max(video, key=lambda s: (s['height'], s['mime_type'] == 'video/mp4', s['fps'] or 0))
+    best_audio = max(audio, key=lambda s: (s['mime_type'] == 'audio/mp4', _abr_value(s)))
+    return f"{best_video['itag']}+{best_audio['itag']}"
+
+
+def format_filesize(metadata: Dict[str, Any], format_id: str) -> int:
+    """Expected size of a format ID from the cached streams (0 when unknown)"""
+    sizes = {str(s['itag']): s['filesize'] or 0 for s in metadata['streams']}
+    return sum(sizes.get(itag, 0) for itag in format_id.split('+'))
+
+
+def _retrieve_exception(task: asyncio.Task):
+    """Mark a failed shared fetch as seen when every caller had already given up on it"""
+    if not task.cancelled():
+        task.exception()
+
+
+class VideoMetadataCache:
+    """In-process LRU + TTL cache of video metadata keyed by video ID"""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, video_id: str) -> Optional[Dict[str, Any]]:
+        """Return a fresh entry and mark it recently used, or None"""
+        entry = self._entries.get(video_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        if time.monotonic() - entry['fetched_at'] > self.ttl:
+            # Stream URLs inside the entry expire upstream, so stale entries are dropped
+            del self._entries[video_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(video_id)
+        self.hits += 1
+        return entry
+
+    def put(self, video_id: str, entry: Dict[str, Any]):
+        """Store an entry, evicting the least recently used ones past the size bound"""
+        self._entries[video_id] = entry
+        self._entries.move_to_end(video_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, video_id: str):
+        """Drop an entry, e.g. after its stream URLs stopped working"""
+        self._entries.pop(video_id, None)
+
+    async def get_or_fetch(self, video_id: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Return the cached entry or fetch it once, sharing the fetch between concurrent callers"""
+        entry = self.get(video_id)
+        if entry is not None:
+            return entry
+
+        task = self._inflight.get(video_id)
+        if task is None:
+            # The fetch belongs to no caller: one of them timing out or being cancelled
+            # must not cancel it under the others
+            task = asyncio.ensure_future(self._fetch(video_id, fetch))
+            task.add_done_callback(_retrieve_exception)
+            self._inflight[video_id] = task
+        return await asyncio.shield(task)
+
+    async def _fetch(self, video_id: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Run the shared fetch and cache its result"""
+        try:
+            entry = await fetch()
+            self.put(video_id, entry)
+            return entry
+        finally:
+            self._inflight.pop(video_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache hit/miss statistics"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups * 100, 1) if lookups else 0.0
+        }
+
+
+# Shared by the download service and the YouTube plugin
+video_metadata_cache = VideoMetadataCache(
+    DOWNLOAD_CONFIG['metadata_cache_size'],
+    DOWNLOAD_CONFIG['metadata_cache_ttl']
+)
+
+
+# Failures of the video itself; every other client would fail the same way
+VIDEO_ERRORS = (VideoPrivate, MembersOnly, VideoRegionBlocked, LiveStreamError)
+
+# Failures that mean YouTube is blocking this client (or account) for now
+BLOCKED_ERRORS = (BotDetection, LoginRequired, PoTokenRequired)
+
+
+class ClientStats:
+    """Success rate and recent latencies of one pytubefix client"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: Deque[float] = deque(maxlen=50)
+        self.successes = 0
+        self.failures = 0
+        self.hedge_wins = 0
+        self.blocked_until = 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Latency below which q of the recent successful requests finished"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def success_rate(self) -> float:
+        # Smoothed so a single early failure does not bury a client
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def expected_latency(self, default: float) -> float:
+        """Median latency scaled up by the chance of having to ask again"""
+        median = self.percentile(0.5)
+        return (default if median is None else median) / self.success_rate
+
+
+class MetadataResolver:
+    """Loads YouTube objects through the fastest healthy pytubefix client
+
+    Clients are ranked by latency and success rate. If the chosen client has not answered by
+    its hedge_percentile latency, the next client is raced against it and the first answer
+    wins; a failed client hands over to the next one at once instead of after a timeout.
+    """
+
+    def __init__(self, clients: List[str]):
+        self.clients = {name: ClientStats(name) for name in clients or ['WEB']}
+        self.hedges = 0
+
+    def ranked(self) -> List[ClientStats]:
+        """Clients in the order they should be tried"""
+        now = time.monotonic()
+        default = DOWNLOAD_CONFIG['hedge_initial_delay']
+        # Blocked clients go last rather than away, they may be all that is left
+        return sorted(self.clients.values(), key=lambda c: (c.blocked_until > now, c.expected_latency(default)))
+
+    @staticmethod
+    def hedge_delay(client: ClientStats) -> float:
+        """How long to wait for client before racing another one"""
+        if len(client.latencies) < 5:
+            return DOWNLOAD_CONFIG['hedge_initial_delay']
+        return max(DOWNLOAD_CONFIG['hedge_min_delay'], client.percentile(DOWNLOAD_CONFIG['hedge_percentile']))
+
+    async def _attempt(self, client: ClientStats, url: str, kwargs: Dict[str, Any]) -> Tuple[YouTube, float]:
+        # Each attempt, hedges included, goes out under the next account in the rotation
+        account = cookie_store.checkout()
+        started = time.monotonic()
+        try:
+            yt = await run_pytube(
+                'metadata', load_youtube, url, account, client=client.name,
+                **cookie_store.youtube_kwargs(account), **kwargs
+            )
+        except BLOCKED_ERRORS:
+            cookie_store.report_blocked(account)
+            raise
+        return yt, time.monotonic() - started
+
+    async def load(self, url: str, **kwargs) -> YouTube:
+        """load_youtube() with the best client, hedged and failed over across the others"""
+        cookie_store.start()
+        candidates = self.ranked()
+        # Task -> (client, started at)
+        running: Dict[asyncio.Task, Tuple[ClientStats, float]] = {}
+        last_error: Optional[Exception] = None
+
+        def launch() -> ClientStats:
+            client = candidates.pop(0)
+            running[asyncio.create_task(self._attempt(client, url, kwargs))] = (client, time.monotonic())
+            return client
+
+        launch()
+        try:
+            while running:
+                timeout = None
+                if DOWNLOAD_CONFIG['metadata_hedging'] and candidates and len(running) == 1:
+                    client, started = next(iter(running.values()))
+                    timeout = max(0.0, started + self.hedge_delay(client) - time.monotonic())
+
+                done, _ = await asyncio.wait(list(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    hedge = launch()
+                    logger.info(f"{client.name} slow on {url}, hedging with {hedge.name}")
+                    continue
+
+                for task in done:
+                    client, _ = running.pop(task)
+                    try:
+                        yt, latency = task.result()
+                    except VIDEO_ERRORS:
+                        raise
+                    except Exception as e:
+                        client.failures += 1
+                        if isinstance(e, BLOCKED_ERRORS):
+                            client.blocked_until = time.monotonic() + DOWNLOAD_CONFIG['client_cooldown']
+                        logger.warning(f"pytubefix client {client.name} failed on {url}: {e!r}")
+                        last_error = e
+                        continue
+
+                    client.successes += 1
+                    client.latencies.append(latency)
+                    if running:
+                        client.hedge_wins += 1
+                    return yt
+
+                if not running and candidates:
+                    launch()
+        finally:
+            # Losers' threads finish on their own; nobody waits for them
+            for task in running:
+                task.cancel()
+
+        raise last_error
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get per-client health statistics"""
+        now = time.monotonic()
+        return {
+            'hedges': self.hedges,
+            'clients': [
+                {
+                    'name': client.name,
+                    'success_rate': round(client.success_rate * 100, 1),
+                    'successes': client.successes,
+                    'failures': client.failures,
+                    'p50': client.percentile(0.5),
+                    'hedge_wins': client.hedge_wins,
+                    'blocked': client.blocked_until > now
                 }
-                
+                for client in self.ranked()
+            ]
+        }
+
+
+metadata_resolver = MetadataResolver(DOWNLOAD_CONFIG['youtube_clients'])
+
+
+async def fetch_video_metadata(url: str) -> Dict[str, Any]:
+    """Get cached metadata for a YouTube URL, fetching it upstream at most once"""
+    video_id = extract_video_id(url)
+    if not video_id:
+        raise ValueError(f"Not a YouTube video URL: {url}")
+
+    async def fetch() -> Dict[str, Any]:
+        logger.info(f"Fetching YouTube metadata for {video_id}")
+        router = StreamProgressRouter()
+        yt = await metadata_resolver.load(
+            f"https://www.youtube.com/watch?v={video_id}", on_progress_callback=router
+        )
+        entry = await run_pytube('streams', _describe_video, yt, video_id)
+        entry['progress_router'] = router
+        return entry
+
+    return await video_metadata_cache.get_or_fetch(video_id, fetch)
+
+
+# Browser-like headers for googlevideo; stream URLs are pre-signed so no cookies are needed
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.9'
+}
+
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Get the process-wide pooled aiohttp session"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=DOWNLOAD_CONFIG['http_pool_size'], ttl_dns_cache=300),
+            headers=HTTP_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=None, connect=15, sock_read=30)
+        )
+    return _http_session
+
+
+async def close_http_session():
+    """Close the pooled aiohttp session on shutdown"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+class TokenBucket:
+    """Byte budget refilled at `rate` bytes per second; consumers that overdraw sleep off the debt"""
+
+    # Bytes a flow may get ahead of its rate, in seconds of that rate
+    BURST_SECONDS = 0.5
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate * self.BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float):
+        """Change the refill rate, keeping what was earned at the old one"""
+        self._refill()
+        self.rate = rate
+
+    async def consume(self, amount: int):
+        """Take amount bytes, sleeping until the bucket has paid for them"""
+        self._refill()
+        self.tokens -= amount
+        if self.tokens < 0 and self.rate > 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class BandwidthFlow:
+    """The download bandwidth of one job, shaped by its own token bucket"""
+
+    def __init__(self, user_id: Any, small: bool):
+        self.user_id = user_id
+        self.small = small
+        self.bucket = TokenBucket(0)
+        # Number of range fetches currently running; idle flows get no share
+        self.active = 0
+
+
+class BandwidthShaper:
+    """Splits a global bytes/sec ceiling between jobs: a reserved lane for small jobs, then equal shares per user
+
+    Rates are recomputed whenever a job starts or stops fetching, so bandwidth a job does not
+    use (while queued, muxing or uploading) goes to the others.
+    """
+
+    def __init__(self, limit: int, small_share: float):
+        self.limit = limit
+        self.small_share = min(max(small_share, 0.0), 1.0)
+        self.flows: List[BandwidthFlow] = []
+
+    @contextlib.contextmanager
+    def shaping(self, user_id: Any, small: bool) -> Iterator[Optional[BandwidthFlow]]:
+        """Shape every range fetch made in this context (and tasks it creates) as one job's flow"""
+        if not self.limit:
+            yield None
+            return
+        flow = BandwidthFlow(user_id, small)
+        token = _current_flow.set(flow)
+        try:
+            yield flow
+        finally:
+            _current_flow.reset(token)
+            if flow in self.flows:
+                self.flows.remove(flow)
+                self._rebalance()
+
+    def activate(self, flow: BandwidthFlow):
+        """A flow started fetching"""
+        flow.active += 1
+        if flow.active == 1:
+            self.flows.append(flow)
+            self._rebalance()
+
+    def deactivate(self, flow: BandwidthFlow):
+        """A flow stopped fetching"""
+        flow.active -= 1
+        if flow.active == 0 and flow in self.flows:
+            self.flows.remove(flow)
+            self._rebalance()
+
+    def _rebalance(self):
+        """Give every active flow its rate: lane share, then user share, then job share"""
+        small = [f for f in self.flows if f.small]
+        big = [f for f in self.flows if not f.small]
+        if small and big:
+            lanes = ((small, self.limit * self.small_share), (big, self.limit * (1 - self.small_share)))
+        else:
+            lanes = ((small, self.limit), (big, self.limit))
+
+        for flows, lane_rate in lanes:
+            users: Dict[Any, List[BandwidthFlow]] = {}
+            for flow in flows:
+                users.setdefault(flow.user_id, []).append(flow)
+            for user_flows in users.values():
+                for flow in user_flows:
+                    flow.bucket.set_rate(lane_rate / len(users) / len(user_flows))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get current shaping state"""
+        return {
+            'limit': self.limit,
+            'flows': len(self.flows),
+            'small_flows': sum(1 for f in self.flows if f.small),
+            'users': len({f.user_id for f in self.flows})
+        }
+
+
+# Flow of the job whose task is running; set by BandwidthShaper.shaping() and inherited by its subtasks
+_current_flow: contextvars.ContextVar = contextvars.ContextVar('bandwidth_flow', default=None)
+
+bandwidth_shaper = BandwidthShaper(DOWNLOAD_CONFIG['bandwidth_limit'], DOWNLOAD_CONFIG['small_job_share'])
+
+
+# Partial downloads live here under deterministic names so retries (even after a restart) find them
+PARTIAL_DIR = Path(DOWNLOAD_CONFIG['temp_dir']) / 'partial'
+
+
+class DownloadCheckpoint:
+    """Sidecar JSON recording which byte ranges of a partial download are complete"""
+
+    def __init__(self, path: Path, info: Dict[str, Any], completed: Optional[List[List[int]]] = None):
+        self.path = path
+        self.info = info
+        # Sorted, non-overlapping inclusive [start, end] ranges
+        self.completed: List[List[int]] = completed or []
+        self.last_saved = 0.0
+
+    @classmethod
+    def open(cls, path: Path, info: Dict[str, Any]) -> 'DownloadCheckpoint':
+        """Load the checkpoint at path if it describes the same stream, else start a new one"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('itag') == info['itag'] and data.get('filesize') == info['filesize']:
+                return cls(path, dict(data, url=info.get('url') or data.get('url')), data.get('completed', []))
+        except (OSError, ValueError):
+            pass
+        return cls(path, info)
+
+    @property
+    def completed_bytes(self) -> int:
+        return sum(end - start + 1 for start, end in self.completed)
+
+    def mark(self, start: int, end: int):
+        """Record [start, end] as written, merging with neighbouring ranges"""
+        merged = []
+        for rng in self.completed:
+            if rng[1] + 1 < start or rng[0] > end + 1:
+                merged.append(rng)
+            else:
+                start, end = min(start, rng[0]), max(end, rng[1])
+        merged.append([start, end])
+        merged.sort()
+        self.completed = merged
+
+    def missing(self, filesize: int) -> List[Tuple[int, int]]:
+        """Inclusive byte ranges that still have to be fetched"""
+        gaps = []
+        position = 0
+        for start, end in self.completed:
+            if start > position:
+                gaps.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < filesize:
+            gaps.append((position, filesize - 1))
+        return gaps
+
+    def save(self, completed: Optional[List[List[int]]] = None):
+        """Write the sidecar atomically (blocking); completed is a snapshot taken on the loop"""
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            completed = self.completed if completed is None else completed
+            json.dump(dict(self.info, completed=completed, updated_at=time.time()), f)
+        os.replace(tmp_path, self.path)
+        self.last_saved = time.monotonic()
+
+    def remove(self):
+        """Delete the sidecar once the download is complete (blocking)"""
+        for path in (self.path, self.path.with_suffix('.tmp')):
+            if path.exists():
+                path.unlink()
+
+
+class _StreamSource:
+    """The URL a download fetches from, re-resolved once if googlevideo reports it expired"""
+
+    def __init__(self, url: str, refresh_url: Optional[Callable[[], Awaitable[str]]]):
+        self.url = url
+        self.refresh_url = refresh_url
+        self.refreshed = False
+        self._lock = asyncio.Lock()
+
+    async def renew(self, expired: str) -> bool:
+        """Replace an expired URL; False when there is no fresh one to try"""
+        async with self._lock:
+            if self.url != expired:
+                # Another segment already renewed it
+                return True
+            if self.refresh_url is None or self.refreshed:
+                return False
+            self.refreshed = True
+            self.url = await self.refresh_url()
+            logger.info("Stream URL expired, continuing with a freshly resolved one")
+            return True
+
+
+class SegmentedDownloader:
+    """Fetches a stream URL as byte ranges, concurrently into a file or in order into a sink"""
+
+    def __init__(
+        self,
+        segments: int = DOWNLOAD_CONFIG['download_segments'],
+        segment_size: int = DOWNLOAD_CONFIG['segment_size'],
+        retries: int = DOWNLOAD_CONFIG['segment_retries']
+    ):
+        self.segments = max(1, segments)
+        self.segment_size = max(1024 * 1024, segment_size)
+        self.retries = retries
+
+    def split(self, size: int, offset: int = 0) -> List[Tuple[int, int]]:
+        """Split size bytes starting at offset into inclusive (start, end) byte ranges"""
+        return [
+            (start, min(start + self.segment_size, offset + size) - 1)
+            for start in range(offset, offset + size, self.segment_size)
+        ]
+
+    async def download(
+        self,
+        url: str,
+        file_path: Path,
+        filesize: int,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        checkpoint: Optional[DownloadCheckpoint] = None,
+        refresh_url: Optional[Callable[[], Awaitable[str]]] = None
+    ) -> Path:
+        """Download url into file_path; progress_callback gets (bytes_done, filesize)
+
+        With a checkpoint, ranges it already records are skipped and progress is saved to it.
+        refresh_url resolves a new URL when the signed one expires mid-download.
+        """
+        loop = asyncio.get_running_loop()
+
+        resuming = bool(checkpoint and checkpoint.completed) and file_path.exists() and file_path.stat().st_size == filesize
+        if checkpoint and not resuming:
+            checkpoint.completed = []
+        missing = checkpoint.missing(filesize) if checkpoint else [(0, filesize - 1)]
+        if resuming:
+            logger.info(f"Resuming {file_path.name} at {checkpoint.completed_bytes}/{filesize} bytes")
+
+        async def write(offset: int, chunk: bytes):
+            await loop.run_in_executor(None, os.pwrite, fd, chunk, offset)
+
+        # The periodic checkpoint write in flight; at most one, and never on the loop itself
+        saving: List[Optional[asyncio.Future]] = [None]
+
+        def on_written(offset: int, count: int):
+            if checkpoint:
+                checkpoint.mark(offset, offset + count - 1)
+                if ((saving[0] is None or saving[0].done())
+                        and time.monotonic() - checkpoint.last_saved >= DOWNLOAD_CONFIG['checkpoint_interval']):
+                    # mark() rebinds completed, so the list handed to the thread never changes under it
+                    saving[0] = loop.run_in_executor(None, checkpoint.save, checkpoint.completed)
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not resuming:
+                # Preallocate so every segment can write at its own offset
+                await loop.run_in_executor(None, os.ftruncate, fd, filesize)
+            await self._fetch_all(
+                url, filesize, write, progress_callback, self.segments,
+                ranges=[part for start, end in missing for part in self.split(end - start + 1, start)],
+                on_written=on_written, refresh_url=refresh_url
+            )
+        finally:
+            os.close(fd)
+            if checkpoint:
+                if saving[0] is not None:
+                    # Both writes go through the same .tmp file
+                    await asyncio.gather(saving[0], return_exceptions=True)
+                # Keep what we have for the next attempt, even after a crash or restart
+                await loop.run_in_executor(None, checkpoint.save)
+
+        return file_path
+
+    async def stream(
+        self,
+        url: str,
+        filesize: int,
+        write: Callable[[int, bytes], Awaitable[None]],
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        refresh_url: Optional[Callable[[], Awaitable[str]]] = None
+    ):
+        """Fetch url range by range and hand the bytes to write() strictly in order"""
+        await self._fetch_all(url, filesize, write, progress_callback, 1, refresh_url=refresh_url)
+
+    async def _fetch_all(
+        self,
+        url: str,
+        filesize: int,
+        write: Callable[[int, bytes], Awaitable[None]],
+        progress_callback: Optional[Callable[[int, int], None]],
+        concurrency: int,
+        ranges: Optional[List[Tuple[int, int]]] = None,
+        on_written: Optional[Callable[[int, int], None]] = None,
+        refresh_url: Optional[Callable[[], Awaitable[str]]] = None
+    ):
+        """Fetch the given ranges (default: the whole file) with up to `concurrency` requests in flight"""
+        source = _StreamSource(url, refresh_url)
+        if ranges is None:
+            ranges = self.split(filesize)
+        queue: asyncio.Queue = asyncio.Queue()
+        for byte_range in ranges:
+            queue.put_nowait(byte_range)
+
+        done = [filesize - sum(end - start + 1 for start, end in ranges)]
+
+        def on_bytes(offset: int, count: int):
+            done[0] += count
+            if on_written:
+                on_written(offset, count)
+            if progress_callback:
+                progress_callback(done[0], filesize)
+
+        async def worker():
+            while True:
                 try:
-                    loop = asyncio.get_event_loop()
-                    if loop.is_running():
-                        asyncio.create_task(self._safe_callback(progress_data))
-                    else:
-                        loop.run_until_complete(self._safe_callback(progress_data))
-                except Exception as e:
-                    logger.error(f"Error in progress callback: {e}")
-    
-    async def _safe_callback(self, data):
+                    start, end = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self._fetch_range(source, filesize, write, start, end, on_bytes)
+
+        # The job competes for bandwidth only while it is actually fetching
+        flow = _current_flow.get()
+        if flow:
+            bandwidth_shaper.activate(flow)
+        workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, queue.qsize()))]
         try:
-            await self.callback(data)
-        except Exception as e:
-            logger.error(f"Error in callback: {e}")
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        finally:
+            if flow:
+                bandwidth_shaper.deactivate(flow)
 
+        if done[0] != filesize:
+            raise IOError(f"Segmented download incomplete: {done[0]}/{filesize} bytes")
 
-class PytubeProgressCallback:
-    """Progress callback for pytube downloads"""
-    
-    def __init__(self, callback: Optional[Callable] = None):
-        self.callback = callback
-        self.last_update = 0
-        self.filesize = 0
-    
-    def set_filesize(self, filesize: int):
-        self.filesize = filesize
-    
-    def __call__(self, chunk, file_handle, bytes_remaining):
-        if self.callback and self.filesize > 0:
-            current_time = datetime.now().timestamp()
-            
-            # Throttle updates to avoid spam
-            if current_time - self.last_update < 1:  # Update every 1 second
-                return
-            
-            self.last_update = current_time
-            
-            bytes_downloaded = self.filesize - bytes_remaining
-            percent = int((bytes_downloaded / self.filesize) * 100)
-            
-            progress_data = {
-                'status': 'downloading',
-                'percent': percent,
-                'speed': 'Unknown',  # pytube doesn't provide speed info
-                'eta': 'Unknown'     # pytube doesn't provide ETA info
-            }
-            
+    async def _fetch_range(
+        self,
+        source: _StreamSource,
+        filesize: int,
+        write: Callable[[int, bytes], Awaitable[None]],
+        start: int,
+        end: int,
+        on_bytes: Callable[[int, int], None]
+    ):
+        """Fetch one byte range, retrying from the last written offset"""
+        session = get_http_session()
+        flow = _current_flow.get()
+        offset = start
+
+        attempt = 0
+        while True:
+            url = source.url
             try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.create_task(self._safe_callback(progress_data))
-                else:
-                    loop.run_until_complete(self._safe_callback(progress_data))
-            except Exception as e:
-                logger.error(f"Error in progress callback: {e}")
-    
-    async def _safe_callback(self, data):
+                headers = {'Range': f'bytes={offset}-{end}'}
+                async with session.get(url, headers=headers) as response:
+                    if response.status in (403, 410):
+                        # The signed URL expired; asking again with it cannot succeed
+                        if await source.renew(url):
+                            continue
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history,
+                            status=response.status, message='Stream URL expired'
+                        )
+                    # A server may answer a range spanning the whole file with the plain file
+                    whole_file = response.status == 200 and offset == 0 and end == filesize - 1
+                    if response.status != 206 and not whole_file:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history,
+                            status=response.status, message='Range request not honoured'
+                        )
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CONFIG['http_chunk_size']):
+                        chunk = chunk[:end + 1 - offset]
+                        if flow:
+                            # Reading slower lets TCP flow control throttle the sender
+                            await flow.bucket.consume(len(chunk))
+                        await write(offset, chunk)
+                        on_bytes(offset, len(chunk))
+                        offset += len(chunk)
+                        if offset > end:
+                            return
+                if offset > end:
+                    return
+                raise aiohttp.ClientPayloadError(f"Range {start}-{end} ended early at {offset}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                expired = isinstance(e, aiohttp.ClientResponseError) and e.status in (403, 410)
+                if expired or attempt >= self.retries:
+                    raise
+                delay = 2 ** attempt
+                attempt += 1
+                logger.warning(f"Segment {start}-{end} failed at {offset} ({e}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+
+segmented_downloader = SegmentedDownloader()
+
+
+def resolve_stream_url(stream: Stream) -> str:
+    """Get the signed googlevideo URL of a stream (blocking, may decipher)"""
+    return stream.url
+
+
+async def refresh_stream_url(video_id: str, itag: int) -> str:
+    """Re-fetch a video's metadata and resolve a freshly signed URL for one of its streams"""
+    video_metadata_cache.invalidate(video_id)
+    metadata = await fetch_video_metadata(f"https://www.youtube.com/watch?v={video_id}")
+    stream = await run_pytube('streams', metadata['yt'].streams.get_by_itag, itag)
+    if not stream:
+        raise IOError(f"Stream {itag} of {video_id} is no longer available")
+    return await run_pytube('streams', resolve_stream_url, stream)
+
+
+# Partial file name -> [lock, number of users]
+_partial_locks: Dict[str, List] = {}
+
+
+async def download_resumable(
+    metadata: Dict[str, Any],
+    stream: Stream,
+    file_path: Path,
+    progress_handler: Optional[Callable] = None
+) -> Path:
+    """Download a stream into file_path through a checkpointed partial file, resuming earlier attempts"""
+    partial_path = PARTIAL_DIR / f"{metadata['video_id']}_{stream.itag}.{stream.subtype}"
+    PARTIAL_DIR.mkdir(parents=True, exist_ok=True)
+
+    def on_progress(done: int, total: int):
+        if progress_handler:
+            progress_handler(stream, b'', total - done)
+
+    # Two formats can share an audio itag; only one of them may write its partial file
+    entry = _partial_locks.setdefault(partial_path.name, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            # The caller's reservation covers the partial while we work on it
+            storage_manager.claim_partial(partial_path, stream.filesize)
+            try:
+                result = await _download_partial(stream, partial_path, file_path, metadata['video_id'], on_progress)
+            except BaseException:
+                storage_manager.track_partial(partial_path, stream.filesize)
+                raise
+            storage_manager.finish_partial(partial_path)
+            return result
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _partial_locks.pop(partial_path.name, None)
+
+
+async def _download_partial(
+    stream: Stream,
+    partial_path: Path,
+    file_path: Path,
+    video_id: str,
+    on_progress: Callable[[int, int], None]
+) -> Path:
+    """Fetch the missing ranges of partial_path, then move it to file_path"""
+    filesize = stream.filesize
+    url = await run_pytube('streams', resolve_stream_url, stream)
+    checkpoint = DownloadCheckpoint.open(
+        partial_path.with_name(partial_path.name + '.json'),
+        {'video_id': video_id, 'itag': stream.itag, 'filesize': filesize, 'url': url}
+    )
+
+    async def refresh_url() -> str:
+        # Later resume attempts and restarts pick the new URL up from the checkpoint
+        checkpoint.info['url'] = await refresh_stream_url(video_id, stream.itag)
+        return checkpoint.info['url']
+
+    for attempt in range(DOWNLOAD_CONFIG['resume_attempts'] + 1):
         try:
-            await self.callback(data)
-        except Exception as e:
-            logger.error(f"Error in callback: {e}")
+            await segmented_downloader.download(
+                checkpoint.info['url'], partial_path, filesize, on_progress, checkpoint, refresh_url
+            )
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            if attempt >= DOWNLOAD_CONFIG['resume_attempts']:
+                raise
+            logger.warning(
+                f"Download of itag {stream.itag} stopped at {checkpoint.completed_bytes}/{filesize} bytes ({e}), resuming"
+            )
+
+    os.replace(partial_path, file_path)
+    await asyncio.get_running_loop().run_in_executor(None, checkpoint.remove)
+    return file_path
+
+
+async def download_stream(
+    metadata: Dict[str, Any],
+    stream: Stream,
+    output_dir: Path,
+    progress_handler: Optional[Callable] = None,
+    filename: Optional[str] = None
+) -> Path:
+    """Download a stream with the resumable segmented engine, falling back to pytubefix"""
+    filesize = stream.filesize
+    if DOWNLOAD_CONFIG['segmented_download'] and filesize:
+        file_path = output_dir / (filename or stream.default_filename)
+        try:
+            return await download_resumable(metadata, stream, file_path, progress_handler)
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            # The partial file and its checkpoint stay for the next request of this stream
+            logger.warning(f"Segmented download of itag {stream.itag} failed ({e}), falling back to pytubefix")
+
+    cancelled = threading.Event()
+    try:
+        return Path(await run_pytube(
+            'download', metadata['progress_router'].download, stream, progress_handler, cancelled,
+            output_path=str(output_dir), filename=filename
+        ))
+    except BaseException:
+        # Cancelled or timed out: make the worker thread stop instead of finishing the file
+        cancelled.set()
+        raise
+
+
+async def download_adaptive(
+    metadata: Dict[str, Any],
+    video: Stream,
+    audio: Stream,
+    output_dir: Path,
+    progress_handler: Optional[Callable] = None
+) -> Path:
+    """Fetch a video-only and an audio-only stream concurrently and mux them into one mp4"""
+    remaining = {video.itag: video.filesize, audio.itag: audio.filesize}
+
+    def combined_progress(stream, chunk, bytes_remaining):
+        remaining[stream.itag] = bytes_remaining
+        if progress_handler:
+            progress_handler(stream, chunk, sum(remaining.values()))
+
+    tasks = [
+        asyncio.create_task(download_stream(
+            metadata, part, output_dir, combined_progress, filename=f"{kind}_{part.itag}.{part.subtype}"
+        ))
+        for kind, part in (('video', video), ('audio', audio))
+    ]
+    try:
+        video_path, audio_path = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    output_path = output_dir / f"{Path(video.default_filename).stem}.mp4"
+    try:
+        return await mux_streams(video_path, audio_path, output_path)
+    finally:
+        for part_path in (video_path, audio_path):
+            if part_path.exists() and part_path != output_path:
+                part_path.unlink()
 
 
 class PytubeDownloader:
@@ -140,54 +1142,44 @@ class PytubeDownloader:
             return yt.streams.first()  # Return any available stream as fallback
     
     async def download(self, url: str, quality: str, progress_callback: Optional[Callable] = None) -> Dict[str, Any]:
-        """Download a YouTube video using pytube"""
-        temp_download_dir = Path(tempfile.mkdtemp(dir=self.temp_dir))
+        """Download a YouTube video using pytube
+
+        The file stays reserved until the caller passes it to storage_manager.release().
+        """
+        reservation: Optional[Reservation] = None
+        completed = False
+        job_id = f"pytube_{id(self)}_{time.monotonic_ns()}"
+        if progress_callback:
+            progress_bus.subscribe(job_id, progress_callback)
         
         try:
-            # Create progress callback
-            progress_handler = PytubeProgressCallback(progress_callback)
-            
-            # Initialize YouTube object with cookies and po_token
-            yt = YouTube(url, on_progress_callback=progress_handler, use_po_token=True, cookies='cookies.txt')
+            # Reuse the cached YouTube object instead of fetching the watch page again
+            metadata = await fetch_video_metadata(url)
+            yt = metadata['yt']
             
             # Get stream based on quality
-            stream = self._get_stream_by_quality(yt, quality)
+            stream = await run_pytube('streams', self._get_stream_by_quality, yt, quality)
             if not stream:
                 return {'success': False, 'error': f'No stream available for quality: {quality}'}
             
-            # Set filesize for progress calculation
-            progress_handler.set_filesize(stream.filesize)
-            
             # Download the video
-            file_path = Path(stream.download(output_path=str(temp_download_dir)))
+            reservation = await storage_manager.reserve(stream.filesize or 0)
+            file_path = await download_stream(
+                metadata, stream, reservation.path, progress_bus.pytube_listener(job_id, stream.filesize)
+            )
             
             if not file_path.exists():
                 return {'success': False, 'error': 'Download failed: File not found after download'}
             
+            storage_manager.commit(reservation, file_path)
+            completed = True
             file_size = file_path.stat().st_size
             
-            # Get video info
-            info = {
-                'title': yt.title,
-                'uploader': yt.author,
-                'duration': yt.length,
-                'width': int(stream.resolution.split('x')[0]) if stream.resolution else 0,
-                'height': stream.resolution.split('x')[1] if stream.resolution else 0
-            }
-            
-            media_type = 'video' if stream.includes_video_track else 'audio'
-            
-            return {
-                'success': True,
-                'file_path': str(file_path),
-                'file_size': file_size,
-                'media_type': media_type,
-                'title': info.get('title', 'Unknown'),
-                'uploader': info.get('uploader', 'Unknown'),
-                'duration': info.get('duration', 0),
-                'width': info.get('width', 0),
-                'height': info.get('height', 0)
-            }
+            return build_download_result(metadata, stream.itag, file_path, file_size)
+        
+        except StorageFullError as e:
+            logger.warning(f"Pytube download of {url} rejected: {e}")
+            return {'success': False, 'error': str(e)}
         
         except Exception as e:
             logger.error(f"Pytube download error: {e}")
@@ -198,8 +1190,9 @@ class PytubeDownloader:
             return {'success': False, 'error': str(e)}
         
         finally:
-            # Schedule cleanup
-            asyncio.create_task(self._cleanup_temp_dir(temp_download_dir))
+            await progress_bus.close(job_id)
+            if reservation and not completed:
+                storage_manager.discard(reservation)
     
     def _get_stream_by_quality(self, yt: YouTube, quality: str) -> Optional[Stream]:
         """Get stream based on quality setting"""
@@ -221,21 +1214,266 @@ class PytubeDownloader:
         except Exception as e:
             logger.error(f"Error getting stream: {e}")
             return yt.streams.get_highest_resolution()
-    
-    async def _cleanup_temp_dir(self, temp_dir: Path):
-        """Clean up temporary directory after download"""
-        try:
-            # Wait for a while to ensure file operations are complete
-            await asyncio.sleep(60)
-            if temp_dir.exists():
-                shutil.rmtree(temp_dir, ignore_errors=True)
-        except Exception as e:
-            logger.error(f"Error cleaning up temp dir: {e}")
+
+
+class QueueFullError(Exception):
+    """Raised when the download queue cannot accept another job"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Download queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+CANCELLED_RESULT = {'success': False, 'error': 'cancelled', 'cancelled': True}
+
+
+class DownloadJob:
+    """A unit of work waiting for (or running on) a download worker"""
+
+    def __init__(self, job_id: str, runner: Callable[[], Awaitable[Dict[str, Any]]],
+                 progress_callback: Optional[Callable] = None):
+        self.job_id = job_id
+        self.runner = runner
+        self.progress_callback = progress_callback
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+
+
+class DownloadScheduler:
+    """Fixed-size worker pool with a bounded pending queue"""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = max(1, workers)
+        self.max_pending = max(0, max_pending)
+        self.pending: Deque[DownloadJob] = deque()
+        self.running: Dict[str, DownloadJob] = {}
+        self._condition: Optional[asyncio.Condition] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        # Moving average of job run time, seeded with a conservative guess
+        self.avg_job_seconds = 60.0
+
+    def _ensure_workers(self):
+        """Start worker tasks on first use (needs a running loop)"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        if not self._worker_tasks:
+            for index in range(self.workers):
+                self._worker_tasks.append(asyncio.create_task(self._worker(index)))
+            logger.info(f"Download scheduler started with {self.workers} workers, {self.max_pending} queue slots")
+
+    def estimate_wait(self, position: int) -> int:
+        """Estimate seconds until the job at the given queue position starts"""
+        if position <= 0:
+            return 0
+        rounds = (position - 1) // self.workers + 1
+        return int(rounds * self.avg_job_seconds)
+
+    def retry_after(self) -> int:
+        """Estimate seconds until a queue slot frees up"""
+        return max(1, int(self.avg_job_seconds / self.workers))
+
+    async def submit(
+        self,
+        job_id: str,
+        runner: Callable[[], Awaitable[Dict[str, Any]]],
+        progress_callback: Optional[Callable] = None
+    ) -> Dict[str, Any]:
+        """Queue a job and wait for its result; raises QueueFullError when saturated"""
+        self._ensure_workers()
+
+        # A job may start right away if a worker is idle; otherwise it needs a queue slot
+        idle_workers = self.workers - len(self.running)
+        if len(self.pending) >= self.max_pending + max(0, idle_workers):
+            raise QueueFullError(self.retry_after())
+
+        job = DownloadJob(job_id, runner, progress_callback)
+        async with self._condition:
+            self.pending.append(job)
+            self._condition.notify()
+
+        # Jobs that start immediately don't need a queue position message
+        if idle_workers <= 0:
+            await self._notify_positions()
+        return await job.future
+
+    async def _worker(self, index: int):
+        """Pull jobs from the queue and run them one at a time"""
+        while True:
+            async with self._condition:
+                while not self.pending:
+                    await self._condition.wait()
+                job = self.pending.popleft()
+
+            job.started_at = time.monotonic()
+            self.running[job.job_id] = job
+            await self._notify_positions()
+
+            try:
+                # Run in its own task so cancel() can stop this job without stopping the worker
+                job.task = asyncio.create_task(job.runner())
+                result = await job.task
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                if job.cancelled:
+                    if not job.future.done():
+                        job.future.set_result(CANCELLED_RESULT)
+                    continue
+                job.task.cancel()
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"Download worker {index} error on job {job.job_id}: {e}")
+                if not job.future.done():
+                    job.future.set_result({'success': False, 'error': str(e)})
+            finally:
+                self.running.pop(job.job_id, None)
+                elapsed = time.monotonic() - job.started_at
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+
+    def cancel(self, job_id: str) -> bool:
+        """Drop a queued job or stop a running one; its submitter gets CANCELLED_RESULT"""
+        for job in self.pending:
+            if job.job_id == job_id:
+                self.pending.remove(job)
+                if not job.future.done():
+                    job.future.set_result(CANCELLED_RESULT)
+                return True
+        
+        job = self.running.get(job_id)
+        if job and job.task and not job.task.done():
+            job.cancelled = True
+            job.task.cancel()
+            return True
+        return False
+
+    async def _notify_positions(self):
+        """Tell every waiting job where it currently stands in the queue"""
+        for position, job in enumerate(list(self.pending), start=1):
+            if not job.progress_callback:
+                continue
+            try:
+                await job.progress_callback({
+                    'status': 'queued',
+                    'position': position,
+                    'eta': self.estimate_wait(position)
+                })
+            except Exception as e:
+                logger.debug(f"Queue position update failed for job {job.job_id}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get scheduler load statistics"""
+        return {
+            'workers': self.workers,
+            'running': len(self.running),
+            'pending': len(self.pending),
+            'max_pending': self.max_pending,
+            'avg_job_seconds': round(self.avg_job_seconds, 1)
+        }
+
+
+class AdmissionController:
+    """Decides from metadata alone whether a job can be delivered: accept, downgrade or reject"""
+
+    # Video quality keys from the highest down; requests that do not fit try the next one
+    DOWNGRADE_LADDER = ['4k', '1440p', '1080p', '720p', '480p', '360p', '240p', '144p']
+
+    def __init__(self, scheduler: DownloadScheduler):
+        self.scheduler = scheduler
+        # Moving average of bytes per second per job, seeded from config until jobs finish
+        self.throughput = float(DOWNLOAD_CONFIG['assumed_throughput'])
+        self.accepted = 0
+        self.downgraded = 0
+        self.rejected = 0
+
+    def record(self, size: int, seconds: float):
+        """Feed the size and run time of a finished job into the throughput estimate"""
+        if size > 0 and seconds > 0:
+            self.throughput = 0.8 * self.throughput + 0.2 * (size / seconds)
+
+    def estimate_eta(self, size: int) -> int:
+        """Seconds until a new job of size bytes would be finished under the current load"""
+        idle_workers = self.scheduler.workers - len(self.scheduler.running)
+        position = 0 if idle_workers > 0 else len(self.scheduler.pending) + 1
+        return self.scheduler.estimate_wait(position) + int(size / max(self.throughput, 1))
+
+    def _candidates(self, quality: str) -> List[str]:
+        """The requested quality followed by the lower ones it may be downgraded to"""
+        if quality == 'audio':
+            return [quality]
+        target = QUALITY_HEIGHTS.get(quality, float('inf'))
+        return [quality] + [q for q in self.DOWNGRADE_LADDER if QUALITY_HEIGHTS[q] < target]
+
+    def evaluate(self, metadata: Dict[str, Any], quality: str, count: bool = True) -> Dict[str, Any]:
+        """Pick the best deliverable format for a request before any bytes are fetched
+
+        count=False leaves the decision counters alone (used for speculation).
+        """
+        max_duration = DOWNLOAD_CONFIG['max_duration']
+        if max_duration and (metadata['length'] or 0) > max_duration:
+            self.rejected += count
+            return {'action': 'reject', 'reason': 'too_long', 'duration': metadata['length'], 'limit': max_duration}
+
+        max_size = DOWNLOAD_CONFIG['max_file_size']
+        max_eta = DOWNLOAD_CONFIG['max_eta']
+        rejection = {'action': 'reject', 'reason': 'no_stream'}
+        seen = set()
+
+        for candidate in self._candidates(quality):
+            format_id = select_stream_format(metadata, candidate)
+            if format_id is None or format_id in seen:
+                continue
+            seen.add(format_id)
+
+            size = format_filesize(metadata, format_id)
+            eta = self.estimate_eta(size)
+            if size > max_size:
+                if rejection['reason'] == 'no_stream':
+                    rejection = {'action': 'reject', 'reason': 'too_large', 'size': size, 'limit': max_size}
+                continue
+            if max_eta and eta > max_eta:
+                if rejection['reason'] == 'no_stream':
+                    rejection = {'action': 'reject', 'reason': 'too_slow', 'eta': eta, 'limit': max_eta}
+                continue
+
+            downgraded = candidate != quality
+            if downgraded:
+                # Name the downgrade after the height actually delivered (480p may resolve to 360p)
+                height = max(s['height'] or 0 for s in metadata['streams'] if str(s['itag']) in format_id.split('+'))
+                candidate = next((q for q in self.DOWNGRADE_LADDER if QUALITY_HEIGHTS[q] == height), candidate)
+                self.downgraded += count
+                logger.info(f"Admission: {metadata['video_id']} downgraded from {quality} to {candidate} ({size} bytes)")
+            else:
+                self.accepted += count
+            return {
+                'action': 'downgrade' if downgraded else 'accept',
+                'quality': candidate,
+                'format_id': format_id,
+                'size': size,
+                'eta': eta
+            }
+
+        self.rejected += count
+        logger.info(f"Admission: {metadata['video_id']} ({quality}) rejected: {rejection['reason']}")
+        return rejection
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get admission decision counters"""
+        return {
+            'accepted': self.accepted,
+            'downgraded': self.downgraded,
+            'rejected': self.rejected,
+            'throughput': int(self.throughput)
+        }
 
 
 class DownloadService:
     """Service for downloading media from various platforms"""
-    
+
     def __init__(self, session_manager: SessionManager):
         self.session_manager = session_manager
         self.temp_dir = Path(DOWNLOAD_CONFIG['temp_dir'])
@@ -247,42 +1485,123 @@ class DownloadService:
         # Active downloads tracking
         self.active_downloads: Dict[str, Dict[str, Any]] = {}
         
-        # Schedule cleanup of old temp files
-        asyncio.create_task(self._cleanup_old_files())
+        # Single-flight downloads keyed by (video ID, format ID); their files are refcounted by storage_manager
+        self.inflight_downloads: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.shared_downloads = 0
+        
+        # Finished speculative downloads waiting for their first request, holding one file reference
+        self.ready_files: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        
+        # Bounded worker pool for the actual transfers
+        self.scheduler = DownloadScheduler(
+            DOWNLOAD_CONFIG['concurrent_downloads'],
+            DOWNLOAD_CONFIG['max_pending_downloads']
+        )
+        self.admission = AdmissionController(self.scheduler)
+        
+        # Byte-budgeted temp storage; also expires kept partials and leaked files
+        self.storage = storage_manager
+        self.storage.start()
     
     async def download_and_upload(
         self,
         url: str,
         platform: str,
         quality: str,
-        progress_callback: Optional[Callable] = None
+        progress_callback: Optional[Callable] = None,
+        client: Optional[TelegramClient] = None,
+        deliver: Optional[Callable[[Any, Dict[str, Any]], Awaitable[Any]]] = None,
+        user_id: Optional[int] = None,
+        download_id: Optional[str] = None
     ) -> Dict[str, Any]:
-        """Download media and return file information"""
+        """Download media and return file information
+
+        user_id gets a fair share of the download bandwidth when BANDWIDTH_LIMIT is set.
+        download_id names the request for cancel_download(); a cancelled request returns
+        CANCELLED_RESULT.
+
+        With client and deliver, large single-stream files may be streamed: bytes are uploaded
+        through client as they arrive and deliver(input_file, info) sends the message. The
+        result then has delivered=True instead of a file_path.
+        """
+        
+        download_id = download_id or f"{platform}_{hash(url)}_{datetime.now().timestamp()}"
         
-        download_id = f"{platform}_{hash(url)}_{datetime.now().timestamp()}"
+        # Run in a task of its own so cancel_download() stops only this request
+        task = asyncio.create_task(self._download_request(
+            download_id, url, platform, quality, progress_callback, client, deliver, user_id
+        ))
+        
+        # Mark as active
+        self.active_downloads[download_id] = {
+            'url': url,
+            'platform': platform,
+            'quality': quality,
+            'user_id': user_id,
+            'started_at': datetime.now(),
+            'job_id': None,
+            'task': task,
+            'cancelled': False
+        }
         
         try:
-            # Check if already downloading
-            if download_id in self.active_downloads:
-                return {'success': False, 'error': 'Already downloading'}
+            return await task
+        except asyncio.CancelledError:
+            if not self.active_downloads[download_id]['cancelled']:
+                task.cancel()
+                raise
+            logger.info(f"Download request {download_id} cancelled")
+            return dict(CANCELLED_RESULT)
+        finally:
+            # Remove from active downloads
+            self.active_downloads.pop(download_id, None)
+    
+    async def _download_request(
+        self,
+        download_id: str,
+        url: str,
+        platform: str,
+        quality: str,
+        progress_callback: Optional[Callable],
+        client: Optional[TelegramClient],
+        deliver: Optional[Callable[[Any, Dict[str, Any]], Awaitable[Any]]],
+        user_id: Optional[int]
+    ) -> Dict[str, Any]:
+        """Admit, then join or start the shared download of one request"""
+        try:
+            if platform != 'youtube':
+                return {'success': False, 'error': f'Platform {platform} not supported. Only YouTube is supported.'}
             
-            # Mark as active
-            self.active_downloads[download_id] = {
-                'url': url,
-                'platform': platform,
-                'quality': quality,
-                'started_at': datetime.now()
-            }
+            # Resolve the exact stream first so identical requests share one download
+            metadata = await fetch_video_metadata(url)
+            
+            # Decide from size, duration and load whether this can be delivered at all
+            decision = self.admission.evaluate(metadata, quality)
+            if decision['action'] == 'reject':
+                if decision['reason'] == 'no_stream':
+                    return {'success': False, 'error': f'No stream available for quality: {quality}'}
+                return dict(decision, success=False, error=decision['reason'], rejected=True)
             
-            # Create progress hook
-            progress_hook = ProgressHook(progress_callback)
+            format_id = decision['format_id']
+            if progress_callback:
+                await progress_callback({
+                    'status': 'admitted',
+                    'quality': decision['quality'],
+                    'downgraded': decision['action'] == 'downgrade',
+                    'size': decision['size'],
+                    'eta': decision['eta']
+                })
             
-            # Download the media
-            result = await self._download_media(
-                url, platform, quality, progress_hook
+            stream_to = (client, deliver) if client and deliver and self._can_stream(metadata, format_id) else None
+            self.active_downloads[download_id]['job_id'] = f"{metadata['video_id']}_{format_id}"
+            result = await self._join_flight(
+                (metadata['video_id'], format_id), url, progress_callback, stream_to,
+                user_id=user_id, small=self.is_small_job(metadata, decision['size']), download_id=download_id
             )
+            # The file may be of a lower quality than requested; the format is what the file cache keys on
+            result = dict(result, quality=decision['quality'], format_id=format_id)
             
-            if result['success']:
+            if result['success'] and not result.get('delivered'):
                 # Notify upload start
                 if progress_callback:
                     await progress_callback({'status': 'uploading'})
@@ -292,68 +1611,364 @@ class DownloadService:
         except Exception as e:
             logger.error(f"Download service error: {e}")
             return {'success': False, 'error': str(e)}
+    
+    async def cache_formats(self, url: str, quality: str) -> List[str]:
+        """Format IDs whose cached upload answers a request: the exact one, then what admission would deliver now"""
+        metadata = await fetch_video_metadata(url)
+        formats = []
+        for format_id in (select_stream_format(metadata, quality),
+                          self.admission.evaluate(metadata, quality, count=False).get('format_id')):
+            if format_id and format_id not in formats:
+                formats.append(format_id)
+        return formats
+    
+    def cancel_download(self, download_id: str) -> bool:
+        """Withdraw one request; its shared job stops too when nobody else is waiting for it"""
+        entry = self.active_downloads.get(download_id)
+        if not entry or entry['task'].done():
+            return False
+        entry['cancelled'] = True
+        entry['task'].cancel()
+        return True
+    
+    def cancel_job(self, job_id: str) -> bool:
+        """Stop a queued or running job for every request waiting on it (admin)"""
+        cancelled = self.scheduler.cancel(job_id)
+        if cancelled:
+            logger.info(f"Download job {job_id} cancelled")
+        return cancelled
+    
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        """Queued and running jobs with the users waiting on them"""
+        now = time.monotonic()
+        users: Dict[str, List[Any]] = {}
+        for entry in self.active_downloads.values():
+            if entry['job_id']:
+                users.setdefault(entry['job_id'], []).append(entry['user_id'])
+        
+        jobs = []
+        for state, job_list in (('running', list(self.scheduler.running.values())), ('queued', list(self.scheduler.pending))):
+            for job in job_list:
+                jobs.append({
+                    'job_id': job.job_id,
+                    'state': state,
+                    'seconds': int(now - (job.started_at or job.enqueued_at)),
+                    'users': users.get(job.job_id, [])
+                })
+        return jobs
+    
+    async def _join_flight(
+        self,
+        key: Tuple[str, str],
+        url: str,
+        progress_callback: Optional[Callable] = None,
+        stream_to: Optional[Tuple[TelegramClient, Callable]] = None,
+        speculative: bool = False,
+        user_id: Optional[int] = None,
+        small: bool = False,
+        download_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Wait for the download of (video ID, format ID), starting it if nobody else has"""
+        ready = self.ready_files.pop(key, None)
+        if ready and os.path.exists(ready['file_path']):
+            # A prefetch already has it; its file reference passes to this caller
+            logger.info(f"Serving prefetched download {key[0]} (format {key[1]})")
+            return ready
+        
+        flight = self.inflight_downloads.get(key)
+        leader = flight is None
+        
+        if leader:
+            flight = {
+                'waiters': 0,
+                'subscribers': [],
+                # (download ID, deliver) of the requests a streamed upload may be sent to, leader first
+                'recipients': [],
+                'delivered_to': None,
+                'last_progress': None,
+                'speculative': speculative,
+                # Bandwidth is shaped as the leader's
+                'user_id': user_id,
+                'small': small
+            }
+            flight['task'] = asyncio.create_task(self._run_flight(key, flight, url, stream_to))
+            self.inflight_downloads[key] = flight
+        else:
+            self.shared_downloads += 1
+            # A real request makes a speculative download worth keeping
+            flight['speculative'] = flight['speculative'] and speculative
+            logger.info(f"Joining in-flight download {key[0]} (format {key[1]})")
+            if progress_callback and flight['last_progress']:
+                await progress_callback(flight['last_progress'])
         
+        flight['waiters'] += 1
+        if progress_callback:
+            flight['subscribers'].append(progress_callback)
+        recipient = (download_id, stream_to[1]) if stream_to and download_id else None
+        if recipient:
+            flight['recipients'].append(recipient)
+        
+        try:
+            # Shielded so one user leaving does not cancel everybody's download
+            result = await asyncio.shield(flight['task'])
+        except asyncio.CancelledError:
+            if flight['task'].done():
+                result = flight['task'].result()
+                if result.get('file_path'):
+                    self.release_file(result['file_path'])
+            else:
+                flight['waiters'] -= 1
+                if progress_callback in flight['subscribers']:
+                    flight['subscribers'].remove(progress_callback)
+                if recipient in flight['recipients']:
+                    flight['recipients'].remove(recipient)
+                if flight['waiters'] <= 0:
+                    # Nobody wants the file any more: free the worker slot, bandwidth and disk now
+                    self.scheduler.cancel(f"{key[0]}_{key[1]}")
+            raise
+        
+        if result.get('streamed'):
+            # Only one chat got the streamed message; the others resend its document
+            result = dict(result, delivered=download_id is not None and flight['delivered_to'] == download_id)
+        return result
+    
+    async def _run_flight(
+        self,
+        key: Tuple[str, str],
+        flight: Dict[str, Any],
+        url: str,
+        stream_to: Optional[Tuple[TelegramClient, Callable]] = None
+    ) -> Dict[str, Any]:
+        """Run one shared download and hand the file to every waiter"""
+        video_id, format_id = key
+        job_id = f"{video_id}_{format_id}"
+        
+        async def deliver(input_file, info):
+            # The leader may have cancelled while the upload ran; send to a request still waiting
+            for download_id, send in list(flight['recipients']):
+                entry = self.active_downloads.get(download_id)
+                if entry and not entry['cancelled']:
+                    flight['delivered_to'] = download_id
+                    return await send(input_file, info)
+            logger.info(f"Streamed upload of {job_id} has no requester left to deliver to")
+            return None
+        
+        async def run_download():
+            started = time.monotonic()
+            with bandwidth_shaper.shaping(flight['user_id'], flight['small']):
+                if stream_to:
+                    result = await self._stream_media(url, format_id, job_id, stream_to[0], deliver)
+                else:
+                    result = await self._download_media(url, format_id, job_id)
+            if result.get('success'):
+                self.admission.record(result['file_size'], time.monotonic() - started)
+            return result
+        
+        async def broadcast(progress_data):
+            flight['last_progress'] = progress_data
+            for callback in list(flight['subscribers']):
+                try:
+                    await callback(progress_data)
+                except Exception as e:
+                    logger.error(f"Error in progress subscriber: {e}")
+        
+        # Byte progress arrives through the bus, throttled; queue updates come from the scheduler
+        progress_bus.subscribe(job_id, broadcast)
+        
+        result = {'success': False, 'error': 'Download did not run'}
+        try:
+            result = await self.scheduler.submit(job_id, run_download, broadcast)
+        except QueueFullError as e:
+            logger.warning(f"Rejected download {video_id} (format {format_id}): queue full")
+            result = {'success': False, 'error': 'queue_full', 'queue_full': True, 'retry_after': e.retry_after}
+        except Exception as e:
+            logger.error(f"Shared download {video_id} (format {format_id}) failed: {e}")
+            result = {'success': False, 'error': str(e)}
         finally:
-            # Remove from active downloads
-            if download_id in self.active_downloads:
-                del self.active_downloads[download_id]
+            # Nobody can join from here on, so the waiter count is final
+            self.inflight_downloads.pop(key, None)
+            if result.get('file_path'):
+                self.storage.set_refs(result['file_path'], flight['waiters'])
+            await progress_bus.close(job_id)
+        
+        return result
     
-
+    async def prefetch(
+        self,
+        url: str,
+        key: Tuple[str, str],
+        user_id: Optional[int] = None,
+        small: bool = False
+    ) -> Dict[str, Any]:
+        """Download a format before anybody asked for it and keep the file for the first request"""
+        result = await self._join_flight(key, url, speculative=True, user_id=user_id, small=small)
+        if result.get('file_path'):
+            self.ready_files[key] = result
+            asyncio.get_running_loop().call_later(
+                DOWNLOAD_CONFIG['prefetch_ttl'], self._expire_ready_file, key, result['file_path']
+            )
+        return result
     
-    async def _download_media(
+    def cancel_prefetch(self, key: Tuple[str, str]) -> bool:
+        """Stop a speculative download nobody else is waiting for, or drop its unclaimed file"""
+        ready = self.ready_files.pop(key, None)
+        if ready:
+            self.release_file(ready['file_path'])
+            return True
+        
+        flight = self.inflight_downloads.get(key)
+        if flight and flight['speculative']:
+            return self.scheduler.cancel(f"{key[0]}_{key[1]}")
+        return False
+    
+    def _expire_ready_file(self, key: Tuple[str, str], file_path: str):
+        """Release a prefetched file nobody asked for in time"""
+        ready = self.ready_files.get(key)
+        if ready and ready['file_path'] == file_path:
+            del self.ready_files[key]
+            self.release_file(file_path)
+    
+    def release_file(self, file_path: str, count: int = 1):
+        """Drop a reference to a downloaded file, deleting it once nobody needs it"""
+        self.storage.release(file_path, count)
+    
+    async def cleanup_temp_files(self) -> int:
+        """Delete every kept partial download and any leaked file past its age limit"""
+        return self.storage.sweep(partial_age=0)
+    
+    @staticmethod
+    def is_small_job(metadata: Dict[str, Any], size: int) -> bool:
+        """Audio, shorts and other small files ride the reserved bandwidth lane"""
+        return size <= DOWNLOAD_CONFIG['small_job_size'] or (metadata['length'] or 0) <= DOWNLOAD_CONFIG['small_job_duration']
+    
+    @staticmethod
+    def _can_stream(metadata: Dict[str, Any], format_id: str) -> bool:
+        """Whether a format can go straight from the source into a Telegram upload"""
+        if not DOWNLOAD_CONFIG['streaming_upload'] or '+' in format_id:
+            # Adaptive formats need both files on disk for ffmpeg
+            return False
+        stream_info = next((s for s in metadata['streams'] if str(s['itag']) == format_id), None)
+        return bool(stream_info) and BIG_FILE_THRESHOLD < (stream_info['filesize'] or 0) <= DOWNLOAD_CONFIG['max_file_size']
+    
+    async def _stream_media(
         self,
         url: str,
-        platform: str,
-        quality: str,
-        progress_hook: ProgressHook
+        format_id: str,
+        job_id: str,
+        client: TelegramClient,
+        deliver: Callable[[Any, Dict[str, Any]], Awaitable[Any]]
     ) -> Dict[str, Any]:
-        """Download media using pytube for YouTube"""
+        """Upload a stream to Telegram while it downloads, then deliver it; falls back to a file download"""
+        logger.info(f"Streaming {url} (format {format_id}) straight to Telegram")
         
-        if platform != 'youtube':
-            return {'success': False, 'error': f'Platform {platform} not supported. Only YouTube is supported.'}
+        reservation: Optional[Reservation] = None
+        try:
+            metadata = await fetch_video_metadata(url)
+            stream = await run_pytube('streams', metadata['yt'].streams.get_by_itag, int(format_id))
+            if not stream:
+                return {'success': False, 'error': f'Stream {format_id} is no longer available'}
+            
+            filesize = stream.filesize
+            stream_url = await run_pytube('streams', resolve_stream_url, stream)
+            # The upload buffer may spill the whole file to disk if Telegram falls behind
+            reservation = await self.storage.reserve(filesize)
+            
+            def on_progress(done: int, total: int):
+                progress_bus.report(job_id, done, total)
+            
+            input_file = await stream_upload(
+                client,
+                lambda write: segmented_downloader.stream(
+                    stream_url, filesize, write, on_progress,
+                    lambda: refresh_stream_url(metadata['video_id'], stream.itag)
+                ),
+                filesize,
+                stream.default_filename
+            )
+        except StorageFullError as e:
+            logger.warning(f"Streaming upload of {format_id} rejected: {e}")
+            return {'success': False, 'error': str(e)}
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            logger.warning(f"Streaming upload of {format_id} failed ({e}), falling back to a file download")
+            # Metadata or URL resolution can fail before anything was reserved
+            if reservation:
+                self.storage.discard(reservation)
+                reservation = None
+            return await self._download_media(url, format_id, job_id)
+        finally:
+            if reservation:
+                self.storage.discard(reservation)
+        
+        info = build_download_result(metadata, stream.itag, None, filesize)
+        info.update({'file_name': stream.default_filename, 'mime_type': stream.mime_type})
+        
+        message = await deliver(input_file, info)
+        info.update({
+            'streamed': True,
+            'message': message,
+            'document': get_input_document(message.document) if getattr(message, 'document', None) else None
+        })
+        return info
+    
+    async def _download_media(
+        self,
+        url: str,
+        format_id: str,
+        job_id: str
+    ) -> Dict[str, Any]:
+        """Download a YouTube format (one stream, or video+audio to mux) using pytube"""
         
-        logger.info(f"Using pytube downloader for URL: {url}")
+        logger.info(f"Using pytube downloader for URL: {url} (format {format_id})")
         
-        temp_download_dir = Path(tempfile.mkdtemp(dir=self.temp_dir))
+        reservation: Optional[Reservation] = None
+        completed = False
         
         try:
-            # Create progress callback
-            progress_handler = PytubeProgressCallback(progress_hook.callback if hasattr(progress_hook, 'callback') else None)
+            # Reuse the cached YouTube object instead of fetching the watch page again
+            metadata = await fetch_video_metadata(url)
+            yt = metadata['yt']
             
-            # Initialize YouTube object
-            yt = YouTube(url, on_progress_callback=progress_handler, client='WEB')
+            streams = []
+            for itag in format_id.split('+'):
+                stream = await run_pytube('streams', yt.streams.get_by_itag, int(itag))
+                if not stream:
+                    return {'success': False, 'error': f'Stream {itag} is no longer available'}
+                streams.append(stream)
             
-            # Get stream based on quality
-            stream = self._get_stream_by_quality(yt, quality)
-            if not stream:
-                return {'success': False, 'error': f'No stream available for quality: {quality}'}
+            # Byte progress of every part goes to the job's progress bus entry
+            total_size = sum(stream.filesize or 0 for stream in streams)
+            progress_handler = progress_bus.pytube_listener(job_id, total_size)
             
-            # Set filesize for progress calculation
-            progress_handler.set_filesize(stream.filesize)
+            # Muxing needs the two parts and the output on disk at the same time
+            reservation = await self.storage.reserve(total_size * len(streams))
             
-            # Download the video
-            file_path = Path(stream.download(output_path=str(temp_download_dir)))
+            # Download the video (and its audio track for adaptive formats)
+            if len(streams) == 2:
+                file_path = await download_adaptive(metadata, streams[0], streams[1], reservation.path, progress_handler)
+            else:
+                file_path = await download_stream(metadata, streams[0], reservation.path, progress_handler)
+                # Muxed files are written faststart already
+                if await moov_at_end(file_path):
+                    try:
+                        # The remux writes a second copy next to the first for a moment
+                        await self.storage.grow(reservation, file_path.stat().st_size)
+                        file_path = await faststart_remux(file_path)
+                    except StorageFullError as e:
+                        logger.info(f"Skipping faststart remux of {file_path.name}: {e}")
             
             if not file_path.exists():
                 return {'success': False, 'error': 'Download failed: File not found after download'}
             
+            # The flight sets the real reference count once its waiters are known
+            self.storage.commit(reservation, file_path)
             file_size = file_path.stat().st_size
+            completed = True
             
-            # Determine media type
-            media_type = 'video' if stream.includes_video_track else 'audio'
-            
-            return {
-                'success': True,
-                'file_path': str(file_path),
-                'file_size': file_size,
-                'media_type': media_type,
-                'title': yt.title,
-                'uploader': yt.author,
-                'duration': yt.length,
-                'width': int(stream.resolution.split('x')[0]) if stream.resolution else 0,
-                'height': int(stream.resolution.split('x')[1]) if stream.resolution else 0
-            }
-                
+            return build_download_result(metadata, streams[0].itag, file_path, file_size)
+        
+        except StorageFullError as e:
+            logger.warning(f"Download of {url} (format {format_id}) rejected: {e}")
+            return {'success': False, 'error': str(e)}
         except Exception as e:
             logger.error(f"Pytube error: {e}")
             return {'success': False, 'error': f'Pytube error: {str(e)}'}
@@ -362,32 +1977,9 @@ class DownloadService:
             return {'success': False, 'error': str(e)}
         
         finally:
-            # Schedule cleanup
-            asyncio.create_task(self._cleanup_temp_dir(temp_download_dir))
-    
-    def _get_stream_by_quality(self, yt: YouTube, quality: str) -> Optional[Stream]:
-        """Get the best stream based on quality preference"""
-        try:
-            if quality == 'highest':
-                return yt.streams.get_highest_resolution()
-            elif quality == 'lowest':
-                return yt.streams.get_lowest_resolution()
-            elif quality == 'audio':
-                return yt.streams.filter(only_audio=True).first()
-            elif quality in ['720p', '480p', '360p', '240p', '144p']:
-                # Try to get specific resolution
-                stream = yt.streams.filter(res=quality, file_extension='mp4').first()
-                if stream:
-                    return stream
-                # Fallback to best available
-                return yt.streams.get_highest_resolution()
-            else:
-                return yt.streams.get_highest_resolution()
-        except Exception as e:
-            logger.error(f"Error getting stream: {e}")
-            return yt.streams.first()  # Return any available stream as fallback
-    
-
+            # Finished files are removed by release_file() once every waiter is done with them
+            if reservation and not completed:
+                self.storage.discard(reservation)
     
     def _get_platform(self, url: str) -> str:
         """Determine platform from URL"""
@@ -431,36 +2023,33 @@ class DownloadService:
             logger.info(f"Using pytube to extract info for URL: {url}")
             
             try:
-                # Initialize YouTube object with cookies and po_token
-                yt = YouTube(url, use_po_token=True, cookies='cookies.txt')
-                
-                # Get available streams
-                streams = yt.streams.all()
-                formats = []
+                metadata = await fetch_video_metadata(url)
                 
-                for stream in streams:
-                    format_info = {
-                        'format_id': stream.itag,
-                        'ext': stream.mime_type.split('/')[-1] if stream.mime_type else 'mp4',
-                        'resolution': stream.resolution,
-                        'fps': stream.fps,
-                        'filesize': stream.filesize,
-                        'abr': stream.abr,
-                        'vcodec': stream.video_codec,
-                        'acodec': stream.audio_codec,
-                        'format_note': f"{stream.type} - {stream.mime_type}"
+                formats = [
+                    {
+                        'format_id': stream['itag'],
+                        'ext': stream['mime_type'].split('/')[-1] if stream['mime_type'] else 'mp4',
+                        'resolution': stream['resolution'],
+                        'height': stream['height'],
+                        'fps': stream['fps'],
+                        'filesize': stream['filesize'],
+                        'abr': stream['abr'],
+                        'vcodec': stream['video_codec'],
+                        'acodec': stream['audio_codec'],
+                        'format_note': f"{stream['type']} - {stream['mime_type']}"
                     }
-                    formats.append(format_info)
+                    for stream in metadata['streams']
+                ]
                 
                 return {
                     'success': True,
-                    'title': yt.title,
-                    'uploader': yt.author,
-                    'duration': yt.length,
-                    'thumbnail': yt.thumbnail_url,
+                    'title': metadata['title'],
+                    'uploader': metadata['author'],
+                    'duration': metadata['length'],
+                    'thumbnail': metadata['thumbnail'],
                     'platform': platform,
                     'formats': formats,
-                    'filesize': yt.streams.get_highest_resolution().filesize if yt.streams.get_highest_resolution() else 0
+                    'filesize': self._best_progressive_filesize(metadata)
                 }
                 
             except Exception as e:
@@ -474,6 +2063,14 @@ class DownloadService:
             logger.error(f"Error getting download info: {e}")
             return {'success': False, 'error': str(e)}
     
+    @staticmethod
+    def _best_progressive_filesize(metadata: Dict[str, Any]) -> int:
+        """Size of the highest resolution progressive stream in cached metadata"""
+        progressive = [s for s in metadata['streams'] if s['is_progressive']]
+        if not progressive:
+            return 0
+        return max(progressive, key=lambda s: s['height'])['filesize']
+    
     async def extract_info(self, url: str) -> Dict[str, Any]:
         """Extract information about a video without downloading"""
         try:
@@ -485,17 +2082,16 @@ class DownloadService:
             
             # Use pytube for YouTube
             try:
-                yt = YouTube(url, use_po_token=True, cookies='cookies.txt')
-                stream = yt.streams.get_highest_resolution()
+                metadata = await fetch_video_metadata(url)
                 
                 return {
                     'success': True,
-                    'title': yt.title,
-                    'uploader': yt.author,
-                    'duration': yt.length,
-                    'thumbnail': yt.thumbnail_url,
+                    'title': metadata['title'],
+                    'uploader': metadata['author'],
+                    'duration': metadata['length'],
+                    'thumbnail': metadata['thumbnail'],
                     'platform': platform,
-                    'filesize': stream.filesize if stream else 0
+                    'filesize': self._best_progressive_filesize(metadata)
                 }
             except Exception as e:
                 logger.error(f"Pytube info extraction error: {e}")
@@ -504,43 +2100,3 @@ class DownloadService:
         except Exception as e:
             logger.error(f"Info extraction error: {e}")
             return {'success': False, 'error': str(e)}
-    
-    async def _cleanup_temp_dir(self, temp_dir: Path):
-        """Clean up temporary directory after download"""
-        try:
-            # Wait for a while to ensure file operations are complete
-            await asyncio.sleep(60)
-            if temp_dir.exists():
-                shutil.rmtree(temp_dir, ignore_errors=True)
-        except Exception as e:
-            logger.error(f"Error cleaning up temp dir: {e}")
-    
-    async def _cleanup_old_files(self):
-        """Clean up old temporary files"""
-        try:
-            while True:
-                # Run cleanup every hour
-                await asyncio.sleep(3600)
-                
-                # Find and delete files older than 24 hours
-                now = datetime.now()
-                cutoff = now - timedelta(hours=24)
-                
-                for item in self.temp_dir.glob('*'):
-                    try:
-                        # Get item modification time
-                        mtime = datetime.fromtimestamp(item.stat().st_mtime)
-                        
-                        # Delete if older than cutoff
-                        if mtime < cutoff:
-                            if item.is_dir():
-                                shutil.rmtree(item, ignore_errors=True)
-                            else:
-                                item.unlink()
-                            
-                            logger.info(f"Cleaned up old temp file: {item}")
-                    except Exception as e:
-                        logger.error(f"Error cleaning up {item}: {e}")
-        
-        except Exception as e:
-            logger.error(f"Error in cleanup task: {e}")
\ No newline at end of file
@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from config import DOWNLOAD_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class FFmpegPool:
+    """Runs ffmpeg/ffprobe as async subprocesses, at most `workers` at a time"""
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.running = 0
+
+    async def run(self, *args: str, timeout: Optional[float] = None) -> Tuple[int, bytes, bytes]:
+        """Run a command and return (returncode, stdout, stderr)"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+
+        async with self._semaphore:
+            self.running += 1
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+            except BaseException:
+                # Timed out or cancelled: do not leave ffmpeg running in the background
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+            finally:
+                self.running -= 1
+
+        return process.returncode, stdout, stderr
+
+
+ffmpeg_pool = FFmpegPool(DOWNLOAD_CONFIG['ffmpeg_workers'])
+# Probes are short; keep them from queueing behind long muxes
+probe_pool = FFmpegPool(DOWNLOAD_CONFIG['probe_workers'])
+
+# Bytes read from each end of a file for its cache fingerprint
+FINGERPRINT_CHUNK = 64 * 1024
+
+
+def ffmpeg_available() -> bool:
+    """Check whether ffmpeg is installed"""
+    return shutil.which('ffmpeg') is not None
+
+
+async def mux_streams(video_path: Path, audio_path: Path, output_path: Path) -> Path:
+    """Combine a video-only and an audio-only file by stream copy (no re-encode)"""
+    returncode, _, stderr = await ffmpeg_pool.run(
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-i', str(video_path), '-i', str(audio_path),
+        '-map', '0:v:0', '-map', '1:a:0',
+        '-c', 'copy',
+        # Write the moov atom first so Telegram can play the video while it loads
+        '-movflags', '+faststart',
+        str(output_path),
+        timeout=DOWNLOAD_CONFIG['mux_timeout']
+    )
+
+    if returncode != 0 or not output_path.exists():
+        raise RuntimeError(f"ffmpeg mux failed: {stderr.decode(errors='ignore').strip()[-500:]}")
+
+    logger.debug(f"Muxed {video_path.name} + {audio_path.name} -> {output_path.name}")
+    return output_path
+
+
+def _fingerprint(path: Path) -> str:
+    """Cheap content hash: size plus the first and last chunk, where containers keep their headers"""
+    size = path.stat().st_size
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(FINGERPRINT_CHUNK, size - FINGERPRINT_CHUNK))
+            digest.update(f.read(FINGERPRINT_CHUNK))
+    return digest.hexdigest()
+
+
+def find_moov(path: Path) -> Optional[Dict[str, int]]:
+    """Offsets of the top-level moov and mdat atoms of an MP4/MOV file, or None if it is not one"""
+    offsets: Dict[str, int] = {}
+    size = path.stat().st_size
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset + 8 <= size and len(offsets) < 2:
+            f.seek(offset)
+            header = f.read(16)
+            atom_size, atom_type = struct.unpack('>I4s', header[:8])
+            if atom_size == 1:
+                # 64-bit size follows the type
+                atom_size = struct.unpack('>Q', header[8:16])[0]
+            elif atom_size == 0:
+                # Atom runs to the end of the file
+                atom_size = size - offset
+            if atom_size < 8:
+                break
+            name = atom_type.decode('latin-1')
+            if offset == 0 and name != 'ftyp':
+                return None
+            if name in ('moov', 'mdat'):
+                offsets.setdefault(name, offset)
+            offset += atom_size
+    return offsets if 'moov' in offsets else None
+
+
+async def moov_at_end(path: Path) -> bool:
+    """Whether path is an mp4 whose moov atom follows its media data and a faststart remux may run"""
+    if not DOWNLOAD_CONFIG['faststart'] or not ffmpeg_available():
+        return False
+    try:
+        atoms = await asyncio.get_running_loop().run_in_executor(None, find_moov, path)
+    except (OSError, struct.error) as e:
+        logger.debug(f"Could not read atoms of {path.name}: {e}")
+        return False
+    return bool(atoms) and 'mdat' in atoms and atoms['moov'] > atoms['mdat']
+
+
+async def faststart_remux(path: Path) -> Path:
+    """Move the moov atom of an mp4 to the front by stream copy; on any failure keep the original"""
+    remuxed = path.with_name(f"{path.stem}.faststart{path.suffix}")
+    try:
+        returncode, _, stderr = await ffmpeg_pool.run(
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-i', str(path),
+            '-map', '0', '-c', 'copy',
+            '-movflags', '+faststart',
+            str(remuxed),
+            timeout=DOWNLOAD_CONFIG['mux_timeout']
+        )
+        if returncode != 0 or not remuxed.exists():
+            raise RuntimeError(stderr.decode(errors='ignore').strip()[-300:])
+        os.replace(remuxed, path)
+    except asyncio.CancelledError:
+        remuxed.unlink(missing_ok=True)
+        raise
+    except Exception as e:
+        # Faststart is an optimization: the original still plays, just not before it is fully downloaded
+        remuxed.unlink(missing_ok=True)
+        logger.warning(f"Faststart remux of {path.name} failed: {e!r}")
+        return path
+
+    logger.debug(f"Moved moov atom of {path.name} to the front")
+    return path
+
+
+class MediaProber:
+    """ffprobe results per file content, probed once and cached
+
+    Duration, dimensions and codecs come from one async ffprobe call in a bounded pool; the
+    moov position is read from the atom headers directly. Results are keyed by a content
+    fingerprint, so the same file served again (a shared download, a prefetch) is free.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def probe(self, path: Path) -> Dict[str, Any]:
+        """Media facts of path; missing values are None rather than guesses"""
+        path = Path(path)
+        loop = asyncio.get_running_loop()
+        key = await loop.run_in_executor(None, _fingerprint, path)
+        info = self._cache.get(key)
+        if info is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return info
+
+        self.misses += 1
+        info = await self._ffprobe(path)
+        try:
+            atoms = await loop.run_in_executor(None, find_moov, path)
+        except (OSError, struct.error) as e:
+            logger.debug(f"Could not read atoms of {path.name}: {e}")
+            atoms = None
+        info['moov_at_end'] = atoms['moov'] > atoms['mdat'] if atoms and 'mdat' in atoms else None
+
+        if info['video_codec'] is None and info['audio_codec'] is None:
+            # ffprobe failed; try again next time instead of remembering the failure
+            return info
+        self._cache[key] = info
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return info
+
+    @staticmethod
+    async def _ffprobe(path: Path) -> Dict[str, Any]:
+        """Read duration, dimensions and codecs with ffprobe"""
+        info: Dict[str, Any] = {
+            'duration': None, 'width': None, 'height': None, 'video_codec': None, 'audio_codec': None
+        }
+        try:
+            returncode, stdout, stderr = await probe_pool.run(
+                'ffprobe', '-v', 'error', '-print_format', 'json',
+                '-show_format', '-show_streams', str(path),
+                timeout=DOWNLOAD_CONFIG['probe_timeout']
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"ffprobe of {path.name} failed: {e}")
+            return info
+        if returncode != 0:
+            logger.warning(f"ffprobe of {path.name} failed: {stderr.decode(errors='ignore').strip()[-300:]}")
+            return info
+
+        data = json.loads(stdout or b'{}')
+        duration = data.get('format', {}).get('duration')
+        if duration:
+            info['duration'] = float(duration)
+
+        for stream in data.get('streams', []):
+            codec_type = stream.get('codec_type')
+            if codec_type == 'video' and info['video_codec'] is None:
+                if (stream.get('disposition') or {}).get('attached_pic'):
+                    # Cover art in audio files is not the video track
+                    continue
+                info['video_codec'] = stream.get('codec_name')
+                width, height = stream.get('width'), stream.get('height')
+                rotation = int((stream.get('tags') or {}).get('rotate', 0) or 0)
+                for side_data in stream.get('side_data_list') or []:
+                    rotation = int(side_data.get('rotation', rotation) or 0)
+                if abs(rotation) % 180 == 90:
+                    # Phone footage is stored sideways and played rotated
+                    width, height = height, width
+                info['width'], info['height'] = width, height
+            elif codec_type == 'audio' and info['audio_codec'] is None:
+                info['audio_codec'] = stream.get('codec_name')
+        return info
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get probe cache statistics"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._cache),
+            'hits': self.hits,
+            'hit_rate': round(self.hits / total * 100, 1) if total else 0.0
+        }
+
+
+media_prober = MediaProber(DOWNLOAD_CONFIG['probe_cache_size'])
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+from telethon.errors import FloodWaitError, MessageNotModifiedError
+
+from config import DOWNLOAD_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class _Outgoing:
+    """One queued API call and everyone waiting for it"""
+
+    __slots__ = ('key', 'chat_id', 'call', 'futures')
+
+    def __init__(self, key: Hashable, chat_id: Any, call: Callable[[], Awaitable[Any]]):
+        self.key = key
+        self.chat_id = chat_id
+        self.call = call
+        self.futures: List[asyncio.Future] = []
+
+
+def _retrieve(future: asyncio.Future):
+    """Mark a failure as seen so fire-and-forget edits do not log 'exception never retrieved'"""
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    """Single exit for the bot's messages and edits, paced under Telegram's flood limits
+
+    Edits of the same message are coalesced: a newer text replaces the queued one in place, so
+    a progress message costs one call per pacing slot however often it changes. Calls are
+    spaced per chat and globally, and a FloodWait holds back only the chat that received it.
+    """
+
+    def __init__(self, rate: float, chat_interval: float, group_interval: float):
+        # Calls per second over all chats
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self._queue: 'OrderedDict[Hashable, _Outgoing]' = OrderedDict()
+        # Chat ID -> monotonic time its next call may go out
+        self._chat_ready: Dict[Any, float] = {}
+        self._global_ready = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        # Calls in progress; the loop keeps only weak references to tasks
+        self._running: Set[asyncio.Task] = set()
+        self._sequence = 0
+        self.calls = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+
+    def _bind(self):
+        """Start the dispatcher on the running loop"""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch_loop())
+
+    def _submit(self, key: Hashable, chat_id: Any, call: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        self._bind()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_retrieve)
+        entry = self._queue.get(key)
+        if entry is None:
+            entry = self._queue[key] = _Outgoing(key, chat_id, call)
+        else:
+            # Keep the queue position, send only the latest content
+            entry.call = call
+            self.coalesced += 1
+        entry.futures.append(future)
+        self._wakeup.set()
+        return future
+
+    def edit(self, message, text: str, **kwargs) -> asyncio.Future:
+        """Queue message.edit(text, **kwargs); await the result only when the edit must have landed"""
+        return self._submit(
+            ('edit', message.chat_id, message.id), message.chat_id, lambda: message.edit(text, **kwargs)
+        )
+
+    def send(self, client, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Queue client.send_message(chat_id, text, **kwargs); sends are never coalesced"""
+        self._sequence += 1
+        return self._submit(
+            ('send', self._sequence), chat_id, lambda: client.send_message(chat_id, text, **kwargs)
+        )
+
+    def _interval(self, chat_id: Any) -> float:
+        # Groups and channels have a much lower limit than private chats
+        if isinstance(chat_id, int) and chat_id < 0:
+            return self.group_interval
+        return self.chat_interval
+
+    async def _dispatch_loop(self):
+        """Start the oldest call whose chat and the global budget allow it"""
+        while True:
+            now = time.monotonic()
+            entry = None
+            next_ready = None
+            for candidate in self._queue.values():
+                ready = self._chat_ready.get(candidate.chat_id, 0.0)
+                if ready <= now:
+                    entry = candidate
+                    break
+                next_ready = ready if next_ready is None else min(next_ready, ready)
+
+            if entry is not None and self._global_ready > now:
+                next_ready, entry = self._global_ready, None
+            if entry is None:
+                if not self._queue:
+                    # Forget chats whose pacing slot has passed
+                    self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+                self._wakeup.clear()
+                timeout = max(0.0, next_ready - now) if next_ready is not None else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            del self._queue[entry.key]
+            self._chat_ready[entry.chat_id] = now + self._interval(entry.chat_id)
+            self._global_ready = max(self._global_ready, now) + 1 / self.rate
+            task = asyncio.create_task(self._run(entry))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, entry: _Outgoing):
+        """Make one call and settle its waiters, requeueing it after a FloodWait"""
+        self.calls += 1
+        try:
+            result = await entry.call()
+        except MessageNotModifiedError:
+            result = None
+        except FloodWaitError as e:
+            self.flood_waits += 1
+            logger.warning(f"FloodWait of {e.seconds}s for chat {entry.chat_id}, holding its messages back")
+            self._chat_ready[entry.chat_id] = time.monotonic() + e.seconds
+            newer = self._queue.get(entry.key)
+            if newer is not None:
+                # A newer edit of the same message arrived meanwhile; it answers these waiters too
+                newer.futures[:0] = entry.futures
+            else:
+                self._queue[entry.key] = entry
+                self._queue.move_to_end(entry.key, last=False)
+            self._wakeup.set()
+            return
+        except Exception as e:
+            logger.debug(f"Outgoing call to chat {entry.chat_id} failed: {e}")
+            for future in entry.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future in entry.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get outbound traffic statistics"""
+        now = time.monotonic()
+        return {
+            'queued': len(self._queue),
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'flood_waits': self.flood_waits,
+            'held_chats': sum(1 for ready in self._chat_ready.values() if ready - now > self.group_interval)
+        }
+
+
+outbox = Outbox(
+    DOWNLOAD_CONFIG['outbox_rate'], DOWNLOAD_CONFIG['outbox_chat_interval'], DOWNLOAD_CONFIG['outbox_group_interval']
+)
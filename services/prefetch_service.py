@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from config import DOWNLOAD_CONFIG
+from services.download_service import DownloadService, fetch_video_metadata
+from utils.database import Database
+
+logger = logging.getLogger(__name__)
+
+# How much more a user's own history counts than everybody else's
+USER_HISTORY_WEIGHT = 3.0
+
+
+class SpeculativePrefetcher:
+    """Starts downloading the quality a user will most likely pick while the keyboard is still open"""
+
+    def __init__(self, download_service: DownloadService, db: Database):
+        self.download_service = download_service
+        self.db = db
+        # User ID -> the one speculation running (or parked) for that user
+        self.speculations: Dict[int, Dict[str, Any]] = {}
+        self.consecutive_misses: Dict[int, int] = {}
+        self.cooldowns: Dict[int, float] = {}
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    @staticmethod
+    def predict(history: Dict[str, Dict[str, int]], available: Dict[str, bool]) -> Tuple[Optional[str], float]:
+        """Most likely quality among the offered ones and the share of history behind it"""
+        scores: Dict[str, float] = {}
+        for source, weight in (('global', 1.0), ('user', USER_HISTORY_WEIGHT)):
+            counts = {q: n for q, n in history.get(source, {}).items() if available.get(q) and q != 'thumbnail'}
+            total = sum(counts.values())
+            for quality, n in counts.items():
+                scores[quality] = scores.get(quality, 0.0) + weight * n / total
+
+        if not scores:
+            return None, 0.0
+        best = max(scores, key=scores.get)
+        return best, scores[best] / sum(scores.values())
+
+    def _speculated_bytes(self) -> int:
+        """Bytes of all current speculations, running or parked"""
+        return sum(entry['size'] for entry in self.speculations.values())
+
+    def _prune(self):
+        """Forget speculations whose parked file has expired"""
+        cutoff = time.monotonic() - DOWNLOAD_CONFIG['prefetch_ttl']
+        for user_id in [u for u, e in self.speculations.items() if e['task'].done() and e['started_at'] < cutoff]:
+            del self.speculations[user_id]
+
+    async def start(self, user_id: int, url: str, available: Dict[str, bool]):
+        """Guess the user's pick for url and download it in the background if the budget allows"""
+        if not DOWNLOAD_CONFIG['speculative_prefetch']:
+            return
+
+        try:
+            # A new link replaces whatever we guessed for the previous one
+            self.cancel(user_id)
+            self._prune()
+
+            if time.monotonic() < self.cooldowns.get(user_id, 0):
+                return
+
+            # Speculation only uses idle capacity and never queues in front of real requests
+            scheduler = self.download_service.scheduler
+            running = sum(1 for e in self.speculations.values() if not e['task'].done())
+            if running >= DOWNLOAD_CONFIG['prefetch_max_jobs'] or scheduler.pending or len(scheduler.running) >= scheduler.workers:
+                self.skipped += 1
+                return
+
+            history = await self.db.get_quality_history(user_id, 'youtube')
+            quality, confidence = self.predict(history, available)
+            if quality is None or confidence < DOWNLOAD_CONFIG['prefetch_min_confidence']:
+                return
+
+            metadata = await fetch_video_metadata(url)
+            decision = self.download_service.admission.evaluate(metadata, quality, count=False)
+            if decision.get('format_id') and await self.db.has_cached_file('youtube', metadata['video_id'], decision['format_id']):
+                # The tap will be answered from Telegram's copy anyway
+                return
+
+            size = decision.get('size') or 0
+            if (decision['action'] == 'reject' or not size or size > DOWNLOAD_CONFIG['prefetch_max_size']
+                    or self._speculated_bytes() + size > DOWNLOAD_CONFIG['prefetch_budget']):
+                self.skipped += 1
+                return
+
+            key = (metadata['video_id'], decision['format_id'])
+            self.speculations[user_id] = {
+                'url': url,
+                'quality': quality,
+                'key': key,
+                'size': size,
+                'started_at': time.monotonic(),
+                'task': asyncio.create_task(self._run(
+                    url, key, user_id, self.download_service.is_small_job(metadata, size)
+                ))
+            }
+            self.started += 1
+            logger.info(f"Prefetching {key[0]} (format {key[1]}) for user {user_id}, confidence {confidence:.0%}")
+
+        except Exception as e:
+            logger.debug(f"Speculative prefetch for user {user_id} not started: {e}")
+
+    async def _run(self, url: str, key: Tuple[str, str], user_id: int, small: bool):
+        """Run one speculative download"""
+        result = await self.download_service.prefetch(url, key, user_id, small)
+        if not result.get('success') and not result.get('cancelled'):
+            logger.debug(f"Prefetch of {key[0]} (format {key[1]}) failed: {result.get('error')}")
+
+    async def on_choice(self, user_id: int, url: str, quality: str) -> bool:
+        """Settle the user's speculation once they tap a quality; returns True on a correct guess"""
+        entry = self.speculations.pop(user_id, None)
+        if entry is None:
+            return False
+
+        hit = entry['url'] == url and entry['quality'] == quality
+        if not hit and entry['url'] == url:
+            # Different keys ('hd' and '720p') can resolve to the same format
+            try:
+                metadata = await fetch_video_metadata(url)
+                decision = self.download_service.admission.evaluate(metadata, quality, count=False)
+                hit = (metadata['video_id'], decision.get('format_id')) == entry['key']
+            except Exception as e:
+                logger.debug(f"Could not compare prefetch with the chosen quality: {e}")
+
+        if hit:
+            self.hits += 1
+            self.consecutive_misses[user_id] = 0
+            return True
+
+        self.misses += 1
+        self.download_service.cancel_prefetch(entry['key'])
+        misses = self.consecutive_misses.get(user_id, 0) + 1
+        self.consecutive_misses[user_id] = misses
+        if misses >= DOWNLOAD_CONFIG['prefetch_miss_limit']:
+            # Stop guessing for users whose picks we keep getting wrong
+            self.cooldowns[user_id] = time.monotonic() + DOWNLOAD_CONFIG['prefetch_cooldown']
+            self.consecutive_misses[user_id] = 0
+            logger.info(f"Pausing prefetch for user {user_id} after {misses} wrong guesses")
+        return False
+
+    def cancel(self, user_id: int):
+        """Abandon a user's speculation"""
+        entry = self.speculations.pop(user_id, None)
+        if entry:
+            self.download_service.cancel_prefetch(entry['key'])
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get speculation statistics"""
+        settled = self.hits + self.misses
+        return {
+            'enabled': DOWNLOAD_CONFIG['speculative_prefetch'],
+            'started': self.started,
+            'hits': self.hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+            'hit_rate': round(self.hits / settled * 100, 1) if settled else 0.0,
+            'speculated_bytes': self._speculated_bytes()
+        }
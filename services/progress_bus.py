@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config import DOWNLOAD_CONFIG
+
+logger = logging.getLogger(__name__)
+
+ProgressSubscriber = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class ProgressBus:
+    """Collects download byte counts from any thread and hands subscribers throttled progress events
+
+    Reporters only overwrite the latest (done, total) of their job; the event loop picks the
+    values up with a single call_soon_threadsafe per batch, so a chunk never creates a task.
+    Every `interval` seconds each job that moved gets one event with real speed and ETA.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        # Job ID -> latest (done, total) not yet seen by the loop
+        self._pending: Dict[str, Tuple[int, int]] = {}
+        self._wakeup_scheduled = False
+        # Job ID -> state kept on the loop: done, total, speed, last sample, dirty flag
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._subscribers: Dict[str, List[ProgressSubscriber]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self.coalesced_reports = 0
+
+    def subscribe(self, job_id: str, callback: ProgressSubscriber):
+        """Receive progress events of job_id (call on the event loop)"""
+        self._bind()
+        self._subscribers.setdefault(job_id, []).append(callback)
+
+    def unsubscribe(self, job_id: str, callback: ProgressSubscriber):
+        """Stop receiving progress events of job_id"""
+        callbacks = self._subscribers.get(job_id)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+
+    def _bind(self):
+        """Remember the loop that owns the subscribers and start the flusher"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = self._loop.create_task(self._flush_loop())
+
+    def report(self, job_id: str, done: int, total: int):
+        """Record that job_id has done of total bytes; safe to call from any thread"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        with self._lock:
+            if job_id in self._pending:
+                self.coalesced_reports += 1
+            self._pending[job_id] = (done, total)
+            if self._wakeup_scheduled:
+                return
+            self._wakeup_scheduled = True
+        try:
+            self._loop.call_soon_threadsafe(self._drain)
+        except RuntimeError:
+            # Loop shut down under us
+            pass
+
+    def pytube_listener(self, job_id: str, total: int) -> Callable[[Any, bytes, int], None]:
+        """A pytubefix on_progress callback (stream, chunk, bytes_remaining) reporting to job_id"""
+        def on_progress(stream, chunk, bytes_remaining):
+            self.report(job_id, max(0, total - bytes_remaining), total)
+        return on_progress
+
+    def _drain(self):
+        """Move the latest reports into the job states (runs on the loop)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._wakeup_scheduled = False
+
+        now = time.monotonic()
+        for job_id, (done, total) in pending.items():
+            state = self._states.get(job_id)
+            if state is None:
+                state = self._states[job_id] = {
+                    'done': 0, 'total': total, 'speed': 0.0,
+                    'sample_done': done, 'sample_time': now, 'dirty': True
+                }
+            state['done'] = done
+            state['total'] = total or state['total']
+            state['dirty'] = True
+
+    def _event(self, state: Dict[str, Any], now: float) -> Dict[str, Any]:
+        """Turn a job state into a subscriber event, updating its speed estimate"""
+        elapsed = now - state['sample_time']
+        if elapsed > 0:
+            rate = (state['done'] - state['sample_done']) / elapsed
+            state['speed'] = rate if not state['speed'] else 0.6 * state['speed'] + 0.4 * rate
+            state['sample_done'] = state['done']
+            state['sample_time'] = now
+
+        total = state['total']
+        done = min(state['done'], total) if total else state['done']
+        speed = max(state['speed'], 0.0)
+        return {
+            'status': 'downloading',
+            'percent': int(done * 100 / total) if total else 0,
+            'downloaded': done,
+            'total': total,
+            'speed': speed,
+            'eta': int((total - done) / speed) if speed > 0 and total else None
+        }
+
+    async def _flush_loop(self):
+        """Deliver at most one event per job every interval"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self, job_id: Optional[str] = None):
+        """Send the current state of every changed job (or just job_id) to its subscribers"""
+        self._drain()
+        now = time.monotonic()
+        deliveries = []
+        for key in ([job_id] if job_id else list(self._states)):
+            state = self._states.get(key)
+            if not state or not state['dirty']:
+                continue
+            state['dirty'] = False
+            event = self._event(state, now)
+            for callback in list(self._subscribers.get(key, [])):
+                deliveries.append(self._deliver(key, callback, event))
+        if deliveries:
+            await asyncio.gather(*deliveries)
+
+    @staticmethod
+    async def _deliver(job_id: str, callback: ProgressSubscriber, event: Dict[str, Any]):
+        try:
+            await callback(event)
+        except Exception as e:
+            logger.debug(f"Progress subscriber of {job_id} failed: {e}")
+
+    async def close(self, job_id: str):
+        """Flush the final state of a finished job and forget it"""
+        await self.flush(job_id)
+        self._states.pop(job_id, None)
+        self._subscribers.pop(job_id, None)
+        with self._lock:
+            self._pending.pop(job_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get bus load statistics"""
+        return {
+            'jobs': len(self._states),
+            'subscribers': sum(len(callbacks) for callbacks in self._subscribers.values()),
+            'coalesced_reports': self.coalesced_reports
+        }
+
+
+progress_bus = ProgressBus(DOWNLOAD_CONFIG['progress_interval'])
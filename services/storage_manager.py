@@ -0,0 +1,318 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from config import DOWNLOAD_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class StorageFullError(Exception):
+    """Raised when a download cannot get its bytes within the disk budget"""
+
+    def __init__(self, size: int, budget: int):
+        super().__init__(
+            f"Not enough temporary storage: need {size // (1024 * 1024)} MB of a {budget // (1024 * 1024)} MB budget"
+        )
+        self.size = size
+
+
+class Reservation:
+    """Bytes set aside for one download and the directory it writes into"""
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        self.size = size
+
+
+class StorageManager:
+    """Byte-budgeted temp storage with reference-counted files and an on-disk manifest
+
+    Every job directory and every kept partial download is an entry in the manifest, so
+    accounting and cleanup never have to walk the directory tree.
+    """
+
+    def __init__(self, root: Path, budget: int):
+        self.root = root
+        self.budget = budget
+        self.manifest_path = root / 'manifest.json'
+        # Path -> {'kind': 'job' | 'partial', 'size', 'refs', 'created_at', 'file'}; partials being
+        # written also carry 'in_use', since their bytes are counted in the writer's reservation
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._freed: Optional[asyncio.Event] = None
+        self._sweep_task: Optional[asyncio.Task] = None
+        # Manifest write in progress; changes made meanwhile set _dirty and go out in the next one
+        self._writer: Optional[asyncio.Task] = None
+        self._dirty = False
+        self._started = False
+        self.evicted_bytes = 0
+
+    def start(self):
+        """Load the manifest, drop what the previous run left behind and start the sweeper"""
+        if not self._started:
+            self._started = True
+            self._freed = asyncio.Event()
+            self._load()
+        if self._sweep_task is None:
+            try:
+                self._sweep_task = asyncio.get_running_loop().create_task(self._sweep_loop())
+            except RuntimeError:
+                pass
+
+    def _load(self):
+        """Read the manifest; job files of a previous run are orphans, partials may be resumed"""
+        try:
+            with open(self.manifest_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+
+        max_age = DOWNLOAD_CONFIG['storage_max_age']
+        now = time.time()
+        for path, entry in entries.items():
+            if entry.get('kind') == 'partial' and now - entry.get('created_at', 0) < max_age and os.path.exists(path):
+                # A partial that was being written when the previous run died is an ordinary one again
+                self.entries[path] = dict(entry, refs=0, in_use=False)
+            else:
+                self._remove_path(path, entry)
+
+        self._save()
+        logger.info(f"Temp storage: {len(self.entries)} partial downloads kept, {self.used // (1024 * 1024)} MB in use")
+
+    def _save(self):
+        """Schedule a manifest write off the loop, batching the changes made until it starts"""
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside the loop there is nothing to block
+            self._dirty = False
+            self._write(json.dumps(self.entries))
+            return
+        if self._writer is None:
+            self._writer = loop.create_task(self._flush())
+
+    async def _flush(self):
+        """Write the manifest in a worker thread until no change is left unwritten"""
+        loop = asyncio.get_running_loop()
+        try:
+            while self._dirty:
+                self._dirty = False
+                # Serialized on the loop, where nothing mutates the entries under it
+                await loop.run_in_executor(None, self._write, json.dumps(self.entries))
+        finally:
+            self._writer = None
+
+    def _write(self, data: str):
+        """Write the manifest atomically (blocking)"""
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            logger.error(f"Could not write storage manifest: {e}")
+
+    @property
+    def used(self) -> int:
+        """Bytes reserved or occupied by tracked entries"""
+        return sum(entry['size'] for entry in self.entries.values() if not entry.get('in_use'))
+
+    async def reserve(self, size: int, timeout: Optional[float] = None) -> Reservation:
+        """Set size bytes aside and create a job directory, waiting for space if needed"""
+        self.start()
+        size = max(0, int(size))
+        await self._wait_for_space(size, timeout)
+
+        path = Path(tempfile.mkdtemp(dir=self.root))
+        self.entries[str(path)] = {'kind': 'job', 'size': size, 'refs': 1, 'created_at': time.time(), 'file': None}
+        self._save()
+        return Reservation(path, size)
+
+    async def grow(self, reservation: Reservation, extra: int, timeout: Optional[float] = None):
+        """Add extra bytes to a reservation, e.g. for a second copy written next to the first"""
+        entry = self.entries.get(str(reservation.path))
+        extra = max(0, int(extra))
+        if entry is None or not extra:
+            return
+        await self._wait_for_space(extra, timeout)
+        entry['size'] += extra
+        reservation.size += extra
+        self._save()
+
+    async def _wait_for_space(self, size: int, timeout: Optional[float]):
+        """Wait until size more bytes fit in the budget, evicting kept partials first"""
+        if size > self.budget:
+            raise StorageFullError(size, self.budget)
+
+        timeout = DOWNLOAD_CONFIG['storage_wait_timeout'] if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while self.used + size > self.budget:
+            # Kept partials are only an optimization; give them up before making anyone wait
+            if self._evict_partials(self.used + size - self.budget):
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise StorageFullError(size, self.budget)
+            self._freed.clear()
+            try:
+                await asyncio.wait_for(self._freed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                raise StorageFullError(size, self.budget)
+
+    def commit(self, reservation: Reservation, file_path: Path, refs: int = 1):
+        """Record the finished file of a reservation; its entry shrinks to the real file size"""
+        entry = self.entries.get(str(reservation.path))
+        if entry is None:
+            return
+        entry['file'] = str(file_path)
+        entry['size'] = file_path.stat().st_size
+        entry['refs'] = refs
+        self._save()
+        self._notify()
+
+    def set_refs(self, file_path: str, refs: int):
+        """Set how many users still need a committed file, deleting it at zero"""
+        key = str(Path(file_path).parent)
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        if refs <= 0:
+            self._drop(key)
+        else:
+            entry['refs'] = refs
+            self._save()
+
+    def release(self, file_path: str, count: int = 1):
+        """Drop references to a committed file, deleting it once nobody needs it"""
+        key = str(Path(file_path).parent)
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        self.set_refs(file_path, entry['refs'] - count)
+
+    def discard(self, reservation: Reservation):
+        """Give back a reservation whose download failed, with everything it wrote"""
+        self._drop(str(reservation.path))
+
+    def track_partial(self, path: Path, size: int):
+        """Keep an interrupted download on disk for a later resume"""
+        if not path.exists():
+            return
+        self.entries[str(path)] = {'kind': 'partial', 'size': size, 'refs': 0, 'created_at': time.time(), 'file': None}
+        self._save()
+
+    def claim_partial(self, path: Path, size: int):
+        """Hand a partial (kept or new) to a running download, whose reservation now covers it
+
+        The entry stays in the manifest while in use, so a crash mid-download leaves it tracked
+        and the next run expires it like any other partial.
+        """
+        entry = self.entries.get(str(path))
+        if entry is None:
+            entry = self.entries[str(path)] = {
+                'kind': 'partial', 'size': size, 'refs': 0, 'created_at': time.time(), 'file': None
+            }
+        entry['in_use'] = True
+        self._save()
+
+    def finish_partial(self, path: Path):
+        """Forget a partial that became a finished file"""
+        self._drop(str(path))
+
+    def sweep(self, partial_age: Optional[float] = None, file_age: Optional[float] = None) -> int:
+        """Delete partials and (leaked) job files older than the given ages; returns how many"""
+        max_age = DOWNLOAD_CONFIG['storage_max_age']
+        partial_age = max_age if partial_age is None else partial_age
+        file_age = max_age if file_age is None else file_age
+        now = time.time()
+
+        stale = [
+            key for key, entry in self.entries.items()
+            if not entry.get('in_use')
+            and now - entry['created_at'] >= (partial_age if entry['kind'] == 'partial' else file_age)
+        ]
+        for key in stale:
+            logger.info(f"Removing stale temp entry {key}")
+            self._drop(key, save=False)
+        if stale:
+            self._save()
+        return len(stale)
+
+    async def _sweep_loop(self):
+        """Periodically expire old manifest entries"""
+        while True:
+            await asyncio.sleep(DOWNLOAD_CONFIG['storage_sweep_interval'])
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Temp storage sweep failed: {e}")
+
+    def _evict_partials(self, needed: int) -> bool:
+        """Delete the oldest kept partials until needed bytes are free; False if there were none"""
+        partials = sorted(
+            (key for key, entry in self.entries.items() if entry['kind'] == 'partial' and not entry.get('in_use')),
+            key=lambda key: self.entries[key]['created_at']
+        )
+        if not partials:
+            return False
+        freed = 0
+        for key in partials:
+            if freed >= needed:
+                break
+            freed += self.entries[key]['size']
+            logger.info(f"Evicting partial download {key} to make room")
+            self._drop(key, save=False)
+        self.evicted_bytes += freed
+        self._save()
+        return True
+
+    def _drop(self, key: str, save: bool = True):
+        """Forget an entry and delete its files"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self._remove_path(key, entry)
+        if save:
+            self._save()
+        self._notify()
+
+    @staticmethod
+    def _remove_path(path: str, entry: Dict[str, Any]):
+        """Delete a job directory, or a partial file with its checkpoint"""
+        try:
+            if entry.get('kind') == 'partial':
+                for name in (path, path + '.json'):
+                    if os.path.exists(name):
+                        os.remove(name)
+            elif os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            logger.debug(f"Cleaned up {path}")
+        except OSError as e:
+            logger.debug(f"Cleanup error for {path}: {e}")
+
+    def _notify(self):
+        """Wake up downloads waiting for space"""
+        if self._freed is not None:
+            self._freed.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get disk budget statistics"""
+        partials = [entry for entry in self.entries.values() if entry['kind'] == 'partial' and not entry.get('in_use')]
+        return {
+            'budget': self.budget,
+            'used': self.used,
+            'jobs': sum(1 for entry in self.entries.values() if entry['kind'] == 'job'),
+            'partials': len(partials),
+            'partial_bytes': sum(entry['size'] for entry in partials),
+            'evicted_bytes': self.evicted_bytes
+        }
+
+
+storage_manager = StorageManager(Path(DOWNLOAD_CONFIG['temp_dir']), DOWNLOAD_CONFIG['storage_budget'])
@@ -0,0 +1,141 @@
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError, RPCError
+from telethon.tl.custom import Message
+
+from config import DOWNLOAD_CONFIG, USERBOT_CONFIG
+from services.session_manager import SessionManager
+from services.upload_service import parallel_upload
+
+logger = logging.getLogger(__name__)
+
+
+class UploadRouter:
+    """Uploads large files through the least-loaded userbot into a storage channel
+
+    Each userbot account has its own upload flood limits, so spreading big uploads over them
+    adds capacity the bot alone does not have. The bot then copies the stored message to the
+    user, which costs Telegram a reference instead of a second upload.
+    """
+
+    def __init__(self, session_manager: SessionManager):
+        self.session_manager = session_manager
+        self.channel_id = USERBOT_CONFIG['storage_channel']
+        # Session name -> bytes currently being uploaded through it
+        self.in_flight: Dict[str, int] = {}
+        # Session name -> storage channel input entity as that account sees it
+        self._channels: Dict[str, Any] = {}
+        self.routed = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.channel_id)
+
+    def _candidates(self) -> List[Tuple[str, TelegramClient]]:
+        """Active sessions, least loaded first"""
+        stats = self.session_manager.session_stats
+        sessions = [
+            (name, client) for name, client in self.session_manager.active_sessions.items()
+            if stats.get(name, {}).get('active', True)
+        ]
+        return sorted(sessions, key=lambda s: (self.in_flight.get(s[0], 0), stats.get(s[0], {}).get('usage_count', 0)))
+
+    async def _channel(self, name: str, client: TelegramClient):
+        """Resolve the storage channel for one userbot, filling its entity cache once if needed"""
+        if name not in self._channels:
+            try:
+                entity = await client.get_input_entity(self.channel_id)
+            except ValueError:
+                # A fresh session only knows the channel after seeing it in its dialogs
+                await client.get_dialogs()
+                entity = await client.get_input_entity(self.channel_id)
+            self._channels[name] = entity
+        return self._channels[name]
+
+    async def _store(
+        self,
+        name: str,
+        client: TelegramClient,
+        file_path: Path,
+        file_size: int,
+        attributes: Optional[list],
+        progress_callback: Optional[Callable[[int, int], Awaitable[None]]]
+    ) -> Message:
+        """Upload file_path through one userbot into the storage channel"""
+        channel = await self._channel(name, client)
+        upload = file_path
+        if file_size >= DOWNLOAD_CONFIG['parallel_upload_min_size']:
+            upload = await parallel_upload(client, file_path, progress_callback=progress_callback)
+        return await client.send_file(
+            channel,
+            upload,
+            attributes=attributes,
+            supports_streaming=True,
+            progress_callback=progress_callback
+        )
+
+    async def deliver(
+        self,
+        bot: TelegramClient,
+        chat_id: int,
+        file_path: str,
+        file_size: int,
+        caption: str,
+        attributes: Optional[list] = None,
+        progress_callback: Optional[Callable[[int, int], Awaitable[None]]] = None
+    ) -> Optional[Message]:
+        """Send file_path to chat_id via a userbot and the storage channel; None means upload with the bot"""
+        if not self.enabled or file_size < USERBOT_CONFIG['route_min_size']:
+            return None
+
+        file_path = Path(file_path)
+        for name, client in self._candidates():
+            stats = self.session_manager.session_stats.get(name)
+            if stats is not None:
+                stats['usage_count'] += 1
+                stats['last_used'] = datetime.now()
+
+            self.in_flight[name] = self.in_flight.get(name, 0) + file_size
+            try:
+                stored = await self._store(name, client, file_path, file_size, attributes, progress_callback)
+            except FloodWaitError as e:
+                await self.session_manager.handle_flood_wait(name, e.seconds)
+                continue
+            except (RPCError, ValueError, OSError) as e:
+                # Not a member of the channel, no rights to post, connection lost, file unreadable...
+                logger.warning(f"Userbot {name} could not store {file_path.name}: {e}")
+                self._channels.pop(name, None)
+                continue
+            finally:
+                self.in_flight[name] -= file_size
+
+            try:
+                # The bot needs its own copy of the message to get a media reference it may send
+                message = await bot.get_messages(self.channel_id, ids=stored.id)
+                if message is None or message.media is None:
+                    raise ValueError('stored message is not visible to the bot')
+                sent = await bot.send_file(chat_id, message.media, caption=caption, parse_mode='md')
+            except (RPCError, ValueError, OSError) as e:
+                logger.warning(f"Bot could not copy stored message {stored.id} of {file_path.name}: {e}")
+                break
+
+            self.routed += 1
+            logger.info(f"Delivered {file_path.name} via userbot {name} and storage message {stored.id}")
+            return sent
+
+        self.fallbacks += 1
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get routing statistics"""
+        return {
+            'enabled': self.enabled,
+            'routed': self.routed,
+            'fallbacks': self.fallbacks,
+            'in_flight': sum(self.in_flight.values())
+        }
@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import math
+import os
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Deque, List, Optional, Tuple, Union
+
+from telethon import TelegramClient, helpers
+from telethon.errors import FloodWaitError
+from telethon.network import MTProtoSender
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputFile, InputFileBig
+
+from config import DOWNLOAD_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts parts of up to 512 KiB; files above 10 MiB must use saveBigFilePart
+UPLOAD_PART_SIZE = 512 * 1024
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+
+
+class SpillBuffer:
+    """Ordered byte buffer that keeps up to max_memory bytes in RAM and spills the rest to disk"""
+
+    def __init__(self, max_memory: int, spill_dir: Path):
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        # Items are bytes kept in memory or (offset, length) slices of the spill file
+        self._items: Deque[Union[bytes, Tuple[int, int]]] = deque()
+        self._memory = 0
+        self._spill_file = None
+        self._spill_size = 0
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._changed = asyncio.Condition()
+        self.spilled_bytes = 0
+
+    async def write(self, data: bytes):
+        """Append data; never blocks on the consumer, spilling to disk when memory is full"""
+        if not data:
+            return
+        async with self._changed:
+            if self._memory + len(data) <= self.max_memory:
+                self._items.append(data)
+                self._memory += len(data)
+            else:
+                offset = await self._spill(data)
+                self._items.append((offset, len(data)))
+            self._changed.notify_all()
+
+    async def _spill(self, data: bytes) -> int:
+        """Append data to the spill file and return its offset"""
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+            logger.debug("Upload is behind the download, spilling stream buffer to disk")
+        offset = self._spill_size
+        self._spill_size += len(data)
+        self.spilled_bytes += len(data)
+        await asyncio.get_running_loop().run_in_executor(
+            None, os.pwrite, self._spill_file.fileno(), data, offset
+        )
+        return offset
+
+    async def close(self, error: Optional[BaseException] = None):
+        """Mark the end of the data, or abort the reader with error"""
+        async with self._changed:
+            self._closed = True
+            self._error = error
+            self._changed.notify_all()
+
+    async def read(self, size: int) -> bytes:
+        """Read exactly size bytes (fewer only at the end of the data)"""
+        parts = []
+        wanted = size
+        async with self._changed:
+            while wanted > 0:
+                if self._error is not None:
+                    raise self._error
+                if not self._items:
+                    if self._closed:
+                        break
+                    await self._changed.wait()
+                    continue
+
+                item = self._items.popleft()
+                if isinstance(item, bytes):
+                    self._memory -= len(item)
+                    data = item
+                else:
+                    offset, length = item
+                    data = await asyncio.get_running_loop().run_in_executor(
+                        None, os.pread, self._spill_file.fileno(), length, offset
+                    )
+
+                if len(data) > wanted:
+                    # Put the remainder back in front, in memory
+                    rest = data[wanted:]
+                    self._items.appendleft(rest)
+                    self._memory += len(rest)
+                    data = data[:wanted]
+
+                parts.append(data)
+                wanted -= len(data)
+
+        return b''.join(parts)
+
+    def discard(self):
+        """Release memory and the spill file"""
+        self._items.clear()
+        self._memory = 0
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+
+class StreamingUploader:
+    """Uploads a file to Telegram part by part while its bytes are still arriving"""
+
+    def __init__(self, client: TelegramClient, workers: int = DOWNLOAD_CONFIG['upload_workers']):
+        self.client = client
+        self.workers = max(1, workers)
+
+    async def upload(
+        self,
+        buffer: SpillBuffer,
+        file_size: int,
+        file_name: str,
+        progress_callback: Optional[Callable[[int, int], Awaitable[None]]] = None
+    ) -> Union[InputFile, InputFileBig]:
+        """Upload file_size bytes read from buffer and return the InputFile to send"""
+        file_id = helpers.generate_random_long()
+        total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        is_big = file_size > BIG_FILE_THRESHOLD
+        next_part = [0]
+        uploaded = [0]
+        read_lock = asyncio.Lock()
+
+        async def worker():
+            while True:
+                # Parts must be read in order, but may be sent in any order
+                async with read_lock:
+                    index = next_part[0]
+                    if index >= total_parts:
+                        return
+                    data = await buffer.read(UPLOAD_PART_SIZE)
+                    next_part[0] += 1
+
+                expected = min(UPLOAD_PART_SIZE, file_size - index * UPLOAD_PART_SIZE)
+                if len(data) != expected:
+                    raise IOError(f"Stream ended early: part {index} has {len(data)}/{expected} bytes")
+
+                if is_big:
+                    request = SaveBigFilePartRequest(file_id, index, total_parts, data)
+                else:
+                    request = SaveFilePartRequest(file_id, index, data)
+                if not await self.client(request):
+                    raise IOError(f"Telegram rejected upload part {index}")
+
+                uploaded[0] += len(data)
+                if progress_callback:
+                    try:
+                        await progress_callback(uploaded[0], file_size)
+                    except Exception as e:
+                        logger.debug(f"Upload progress callback error: {e}")
+
+        tasks = [asyncio.create_task(worker()) for _ in range(min(self.workers, total_parts))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        if is_big:
+            return InputFileBig(file_id, total_parts, file_name)
+        return InputFile(file_id, total_parts, file_name, '')
+
+
+async def stream_upload(
+    client: TelegramClient,
+    produce: Callable[[Callable[[int, bytes], Awaitable[None]]], Awaitable[Any]],
+    file_size: int,
+    file_name: str,
+    progress_callback: Optional[Callable[[int, int], Awaitable[None]]] = None
+) -> Union[InputFile, InputFileBig]:
+    """Run a byte producer and a Telegram upload side by side through a bounded spill buffer
+
+    produce(write) must call write(offset, chunk) with the file's bytes in order.
+    """
+    buffer = SpillBuffer(DOWNLOAD_CONFIG['stream_buffer_size'], Path(DOWNLOAD_CONFIG['temp_dir']))
+
+    async def run_producer():
+        try:
+            await produce(lambda offset, chunk: buffer.write(chunk))
+        except BaseException as e:
+            await buffer.close(e if isinstance(e, Exception) else IOError('Download cancelled'))
+            raise
+        await buffer.close()
+
+    producer = asyncio.create_task(run_producer())
+    try:
+        input_file = await StreamingUploader(client).upload(buffer, file_size, file_name, progress_callback)
+        await producer
+    except BaseException:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        raise
+    finally:
+        if buffer.spilled_bytes:
+            logger.info(f"Streaming upload of {file_name} spilled {buffer.spilled_bytes} bytes to disk")
+        buffer.discard()
+
+    return input_file
+
+
+class ParallelUploader:
+    """Uploads a file from disk with its parts spread over several MTProto connections
+
+    Telethon's send_file sends one part at a time. Here every extra connection reuses the
+    client's own auth key, so the parts still belong to the client's account and the
+    resulting InputFile can be sent by it. Parts are retried on another connection.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        connections: int = DOWNLOAD_CONFIG['upload_connections'],
+        workers: int = DOWNLOAD_CONFIG['upload_workers']
+    ):
+        self.client = client
+        self.connections = max(1, connections)
+        # Parts in flight per connection
+        self.workers = max(1, workers)
+
+    async def _open_senders(self) -> List[MTProtoSender]:
+        """Extra connections to the client's home DC under its authorization"""
+        senders = []
+        try:
+            dc = await self.client._get_dc(self.client.session.dc_id)
+            for _ in range(self.connections - 1):
+                sender = MTProtoSender(self.client.session.auth_key, loggers=self.client._log)
+                await sender.connect(self.client._connection(
+                    dc.ip_address, dc.port, dc.id, loggers=self.client._log, proxy=self.client._proxy
+                ))
+                senders.append(sender)
+        except Exception as e:
+            # Fewer connections only means a slower upload
+            logger.warning(f"Opened {len(senders)} extra upload connections of {self.connections - 1}: {e}")
+        return senders
+
+    async def upload(
+        self,
+        file_path: Union[str, Path],
+        file_name: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, int], Awaitable[None]]] = None
+    ) -> Union[InputFile, InputFileBig]:
+        """Upload file_path and return the InputFile to send"""
+        file_path = Path(file_path)
+        file_size = file_path.stat().st_size
+        file_id = helpers.generate_random_long()
+        total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        is_big = file_size > BIG_FILE_THRESHOLD
+        pending: Deque[int] = deque(range(total_parts))
+        uploaded = [0]
+        last_progress = [0.0]
+        loop = asyncio.get_running_loop()
+
+        senders = await self._open_senders()
+        invokers: List[Callable[[Any], Awaitable[Any]]] = [self.client] + [sender.send for sender in senders]
+
+        async def send_part(fd: int, index: int, connection: int):
+            data = await loop.run_in_executor(None, os.pread, fd, UPLOAD_PART_SIZE, index * UPLOAD_PART_SIZE)
+            if is_big:
+                request = SaveBigFilePartRequest(file_id, index, total_parts, data)
+            else:
+                request = SaveFilePartRequest(file_id, index, data)
+
+            retries = DOWNLOAD_CONFIG['upload_part_retries']
+            for attempt in range(retries + 1):
+                # A retry goes out on the next connection in case this one is the problem
+                invoke = invokers[(connection + attempt) % len(invokers)]
+                try:
+                    if await invoke(request):
+                        break
+                    error: Exception = IOError(f"Telegram rejected upload part {index}")
+                except FloodWaitError as e:
+                    error = e
+                    await asyncio.sleep(e.seconds)
+                except (ConnectionError, asyncio.TimeoutError, IOError) as e:
+                    error = e
+                    await asyncio.sleep(min(2 ** attempt, 10))
+                if attempt >= retries:
+                    raise error
+                logger.debug(f"Upload part {index} of {file_path.name} failed ({error}), retrying")
+
+            uploaded[0] += len(data)
+            now = time.monotonic()
+            if progress_callback and (now - last_progress[0] >= DOWNLOAD_CONFIG['progress_interval'] or uploaded[0] >= file_size):
+                last_progress[0] = now
+                try:
+                    await progress_callback(uploaded[0], file_size)
+                except Exception as e:
+                    logger.debug(f"Upload progress callback error: {e}")
+
+        async def worker(fd: int, connection: int):
+            while pending:
+                await send_part(fd, pending.popleft(), connection)
+
+        started = time.monotonic()
+        fd = os.open(file_path, os.O_RDONLY)
+        tasks = [
+            asyncio.create_task(worker(fd, connection))
+            for connection in range(len(invokers))
+            for _ in range(self.workers)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            os.close(fd)
+            for sender in senders:
+                await sender.disconnect()
+
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Uploaded {file_path.name} ({file_size // (1024 * 1024)} MB) over {len(invokers)} connections "
+            f"in {elapsed:.1f}s"
+        )
+
+        file_name = file_name or file_path.name
+        if is_big:
+            return InputFileBig(file_id, total_parts, file_name)
+        return InputFile(file_id, total_parts, file_name, '')
+
+
+async def parallel_upload(
+    client: TelegramClient,
+    file_path: Union[str, Path],
+    file_name: Optional[str] = None,
+    progress_callback: Optional[Callable[[int, int], Awaitable[None]]] = None
+) -> Union[InputFile, InputFileBig]:
+    """Upload a file on disk over several connections; send the result with client.send_file()"""
+    return await ParallelUploader(client).upload(file_path, file_name, progress_callback)
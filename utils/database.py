@@ -56,6 +56,12 @@ class Database:
     def __init__(self):
         self.db_path = DATABASE_CONFIG['name']
         self.lock = asyncio.Lock()
+        
+        # File cache lookups since startup
+        self.file_cache_hits = 0
+        self.file_cache_misses = 0
+        self.file_cache_invalidations = 0
+        
         self._init_db()
     
     async def initialize(self):
@@ -74,6 +80,7 @@ class Database:
                     conn.execute(create_sql)
                     logger.debug(f"✅ Table {table_name} ready")
                 
+                self._migrate(conn)
                 conn.commit()
                 logger.info("✅ Database initialized successfully")
         
@@ -81,6 +88,13 @@ class Database:
             logger.error(f"❌ Database initialization error: {e}")
             raise
     
+    def _migrate(self, conn: sqlite3.Connection):
+        """Add columns that older databases were created without"""
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(downloads)')}
+        if 'quality' not in columns:
+            conn.execute('ALTER TABLE downloads ADD COLUMN quality TEXT')
+            logger.info("✅ Added quality column to downloads")
+    
     async def add_user(
         self, 
         user_id: int, 
@@ -228,7 +242,8 @@ class Database:
         media_type: str,
         file_size: int,
         session_used: str,
-        status: str
+        status: str,
+        quality: Optional[str] = None
     ) -> bool:
         """Log a download attempt"""
         async with self.lock:
@@ -236,11 +251,11 @@ class Database:
                 with sqlite3.connect(self.db_path) as conn:
                     conn.execute(
                         '''INSERT INTO downloads 
-                           (user_id, url, platform, media_type, file_size, session_used, download_date, status) 
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (user_id, url, platform, media_type, file_size, session_used, download_date, status, quality) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                         (
                             user_id, url, platform, media_type, file_size,
-                            session_used, datetime.now().isoformat(), status
+                            session_used, datetime.now().isoformat(), status, quality
                         )
                     )
                     conn.commit()
@@ -251,6 +266,154 @@ class Database:
                 logger.error(f"❌ Error logging download for user {user_id}: {e}")
                 return False
     
+    async def get_quality_history(self, user_id: int, platform: str, limit: int = 50) -> Dict[str, Dict[str, int]]:
+        """Count the qualities picked in recent successful downloads, for one user and for everybody"""
+        async with self.lock:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    user_rows = conn.execute(
+                        '''SELECT quality, COUNT(*) FROM (
+                               SELECT quality FROM downloads
+                               WHERE user_id = ? AND platform = ? AND status = 'success' AND quality IS NOT NULL
+                               ORDER BY id DESC LIMIT ?
+                           ) GROUP BY quality''',
+                        (user_id, platform, limit)
+                    ).fetchall()
+                    
+                    global_rows = conn.execute(
+                        '''SELECT quality, COUNT(*) FROM (
+                               SELECT quality FROM downloads
+                               WHERE platform = ? AND status = 'success' AND quality IS NOT NULL
+                               ORDER BY id DESC LIMIT ?
+                           ) GROUP BY quality''',
+                        (platform, limit * 20)
+                    ).fetchall()
+                    
+                    return {'user': dict(user_rows), 'global': dict(global_rows)}
+            
+            except Exception as e:
+                logger.error(f"❌ Error reading quality history for user {user_id}: {e}")
+                return {'user': {}, 'global': {}}
+    
+    async def get_cached_file(self, platform: str, media_id: str, quality: str) -> Optional[Dict[str, Any]]:
+        """Get the Telegram file reference of an already delivered media/format"""
+        async with self.lock:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.row_factory = sqlite3.Row
+                    
+                    row = conn.execute(
+                        'SELECT * FROM file_cache WHERE platform = ? AND media_id = ? AND quality = ?',
+                        (platform, media_id, quality)
+                    ).fetchone()
+                    
+                    if not row:
+                        self.file_cache_misses += 1
+                        return None
+                    
+                    conn.execute(
+                        'UPDATE file_cache SET hits = hits + 1, last_used = ? WHERE id = ?',
+                        (datetime.now().isoformat(), row['id'])
+                    )
+                    conn.commit()
+                    self.file_cache_hits += 1
+                    return dict(row)
+            
+            except Exception as e:
+                logger.error(f"❌ Error reading file cache for {platform}/{media_id}: {e}")
+                return None
+    
+    async def has_cached_file(self, platform: str, media_id: str, quality: str) -> bool:
+        """Whether a media/format is in the file cache, without counting a lookup"""
+        async with self.lock:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    row = conn.execute(
+                        'SELECT 1 FROM file_cache WHERE platform = ? AND media_id = ? AND quality = ?',
+                        (platform, media_id, quality)
+                    ).fetchone()
+                    return row is not None
+            
+            except Exception as e:
+                logger.error(f"❌ Error reading file cache for {platform}/{media_id}: {e}")
+                return False
+    
+    async def cache_file(
+        self,
+        platform: str,
+        media_id: str,
+        quality: str,
+        document_id: int,
+        access_hash: int,
+        file_reference: bytes,
+        media_type: str,
+        file_size: int,
+        title: str
+    ) -> bool:
+        """Remember the Telegram file reference of a sent media/format"""
+        async with self.lock:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    now = datetime.now().isoformat()
+                    conn.execute(
+                        '''INSERT OR REPLACE INTO file_cache 
+                           (platform, media_id, quality, document_id, access_hash, file_reference,
+                            media_type, file_size, title, hits, created_at, last_used) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)''',
+                        (
+                            platform, media_id, quality, document_id, access_hash, file_reference,
+                            media_type, file_size, title, now, now
+                        )
+                    )
+                    conn.commit()
+                    logger.debug(f"✅ Cached file reference for {platform}/{media_id} ({quality})")
+                    return True
+            
+            except Exception as e:
+                logger.error(f"❌ Error caching file for {platform}/{media_id}: {e}")
+                return False
+    
+    async def invalidate_cached_file(self, platform: str, media_id: str, quality: str) -> bool:
+        """Forget a file reference that Telegram no longer accepts"""
+        async with self.lock:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.execute(
+                        'DELETE FROM file_cache WHERE platform = ? AND media_id = ? AND quality = ?',
+                        (platform, media_id, quality)
+                    )
+                    conn.commit()
+                    self.file_cache_invalidations += 1
+                    logger.info(f"🗑️ Invalidated cached file for {platform}/{media_id} ({quality})")
+                    return True
+            
+            except Exception as e:
+                logger.error(f"❌ Error invalidating cached file for {platform}/{media_id}: {e}")
+                return False
+    
+    async def get_file_cache_stats(self) -> Dict[str, Any]:
+        """Get file cache size and hit rate"""
+        async with self.lock:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    row = conn.execute(
+                        'SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM file_cache'
+                    ).fetchone()
+                    
+                    lookups = self.file_cache_hits + self.file_cache_misses
+                    return {
+                        'entries': row[0],
+                        'total_hits': row[1],
+                        'hits': self.file_cache_hits,
+                        'misses': self.file_cache_misses,
+                        'invalidations': self.file_cache_invalidations,
+                        'hit_rate': round(self.file_cache_hits / lookups * 100, 1) if lookups else 0.0
+                    }
+            
+            except Exception as e:
+                logger.error(f"❌ Error getting file cache stats: {e}")
+                return {}
+    
     async def store_temp_url(self, user_id: int, url: str, platform: str) -> bool:
         """Store temporary URL for callback processing"""
         async with self.lock:
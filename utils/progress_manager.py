@@ -3,6 +3,8 @@ import time
 import math
 from telethon import Button
 
+from services.outbox import outbox
+
 class ProgressManager:
     """مدیریت نمایش پیشرفت دانلود برای Telethon"""
     
@@ -74,11 +76,8 @@ class ProgressManager:
             
         progress_text += "\n\n⏳ لطفاً صبر کنید..."
         
-        try:
-            await self.message.edit(progress_text, parse_mode='md')
-        except Exception:
-            # اگر ویرایش ناموفق بود، پیام جدید ارسال کن
-            pass
+        # ویرایش در صف ارسال قرار می‌گیرد و با به‌روزرسانی بعدی ادغام می‌شود؛ دانلود منتظر آن نمی‌ماند
+        outbox.edit(self.message, progress_text, parse_mode='md')
     
     async def complete_progress(self, file_info: str, file_size: int):
         """تکمیل پیشرفت"""
@@ -93,7 +92,7 @@ class ProgressManager:
         )
         
         try:
-            await self.message.edit(complete_text, parse_mode='md')
+            await outbox.edit(self.message, complete_text, parse_mode='md')
         except Exception:
             pass
     
@@ -106,7 +105,7 @@ class ProgressManager:
         )
         
         try:
-            await self.message.edit(error_text, parse_mode='md')
+            await outbox.edit(self.message, error_text, parse_mode='md')
         except Exception:
             pass
     